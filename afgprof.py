@@ -1,24 +1,45 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import asyncio
 import bisect
 import collections
+import concurrent.futures
 import contextlib
+import cProfile
 import functools
+import hashlib
+import heapq
+import io
 import json
+import mmap
 import os
 import pathlib
 import re
+import resource
 import shlex
 import shutil
+import signal
+import sqlite3
 import struct
 import subprocess
 import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 hexint = functools.partial(int, base=16)
 
-*'This script only works under Python 3.5 or later',
+# contextlib.nullcontext and dicts kept in insertion order
+if sys.version_info < (3, 7):
+    sys.exit('This script only works under Python 3.7 or later')
 
 
 class DictObj:
@@ -33,6 +54,9 @@ class DictObj:
 
 
 class ProgressBar:
+    # off in pool workers, whose bars would overwrite each other
+    enabled = True
+
     def __init__(
             self,
             arg=None,
@@ -62,12 +86,12 @@ class ProgressBar:
 
     def increment(self):
         self.count += 1
-        nextp = 1000 * self.count // self.length
+        nextp = 1000 * self.count // self.length if self.length else 1000
         if self.p == nextp:
             return
         self.p = nextp
         self.print()
-        if self.p == 1000:
+        if self.p == 1000 and self.enabled:
             print(file=self.file)
 
     @property
@@ -90,6 +114,8 @@ class ProgressBar:
         return next(self.iter)
 
     def print(self):
+        if not self.enabled:
+            return
         print(
             end=self.format.format_map(self._dictobj),
             file=self.file,
@@ -97,18 +123,142 @@ class ProgressBar:
         )
 
 
-async def gather_cancel(*coros, loop):
-    assert loop is not None
-    tasks = [asyncio.ensure_future(coro, loop=loop) for coro in coros]
+class Stats:
+    """Timing and memory measurements of the stages of a run, for --stats.
+
+    Memory is traced with tracemalloc only when trace_memory is set, as it
+    slows allocations down considerably.  Stages named in profile_stages
+    are also run under cProfile and dumped to <prefix>.<stage>.prof.
+    """
+
+    def __init__(self, trace_memory=False, profile_stages=(), prefix=None):
+        self.trace_memory = trace_memory
+        self.profile_stages = set(profile_stages)
+        self.prefix = prefix
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        profile = None
+        if name in self.profile_stages:
+            profile = cProfile.Profile()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            result = self.stages[name] = collections.OrderedDict()
+            result['wall_seconds'] = time.perf_counter() - wall
+            result['cpu_seconds'] = time.process_time() - cpu
+            result['children_cpu_seconds'] = sum(
+                after - before for before, after in zip(
+                    children[:2],
+                    resource.getrusage(resource.RUSAGE_CHILDREN)[:2]
+                )
+            )
+            if self.trace_memory:
+                result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            # ru_maxrss is the peak of the whole run so far, in KiB on Linux
+            result['peak_rss_kib'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if profile is not None:
+                result['profile'] = '{}.{}.prof'.format(self.prefix, name)
+                profile.dump_stats(result['profile'])
+
+    def write(self, file):
+        json.dump(
+            collections.OrderedDict(
+                [('stages', self.stages)] + list(self.counters.items())
+            ),
+            file,
+            indent=2,
+        )
+        file.write('\n')
+
+
+async def gather_cancel(*coros):
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
     try:
-        return await asyncio.gather(*tasks, loop=loop)
+        return await asyncio.gather(*tasks)
     except:
         for task in tasks:
             task.cancel()
         raise
 
 
-class Addr2line:
+class Symbolizer:
+    workers = 1
+
+    def symbolize(self, jobs):
+        """Resolve ``{filename: addresses}``.
+
+        Return ``(filename, address, symbol, location)`` tuples.  Afterwards
+        object_stats holds the time spent on each object and utilization
+        the busy fraction of the workers.
+        """
+        self.object_stats = collections.OrderedDict()
+        results = []
+        for filename, addresses in jobs.items():
+            start = time.perf_counter()
+            for address, symbol, location in self.find_symbol_and_line(
+                    filename, addresses
+            ):
+                results.append((filename, address, symbol, location))
+            seconds = time.perf_counter() - start
+            self._add_object_stats(filename, len(addresses), seconds, seconds)
+        self.utilization = 1.0
+        return results
+
+    def _load_tables(self, filename, load):
+        """Return load(filename), reused until the file is replaced or
+        modified, such as an object rebuilt during --watch."""
+        stat = os.stat(filename)
+        key = stat.st_ino, stat.st_size, stat.st_mtime_ns
+        cached = self.tables.get(filename)
+        if cached is None or cached[0] != key:
+            cached = self.tables[filename] = key, load(filename)
+        return cached[1]
+
+    def _add_object_stats(self, filename, addresses, seconds, worker_seconds):
+        self.object_stats[filename] = collections.OrderedDict([
+            ('symbolized', addresses),
+            ('seconds', seconds),
+            ('worker_seconds', worker_seconds),
+            ('addresses_per_second', addresses / seconds if seconds else None),
+        ])
+
+
+class Addr2line(Symbolizer):
+    """Pool of addr2line processes shared by all objects.
+
+    Each of the worker slots runs one addr2line process at a time.  A free
+    slot starts a process for the object with the most remaining
+    addresses per process already working on it, so large objects get
+    more processes and slots move on to other objects instead of idling
+    when one runs out of work.
+    """
+
+    class Job:
+        def __init__(self, filename, addresses):
+            self.filename = filename
+            self.address_iter = iter(addresses)
+            self.remaining = len(addresses)
+            self.processes = 0
+            self.count = len(addresses)
+            self.start = None
+            self.end = None
+            self.busy = 0.0
+
     def __init__(self, command, workers):
         if shutil.which(command) is None:
             raise Exception(
@@ -123,38 +273,77 @@ class Addr2line:
             self.workers = cpu_count()
 
     def find_symbol_and_line(self, filename, addresses):
-        self.filename = filename
-        self.address_iter = iter(addresses)
+        return [
+            result[1:] for result in self.symbolize({filename: addresses})
+        ]
+
+    def symbolize(self, jobs):
+        self.jobs = [
+            self.Job(filename, addresses)
+            for filename, addresses in jobs.items()
+            if addresses
+        ]
         self.results = []
 
+        start = time.perf_counter()
+        loop = asyncio.new_event_loop()
         try:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            task = gather_cancel(
-                *(self._worker() for i in range(self.workers)),
-                loop=self.loop,
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(
+                gather_cancel(*(self._slot() for i in range(self.workers)))
             )
-            self.loop.run_until_complete(task)
-            return self.results
         finally:
-            self.loop.close()
+            asyncio.set_event_loop(None)
+            loop.close()
+        wall = time.perf_counter() - start
+
+        self.object_stats = collections.OrderedDict()
+        for job in self.jobs:
+            self._add_object_stats(
+                job.filename, job.count, job.end - job.start, job.busy
+            )
+        busy = sum(job.busy for job in self.jobs)
+        self.utilization = busy / (wall * self.workers) if wall else None
+        return self.results
 
-    async def _worker(self):
+    def _next_job(self):
+        jobs = [job for job in self.jobs if job.remaining > 0]
+        if not jobs:
+            return None
+        return max(jobs, key=lambda job: job.remaining / (job.processes + 1))
+
+    async def _slot(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job.processes += 1
+            start = time.perf_counter()
+            if job.start is None:
+                job.start = start
+            try:
+                await self._worker(job)
+            finally:
+                job.processes -= 1
+                job.end = time.perf_counter()
+                job.busy += job.end - start
+
+    async def _worker(self, job):
         process = await asyncio.create_subprocess_exec(
             self.command,
             '-f',
             '-e',
-            self.filename,
+            job.filename,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            loop=self.loop
         )
 
         input_completed = False
-        queue = asyncio.Queue(maxsize=100, loop=self.loop)
+        queue = asyncio.Queue(maxsize=100)
 
         async def input_worker():
-            for address in self.address_iter:
+            for address in job.address_iter:
+                job.remaining -= 1
                 await queue.put(address)
                 process.stdin.write('{:x}\n'.format(address).encode())
                 await process.stdin.drain()
@@ -181,14 +370,13 @@ class Addr2line:
                 if not location:
                     handle_eof()
                 address = queue.get_nowait()
-                self.results.append((address, symbol, location))
+                self.results.append((job.filename, address, symbol, location))
             await process.wait()
 
         try:
             await gather_cancel(
                 input_worker(),
                 output_worker(),
-                loop=self.loop,
             )
         except:
             with contextlib.suppress(ProcessLookupError):
@@ -196,6 +384,1435 @@ class Addr2line:
             raise
 
 
+class ElfFile:
+    """Minimal ELF reader: section contents, symbols and build-id."""
+
+    SHT_NOBITS = 8
+    SHF_COMPRESSED = 0x800
+    STT_FUNC = 2
+    STT_FILE = 4
+    STT_GNU_IFUNC = 10
+    STB_LOCAL = 0
+    EM_ARM = 40
+    NT_GNU_BUILD_ID = 3
+
+    Section = collections.namedtuple(
+        'Section',
+        ('name', 'type', 'flags', 'address', 'offset', 'size', 'link')
+    )
+    Symbol = collections.namedtuple(
+        'Symbol', ('address', 'size', 'name', 'file', 'end')
+    )
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self.data = file.read()
+        if self.data[:4] != b'\x7fELF':
+            raise ValueError('{}: not an ELF file'.format(filename))
+
+        self.elfclass = {1: 32, 2: 64}[self.data[4]]
+        self.endian = {1: '<', 2: '>'}[self.data[5]]
+        if self.elfclass == 32:
+            header = '{}HHIIIIIHHHHHH'
+            section_header = '{}IIIIIIIIII'
+        else:
+            header = '{}HHIQQQIHHHHHH'
+            section_header = '{}IIQQQQIIQQ'
+        (
+            _, self.machine, _, _, _, shoff, _, _, _, _, shentsize, shnum,
+            shstrndx
+        ) = struct.unpack_from(header.format(self.endian), self.data, 16)
+
+        section_header = struct.Struct(section_header.format(self.endian))
+        headers = []
+        if shoff:
+            first = section_header.unpack_from(self.data, shoff)
+            if shnum == 0:
+                shnum = first[5]
+            if shstrndx == 0xffff:
+                shstrndx = first[6]
+            for i in range(shnum):
+                (
+                    name, type_, flags, address, offset, size, link, _, _, _
+                ) = section_header.unpack_from(self.data, shoff + i * shentsize)
+                headers.append(
+                    (name, type_, flags, address, offset, size, link)
+                )
+
+        self.sections = []
+        if headers:
+            strtab_offset = headers[shstrndx][4]
+            for name, *header in headers:
+                self.sections.append(
+                    self.Section(
+                        self._cstring(strtab_offset + name), *header
+                    )
+                )
+        self.section_by_name = {
+            section.name: section for section in self.sections
+        }
+
+    def _cstring(self, offset):
+        end = self.data.index(b'\0', offset)
+        return self.data[offset:end].decode(errors='replace')
+
+    def section_data(self, name):
+        """Return the (decompressed) contents of a section, or None."""
+        section = self.section_by_name.get(name)
+        if section is None and name.startswith('.debug_'):
+            section = self.section_by_name.get('.z' + name[1:])
+        if section is None:
+            return None
+        if section.type == self.SHT_NOBITS:
+            return b''
+        data = self.data[section.offset:section.offset + section.size]
+        if section.flags & self.SHF_COMPRESSED:
+            if self.elfclass == 32:
+                chdr = struct.Struct(self.endian + 'III')
+            else:
+                chdr = struct.Struct(self.endian + 'IIQQ')
+            if struct.unpack_from(self.endian + 'I', data)[0] != 1:
+                raise ValueError(
+                    '{}: unsupported compression in {}'.format(
+                        self.filename, section.name
+                    )
+                )
+            data = zlib.decompress(data[chdr.size:])
+        elif section.name.startswith('.zdebug_') and data[:4] == b'ZLIB':
+            data = zlib.decompress(data[12:])
+        return data
+
+    def symbols(self):
+        """Return the function symbols.
+
+        ``end`` is the end of the symbol's section.  ``file`` is the source
+        file of local symbols, taken from the preceding STT_FILE symbol, or
+        None.
+        """
+        for name in ('.symtab', '.dynsym'):
+            section = self.section_by_name.get(name)
+            if section is not None and section.size:
+                break
+        else:
+            return []
+
+        strtab = self.sections[section.link].offset
+        if self.elfclass == 32:
+            entry = struct.Struct(self.endian + 'IIIBBH')
+        else:
+            entry = struct.Struct(self.endian + 'IBBHQQ')
+        arm = self.machine == self.EM_ARM
+
+        symbols = []
+        file = None
+        for offset in range(
+                section.offset, section.offset + section.size, entry.size
+        ):
+            if self.elfclass == 32:
+                name, value, size, info, _, shndx = entry.unpack_from(
+                    self.data, offset
+                )
+            else:
+                name, info, _, shndx, value, size = entry.unpack_from(
+                    self.data, offset
+                )
+            type_ = info & 0xf
+            if type_ == self.STT_FILE:
+                file = self._cstring(strtab + name)
+                continue
+            if type_ not in (self.STT_FUNC, self.STT_GNU_IFUNC) or \
+                    not 0 < shndx < len(self.sections):
+                continue
+            name = self._cstring(strtab + name)
+            if arm:
+                if name.startswith('$'):
+                    # mapping symbols
+                    continue
+                value &= ~1
+            section_end = self.sections[shndx].address + \
+                self.sections[shndx].size
+            symbols.append(
+                self.Symbol(
+                    value, size, name,
+                    file if info >> 4 == self.STB_LOCAL else None,
+                    section_end
+                )
+            )
+        return symbols
+
+    def build_id(self):
+        """Return the GNU build-id as a hex string, or None."""
+        for section in self.sections:
+            if not section.name.startswith('.note'):
+                continue
+            data = self.section_data(section.name)
+            offset = 0
+            while offset + 12 <= len(data):
+                namesz, descsz, type_ = struct.unpack_from(
+                    self.endian + 'III', data, offset
+                )
+                offset += 12
+                name = data[offset:offset + namesz]
+                offset += (namesz + 3) & ~3
+                desc = data[offset:offset + descsz]
+                offset += (descsz + 3) & ~3
+                if type_ == self.NT_GNU_BUILD_ID and name == b'GNU\0':
+                    return desc.hex()
+        return None
+
+
+class SymbolTable:
+    """Function symbols sorted by address for bisect lookups.
+
+    Like addr2line, an address belongs to the nearest preceding symbol in
+    the same section, whatever the symbol's size.
+    """
+
+    def __init__(self, symbols):
+        # prefer the first of the largest symbols at the same address
+        symbols = sorted(symbols, key=lambda symbol: (symbol[0], -symbol[1]))
+        self.starts = []
+        self.ends = []
+        self.names = []
+        self.files = []
+        for symbol in symbols:
+            if self.starts and self.starts[-1] == symbol.address:
+                continue
+            self.starts.append(symbol.address)
+            self.ends.append(symbol.end)
+            self.names.append(symbol.name)
+            self.files.append(symbol.file)
+
+    def lookup(self, address):
+        """Return the index of the function containing address, or -1."""
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0 or self.ends[index] <= address:
+            return -1
+        return index
+
+
+class DwarfReader:
+    """Cursor over a DWARF section."""
+
+    def __init__(self, data, offset, endian):
+        self.data = data
+        self.offset = offset
+        self.endian = endian
+        self.offset_size = 4
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(self.endian + fmt, self.data, self.offset)
+        self.offset += struct.calcsize(self.endian + fmt)
+        return values
+
+    def u8(self):
+        self.offset += 1
+        return self.data[self.offset - 1]
+
+    def u16(self):
+        return self.unpack('H')[0]
+
+    def u32(self):
+        return self.unpack('I')[0]
+
+    def u64(self):
+        return self.unpack('Q')[0]
+
+    def uint(self, size):
+        value = int.from_bytes(
+            self.data[self.offset:self.offset + size],
+            'little' if self.endian == '<' else 'big',
+        )
+        self.offset += size
+        return value
+
+    def uleb(self):
+        data = self.data
+        offset = self.offset
+        result = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.offset = offset
+        return result
+
+    def sleb(self):
+        data = self.data
+        offset = self.offset
+        result = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        self.offset = offset
+        if byte & 0x40:
+            result -= 1 << shift
+        return result
+
+    def cstring(self):
+        end = self.data.index(b'\0', self.offset)
+        value = self.data[self.offset:end].decode(errors='replace')
+        self.offset = end + 1
+        return value
+
+    def unit_length(self):
+        """Read an initial length field and return the end of the unit."""
+        length = self.u32()
+        if length == 0xffffffff:
+            self.offset_size = 8
+            length = self.u64()
+        else:
+            self.offset_size = 4
+        return self.offset + length
+
+    def section_offset(self):
+        return self.uint(self.offset_size)
+
+
+class DwarfInfo:
+    """Functions and lines of the compilation units in ``.debug_info``.
+
+    Units are parsed lazily: ``.debug_aranges``, or the ranges of the unit
+    DIE for units it leaves out, tell which unit covers an address, and the
+    DIEs and line program of a unit are only read once an address falls in
+    it.  The DIEs are scanned linearly; only compilation units, subprograms
+    and inlined subroutines are decoded.
+    """
+
+    # DW_FORM_* values
+    FORM_ADDR = 0x01
+    FORM_STRING = 0x08
+    FORM_STRP = 0x0e
+    FORM_SDATA = 0x0d
+    FORM_REF_ADDR = 0x10
+    FORM_INDIRECT = 0x16
+    FORM_SEC_OFFSET = 0x17
+    FORM_LINE_STRP = 0x1f
+    FORM_IMPLICIT_CONST = 0x21
+    FORM_RNGLISTX = 0x23
+    FORM_SIZES = {
+        0x0b: 1, 0x05: 2, 0x06: 4, 0x07: 8, 0x1e: 16, 0x0c: 1, 0x19: 0,
+        0x11: 1, 0x12: 2, 0x13: 4, 0x14: 8, 0x20: 8, 0x1c: 4, 0x24: 8,
+        0x25: 1, 0x26: 2, 0x27: 3, 0x28: 4, 0x29: 1, 0x2a: 2, 0x2b: 3,
+        0x2c: 4, 0x21: 0,
+    }
+    FORM_ULEB = {0x0f, 0x15, 0x1a, 0x1b, 0x22, 0x23, 0x1f01, 0x1f02}
+    FORM_OFFSET = {0x0e, 0x17, 0x1d, 0x1f, 0x1f20, 0x1f21}
+    FORM_BLOCKS = {0x0a: 1, 0x03: 2, 0x04: 4}
+    FORM_ULEB_BLOCKS = {0x09, 0x18}
+    FORM_STRX = {0x1a, 0x25, 0x26, 0x27, 0x28, 0x1f02}
+    FORM_ADDRX = {0x1b, 0x29, 0x2a, 0x2b, 0x2c, 0x1f01}
+    FORM_UNIT_REF = {0x11, 0x12, 0x13, 0x14, 0x15}
+    FORM_CONSTANT = {0x0b, 0x05, 0x06, 0x07, 0x0f, 0x0d, 0x21}
+
+    # DW_TAG_* values
+    TAG_UNITS = {0x11, 0x3c, 0x4a}
+    TAG_FUNCTIONS = {0x2e, 0x1d}
+    # array, class, enumeration, structure, subroutine and union types
+    TAG_TYPES = {0x01, 0x02, 0x04, 0x13, 0x15, 0x17}
+
+    # DW_AT_* values
+    AT_SIBLING = 0x01
+    AT_NAME = 0x03
+    AT_STMT_LIST = 0x10
+    AT_LOW_PC = 0x11
+    AT_HIGH_PC = 0x12
+    AT_COMP_DIR = 0x1b
+    AT_ABSTRACT_ORIGIN = 0x31
+    AT_SPECIFICATION = 0x47
+    AT_RANGES = 0x55
+    AT_LINKAGE_NAME = 0x6e
+    AT_STR_OFFSETS_BASE = 0x72
+    AT_ADDR_BASE = 0x73
+    AT_RNGLISTS_BASE = 0x74
+    AT_MIPS_LINKAGE_NAME = 0x2007
+    UNIT_ATTRIBUTES = {
+        AT_STMT_LIST, AT_LOW_PC, AT_HIGH_PC, AT_RANGES, AT_COMP_DIR,
+        AT_STR_OFFSETS_BASE, AT_ADDR_BASE, AT_RNGLISTS_BASE,
+    }
+    FUNCTION_ATTRIBUTES = {
+        AT_NAME, AT_LOW_PC, AT_HIGH_PC, AT_ABSTRACT_ORIGIN, AT_SPECIFICATION,
+        AT_RANGES, AT_LINKAGE_NAME, AT_MIPS_LINKAGE_NAME,
+    }
+
+    class Unit:
+        def __init__(self, offset, version, address_size, offset_size):
+            self.offset = offset
+            self.version = version
+            self.address_size = address_size
+            self.offset_size = offset_size
+            self.base_address = 0
+            self.addr_base = 8 if version >= 5 else 0
+            self.str_offsets_base = 8 if version >= 5 else 0
+            self.rnglists_base = None
+            # set from the unit DIE by DwarfInfo._read_unit
+            self.end = None
+            self.abbrevs = None
+            self.dies = None
+            self.stmt_list = None
+            self.comp_dir = None
+            self.ranges = []
+            # (low, high, DIE offset) of the functions, once scanned
+            self.functions = None
+            self.function_table = None
+
+    def __init__(self, elf):
+        self.elf = elf
+        self.endian = elf.endian
+        self.debug_str = elf.section_data('.debug_str') or b''
+        self.debug_line_str = elf.section_data('.debug_line_str') or b''
+        self.debug_str_offsets = elf.section_data('.debug_str_offsets') or b''
+        self.debug_addr = elf.section_data('.debug_addr') or b''
+        self.debug_ranges = elf.section_data('.debug_ranges') or b''
+        self.debug_rnglists = elf.section_data('.debug_rnglists') or b''
+        self.debug_line = elf.section_data('.debug_line') or b''
+        self.abbrevs = {}
+
+        # unit offset -> Unit, or None for type units and others not read
+        self.units = {}
+        # DIE offset -> (name, is_linkage, referenced DIE offset), or None
+        # for DIEs that are not functions
+        self.names = {}
+        # .debug_line offset -> DwarfLineTable
+        self.line_tables = {}
+
+        self.info = elf.section_data('.debug_info') or b''
+        self.debug_abbrev = elf.section_data('.debug_abbrev')
+        self.unit_offsets = []
+        if self.debug_abbrev:
+            offset = 0
+            while offset < len(self.info):
+                self.unit_offsets.append(offset)
+                offset = DwarfReader(
+                    self.info, offset, self.endian
+                ).unit_length()
+
+        # (low, high, unit offset), sorted, and the units without ranges,
+        # which are searched last like addr2line does
+        ranges = self._read_aranges()
+        self.rangeless = []
+        for offset in self.unit_offsets:
+            if offset in ranges:
+                continue
+            unit = self._unit(offset)
+            if unit is None:
+                continue
+            if unit.ranges:
+                ranges[offset] = unit.ranges
+            else:
+                self.rangeless.append(offset)
+        self.ranges = sorted(
+            (low, high, offset)
+            for offset, unit_ranges in ranges.items()
+            for low, high in unit_ranges
+        )
+        self.range_starts = [low for low, _, _ in self.ranges]
+
+    def lookup(self, address):
+        """Return ``(function, location)`` for address.
+
+        function is ``(name, is_linkage)`` and location ``(filename, line,
+        discriminator)``, or None when unknown.  They come from the first
+        unit covering address that knows either.
+        """
+        for unit in self._units_at(address):
+            if unit.functions is None:
+                self._scan_unit(unit)
+            if unit.function_table is None:
+                unit.function_table = FunctionTable(self._functions(unit))
+            function = unit.function_table.lookup(address)
+            location = None
+            if unit.stmt_list is not None:
+                location = self._line_table(unit).lookup(address)
+            if function is not None or location is not None:
+                return function, location
+        return None, None
+
+    def _units_at(self, address):
+        # past the end of a range, the line program of its unit may still
+        # cover address, as in the padding after a function
+        index = bisect.bisect_right(self.range_starts, address) - 1
+        offsets = self.rangeless
+        if index >= 0:
+            offsets = [self.ranges[index][2]] + offsets
+        for offset in offsets:
+            unit = self._unit(offset)
+            if unit is not None:
+                yield unit
+
+    def _read_aranges(self):
+        """Return ``{unit offset: [(low, high), ...]}`` from
+        ``.debug_aranges``."""
+        data = self.elf.section_data('.debug_aranges') or b''
+        ranges = {}
+        offset = 0
+        while offset + 4 <= len(data):
+            reader = DwarfReader(data, offset, self.endian)
+            end = reader.unit_length()
+            reader.u16()  # version
+            unit = reader.section_offset()
+            size = reader.u8()
+            reader.u8()  # segment selector size
+            if not size:
+                break
+            # tuples are aligned to their size from the start of the set
+            reader.offset += -(reader.offset - offset) % (2 * size)
+            unit_ranges = ranges.setdefault(unit, [])
+            while reader.offset + 2 * size <= end:
+                low = reader.uint(size)
+                length = reader.uint(size)
+                if low == 0 and length == 0:
+                    break
+                if length:
+                    unit_ranges.append((low, low + length))
+            offset = end
+        return ranges
+
+    def _line_table(self, unit):
+        table = self.line_tables.get(unit.stmt_list)
+        if table is None:
+            table = self.line_tables[unit.stmt_list] = DwarfLineTable(
+                self, unit.stmt_list, unit.comp_dir
+            )
+        return table
+
+    def _functions(self, unit):
+        """Return ``(low, high, name, is_linkage)`` for the functions of a
+        scanned unit."""
+        functions = []
+        for low, high, offset in unit.functions:
+            name, is_linkage = self._function_name(offset)
+            if name is not None:
+                functions.append((low, high, name, is_linkage))
+        return functions
+
+    def _function_name(self, offset):
+        name = None
+        for _ in range(8):
+            if offset not in self.names:
+                self._read_function(offset)
+            entry = self.names[offset]
+            if entry is None:
+                break
+            own_name, is_linkage, offset = entry
+            if is_linkage:
+                return own_name, True
+            if name is None:
+                name = own_name
+            if offset is None:
+                break
+        return name, False
+
+    def _abbrev_table(self, offset):
+        try:
+            return self.abbrevs[offset]
+        except KeyError:
+            pass
+        reader = DwarfReader(self.debug_abbrev, offset, self.endian)
+        table = self.abbrevs[offset] = {}
+        while reader.offset < len(self.debug_abbrev):
+            code = reader.uleb()
+            if code == 0:
+                break
+            tag = reader.uleb()
+            reader.u8()  # children
+            attributes = []
+            fixed_size = 0
+            while True:
+                name = reader.uleb()
+                form = reader.uleb()
+                if name == 0 and form == 0:
+                    break
+                implicit = None
+                if form == self.FORM_IMPLICIT_CONST:
+                    implicit = reader.sleb()
+                attributes.append((name, form, implicit))
+                if fixed_size is not None and form in self.FORM_SIZES:
+                    fixed_size += self.FORM_SIZES[form]
+                else:
+                    fixed_size = None
+            if tag in self.TAG_UNITS:
+                wanted = self.UNIT_ATTRIBUTES
+            elif tag in self.TAG_FUNCTIONS:
+                wanted = self.FUNCTION_ATTRIBUTES
+            elif tag in self.TAG_TYPES and any(
+                    name == self.AT_SIBLING for name, _, _ in attributes
+            ):
+                wanted = {self.AT_SIBLING}
+            else:
+                wanted = None
+            table[code] = (tag, attributes, wanted, fixed_size)
+        return table
+
+    def _unit(self, offset):
+        """Return the unit at offset, with its header and unit DIE read."""
+        try:
+            return self.units[offset]
+        except KeyError:
+            unit = self.units[offset] = self._read_unit(offset)
+            return unit
+
+    def _read_unit(self, offset):
+        reader = DwarfReader(self.info, offset, self.endian)
+        end = reader.unit_length()
+        version = reader.u16()
+        if version >= 5:
+            unit_type = reader.u8()
+            address_size = reader.u8()
+            abbrev_offset = reader.section_offset()
+            if unit_type in (4, 5):
+                # skeleton and split units carry a dwo_id
+                reader.offset += 8
+            elif unit_type != 1 and unit_type != 3:
+                return None
+        else:
+            abbrev_offset = reader.section_offset()
+            address_size = reader.u8()
+        unit = self.Unit(offset, version, address_size, reader.offset_size)
+        unit.end = end
+        unit.abbrevs = self._abbrev_table(abbrev_offset)
+        unit.dies = reader.offset
+        if reader.offset < end:
+            code = reader.uleb()
+            if code == 0:
+                return None
+            tag, attributes, wanted, _ = unit.abbrevs[code]
+            if tag not in self.TAG_UNITS:
+                return None
+            self._unit_die(
+                unit, self._values(reader, attributes, wanted, unit)
+            )
+            unit.dies = reader.offset
+        return unit
+
+    def _read_function(self, offset):
+        """Read the names of the function DIE at offset into names, such as
+        a declaration in a type skipped by _scan_unit."""
+        self.names[offset] = None
+        index = bisect.bisect_right(self.unit_offsets, offset) - 1
+        if index < 0:
+            return
+        unit = self._unit(self.unit_offsets[index])
+        if unit is None or not unit.dies <= offset < unit.end:
+            return
+        reader = DwarfReader(self.info, offset, self.endian)
+        reader.offset_size = unit.offset_size
+        abbrev = unit.abbrevs.get(reader.uleb())
+        if abbrev is not None and abbrev[0] in self.TAG_FUNCTIONS:
+            self.names[offset] = self._function_entry(
+                unit, self._values(reader, abbrev[1], abbrev[2], unit)
+            )
+
+    def _scan_unit(self, unit):
+        """Read the functions below the unit DIE."""
+        unit.functions = []
+        reader = DwarfReader(self.info, unit.dies, self.endian)
+        reader.offset_size = unit.offset_size
+        abbrevs = unit.abbrevs
+        end = unit.end
+        while reader.offset < end:
+            die_offset = reader.offset
+            code = reader.uleb()
+            if code == 0:
+                continue
+            tag, attributes, wanted, fixed_size = abbrevs[code]
+            if wanted is None:
+                if fixed_size is not None:
+                    reader.offset += fixed_size
+                else:
+                    for _, form, _ in attributes:
+                        self._skip_form(reader, form, unit)
+                continue
+
+            values = self._values(reader, attributes, wanted, unit)
+            if tag in self.TAG_FUNCTIONS:
+                self._function_die(unit, die_offset, values)
+            else:
+                # the members of types hold no code
+                form, sibling = values[self.AT_SIBLING]
+                if form in self.FORM_UNIT_REF:
+                    sibling += unit.offset
+                if sibling > reader.offset:
+                    reader.offset = sibling
+
+    def _values(self, reader, attributes, wanted, unit):
+        values = {}
+        for name, form, implicit in attributes:
+            if name in wanted:
+                values[name] = self._value(reader, form, implicit, unit)
+            else:
+                self._skip_form(reader, form, unit)
+        return values
+
+    def _unit_die(self, unit, values):
+        if self.AT_ADDR_BASE in values:
+            unit.addr_base = values[self.AT_ADDR_BASE][1]
+        if self.AT_STR_OFFSETS_BASE in values:
+            unit.str_offsets_base = values[self.AT_STR_OFFSETS_BASE][1]
+        if self.AT_RNGLISTS_BASE in values:
+            unit.rnglists_base = values[self.AT_RNGLISTS_BASE][1]
+        if self.AT_LOW_PC in values:
+            unit.base_address = self._address(unit, *values[self.AT_LOW_PC])
+        if self.AT_STMT_LIST in values:
+            unit.stmt_list = values[self.AT_STMT_LIST][1]
+            if self.AT_COMP_DIR in values:
+                unit.comp_dir = self._string(unit, *values[self.AT_COMP_DIR])
+        unit.ranges = self._ranges(unit, values)
+
+    def _function_die(self, unit, die_offset, values):
+        self.names[die_offset] = self._function_entry(unit, values)
+        for low, high in self._ranges(unit, values):
+            unit.functions.append((low, high, die_offset))
+
+    def _function_entry(self, unit, values):
+        """Return ``(name, is_linkage, referenced DIE offset)``."""
+        name = None
+        is_linkage = False
+        for attribute in (self.AT_LINKAGE_NAME, self.AT_MIPS_LINKAGE_NAME):
+            if attribute in values:
+                name = self._string(unit, *values[attribute])
+                is_linkage = name is not None
+                break
+        if name is None and self.AT_NAME in values:
+            name = self._string(unit, *values[self.AT_NAME])
+        reference = None
+        for attribute in (self.AT_ABSTRACT_ORIGIN, self.AT_SPECIFICATION):
+            if attribute in values:
+                form, value = values[attribute]
+                if form in self.FORM_UNIT_REF:
+                    value += unit.offset
+                reference = value
+                break
+        return name, is_linkage, reference
+
+    def _ranges(self, unit, values):
+        """Return the non-empty address ranges of a DIE."""
+        if self.AT_LOW_PC in values and self.AT_HIGH_PC in values:
+            low = self._address(unit, *values[self.AT_LOW_PC])
+            form, high = values[self.AT_HIGH_PC]
+            if form in self.FORM_CONSTANT:
+                high += low
+            else:
+                high = self._address(unit, form, high)
+            ranges = [(low, high)]
+        elif self.AT_RANGES in values:
+            ranges = self._range_list(unit, *values[self.AT_RANGES])
+        else:
+            return []
+        return [(low, high) for low, high in ranges if low < high]
+
+    def _value(self, reader, form, implicit, unit):
+        """Read an attribute value as ``(form, raw value)``."""
+        if form == self.FORM_INDIRECT:
+            form = reader.uleb()
+        if form == self.FORM_IMPLICIT_CONST:
+            return form, implicit
+        if form == self.FORM_STRING:
+            return form, reader.cstring()
+        if form == self.FORM_ADDR:
+            return form, reader.uint(unit.address_size)
+        if form == self.FORM_SDATA:
+            return form, reader.sleb()
+        if form in self.FORM_ULEB:
+            return form, reader.uleb()
+        if form in self.FORM_OFFSET:
+            return form, reader.section_offset()
+        if form == self.FORM_REF_ADDR:
+            if unit.version <= 2:
+                return form, reader.uint(unit.address_size)
+            return form, reader.section_offset()
+        if form in self.FORM_SIZES:
+            return form, reader.uint(self.FORM_SIZES[form])
+        self._skip_form(reader, form, unit)
+        return form, None
+
+    def _skip_form(self, reader, form, unit):
+        if form == self.FORM_INDIRECT:
+            form = reader.uleb()
+        if form in self.FORM_SIZES:
+            reader.offset += self.FORM_SIZES[form]
+        elif form in self.FORM_ULEB:
+            reader.uleb()
+        elif form == self.FORM_SDATA:
+            reader.sleb()
+        elif form in self.FORM_OFFSET:
+            reader.offset += reader.offset_size
+        elif form == self.FORM_ADDR:
+            reader.offset += unit.address_size
+        elif form == self.FORM_REF_ADDR:
+            if unit.version <= 2:
+                reader.offset += unit.address_size
+            else:
+                reader.offset += reader.offset_size
+        elif form == self.FORM_STRING:
+            reader.cstring()
+        elif form in self.FORM_BLOCKS:
+            length = reader.uint(self.FORM_BLOCKS[form])
+            reader.offset += length
+        elif form in self.FORM_ULEB_BLOCKS:
+            length = reader.uleb()
+            reader.offset += length
+        else:
+            raise ValueError(
+                '{}: unknown DWARF form 0x{:x}'.format(self.elf.filename, form)
+            )
+
+    @staticmethod
+    def _cstring_at(table, offset):
+        end = table.find(b'\0', offset)
+        if offset >= len(table) or end < 0:
+            return None
+        return table[offset:end].decode(errors='replace')
+
+    def _string(self, unit, form, value):
+        if value is None:
+            return None
+        if form == self.FORM_STRING:
+            return value
+        if form == self.FORM_STRP:
+            return self._cstring_at(self.debug_str, value)
+        if form == self.FORM_LINE_STRP:
+            return self._cstring_at(self.debug_line_str, value)
+        if form in self.FORM_STRX:
+            reader = DwarfReader(
+                self.debug_str_offsets,
+                unit.str_offsets_base + value * unit.offset_size,
+                self.endian,
+            )
+            if reader.offset + unit.offset_size > len(reader.data):
+                return None
+            return self._cstring_at(
+                self.debug_str, reader.uint(unit.offset_size)
+            )
+        return None
+
+    def _address(self, unit, form, value):
+        if form in self.FORM_ADDRX:
+            reader = DwarfReader(
+                self.debug_addr,
+                unit.addr_base + value * unit.address_size,
+                self.endian,
+            )
+            return reader.uint(unit.address_size)
+        return value
+
+    def _range_list(self, unit, form, value):
+        if unit.version < 5:
+            return self._debug_ranges(unit, value)
+        if form == self.FORM_RNGLISTX:
+            reader = DwarfReader(
+                self.debug_rnglists,
+                unit.rnglists_base + value * unit.offset_size,
+                self.endian,
+            )
+            value = unit.rnglists_base + reader.uint(unit.offset_size)
+        return self._debug_rnglists(unit, value)
+
+    def _debug_ranges(self, unit, offset):
+        reader = DwarfReader(self.debug_ranges, offset, self.endian)
+        base = unit.base_address
+        largest = (1 << (8 * unit.address_size)) - 1
+        ranges = []
+        while reader.offset + 2 * unit.address_size <= len(self.debug_ranges):
+            start = reader.uint(unit.address_size)
+            end = reader.uint(unit.address_size)
+            if start == 0 and end == 0:
+                break
+            if start == largest:
+                base = end
+            else:
+                ranges.append((base + start, base + end))
+        return ranges
+
+    def _debug_rnglists(self, unit, offset):
+        reader = DwarfReader(self.debug_rnglists, offset, self.endian)
+        reader.offset_size = unit.offset_size
+        base = unit.base_address
+        size = unit.address_size
+        ranges = []
+        while reader.offset < len(self.debug_rnglists):
+            kind = reader.u8()
+            if kind == 0:  # DW_RLE_end_of_list
+                break
+            elif kind == 1:  # DW_RLE_base_addressx
+                base = self._address(unit, 0x1b, reader.uleb())
+            elif kind == 2:  # DW_RLE_startx_endx
+                start = self._address(unit, 0x1b, reader.uleb())
+                end = self._address(unit, 0x1b, reader.uleb())
+                ranges.append((start, end))
+            elif kind == 3:  # DW_RLE_startx_length
+                start = self._address(unit, 0x1b, reader.uleb())
+                ranges.append((start, start + reader.uleb()))
+            elif kind == 4:  # DW_RLE_offset_pair
+                start = reader.uleb()
+                ranges.append((base + start, base + reader.uleb()))
+            elif kind == 5:  # DW_RLE_base_address
+                base = reader.uint(size)
+            elif kind == 6:  # DW_RLE_start_end
+                start = reader.uint(size)
+                ranges.append((start, reader.uint(size)))
+            elif kind == 7:  # DW_RLE_start_length
+                start = reader.uint(size)
+                ranges.append((start, start + reader.uleb()))
+            else:
+                break
+        return ranges
+
+
+class FunctionTable:
+    """Innermost function lookups over possibly nested address ranges.
+
+    The ranges are flattened into disjoint segments, each labelled with
+    the smallest range covering it; among equal ranges the later one, i.e.
+    the deeper inlined function, wins.
+    """
+
+    def __init__(self, functions):
+        starts = collections.defaultdict(list)
+        for order, (low, high, name, is_linkage) in enumerate(functions):
+            starts[low].append((high - low, -order, high, name, is_linkage))
+        points = sorted(
+            set(starts).union(high for _, high, _, _ in functions)
+        )
+
+        self.starts = []
+        self.values = []
+        active = []
+        for point in points:
+            for item in starts.get(point, ()):
+                heapq.heappush(active, item)
+            while active and active[0][2] <= point:
+                heapq.heappop(active)
+            value = (active[0][3], active[0][4]) if active else None
+            if not self.values or self.values[-1] != value:
+                self.starts.append(point)
+                self.values.append(value)
+
+    def lookup(self, address):
+        """Return ``(name, is_linkage)`` or None."""
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0:
+            return None
+        return self.values[index]
+
+
+class DwarfLineTable:
+    """Address to source line lookups from a ``.debug_line`` program.
+
+    The rows of the program at offset are sorted by address;
+    end-of-sequence rows are kept as gaps.
+    """
+
+    LNCT_PATH = 1
+    LNCT_DIRECTORY_INDEX = 2
+
+    def __init__(self, info, offset, comp_dir):
+        self.info = info
+        self.rows = []
+        if offset < len(info.debug_line):
+            self._parse_program(info.debug_line, offset, comp_dir)
+
+        # end-of-sequence gaps sort before rows at the same address
+        self.rows.sort(key=lambda row: (row[0], row[1] is not None))
+        self.addresses = [row[0] for row in self.rows]
+
+    def lookup(self, address):
+        """Return ``(filename, line, discriminator)`` or None."""
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0:
+            return None
+        _, filename, line, discriminator = self.rows[index]
+        if filename is None:
+            return None
+        return filename, line, discriminator
+
+    def _entry_formats(self, reader):
+        count = reader.u8()
+        return [(reader.uleb(), reader.uleb()) for _ in range(count)]
+
+    def _entries(self, reader, formats, unit):
+        entries = []
+        for _ in range(reader.uleb()):
+            path = None
+            directory = 0
+            for content, form in formats:
+                if content == self.LNCT_PATH:
+                    path = self.info._string(
+                        unit, *self.info._value(reader, form, None, unit)
+                    )
+                elif content == self.LNCT_DIRECTORY_INDEX:
+                    directory = self.info._value(reader, form, None, unit)[1]
+                else:
+                    self.info._skip_form(reader, form, unit)
+            entries.append((path, directory))
+        return entries
+
+    @staticmethod
+    def _join(*parts):
+        path = ''
+        for part in parts:
+            if part:
+                path = os.path.join(path, part)
+        return path
+
+    def _filenames(self, version, comp_dir, directories, files):
+        """Resolve file entries to full paths the way addr2line does."""
+        filenames = []
+        for path, directory in files:
+            if path is None:
+                filenames.append('??')
+                continue
+            if os.path.isabs(path):
+                filenames.append(path)
+                continue
+            if version >= 5:
+                directory = directories[directory] \
+                    if directory < len(directories) else None
+            elif 0 < directory <= len(directories):
+                directory = directories[directory - 1]
+            else:
+                directory = None
+            if directory and os.path.isabs(directory):
+                filenames.append(self._join(directory, path))
+            else:
+                filenames.append(self._join(comp_dir, directory, path))
+        return filenames
+
+    def _parse_program(self, data, offset, comp_dir):
+        elf = self.info.elf
+        reader = DwarfReader(data, offset, elf.endian)
+        end = reader.unit_length()
+        version = reader.u16()
+        address_size = 4 if elf.elfclass == 32 else 8
+        if version >= 5:
+            address_size = reader.u8()
+            reader.u8()  # segment selector size
+        program = reader.section_offset()
+        program += reader.offset
+        min_inst_length = reader.u8()
+        if version >= 4:
+            reader.u8()  # maximum operations per instruction
+        reader.u8()  # default_is_stmt
+        line_base = reader.unpack('b')[0]
+        line_range = reader.u8()
+        opcode_base = reader.u8()
+        opcode_lengths = [0] + [reader.u8() for _ in range(opcode_base - 1)]
+
+        if version >= 5:
+            unit = DwarfInfo.Unit(
+                offset, version, address_size, reader.offset_size
+            )
+            formats = self._entry_formats(reader)
+            directories = [
+                path for path, _ in self._entries(reader, formats, unit)
+            ]
+            formats = self._entry_formats(reader)
+            files = self._entries(reader, formats, unit)
+        else:
+            directories = []
+            while True:
+                path = reader.cstring()
+                if not path:
+                    break
+                directories.append(path)
+            files = []
+            while True:
+                path = reader.cstring()
+                if not path:
+                    break
+                directory = reader.uleb()
+                reader.uleb()  # modification time
+                reader.uleb()  # length
+                files.append((path, directory))
+        filenames = self._filenames(version, comp_dir, directories, files)
+
+        # DWARF < 5 numbers files from 1
+        file_base = 0 if version >= 5 else 1
+        rows = self.rows
+        append = rows.append
+        const_add_pc = (255 - opcode_base) // line_range * min_inst_length
+        # address and line advances of the special opcodes
+        special = [None] * opcode_base + [
+            (
+                (opcode - opcode_base) // line_range * min_inst_length,
+                line_base + (opcode - opcode_base) % line_range,
+            )
+            for opcode in range(opcode_base, 256)
+        ]
+
+        def filename(file):
+            file -= file_base
+            if 0 <= file < len(filenames):
+                return filenames[file]
+            return '??'
+
+        offset = program
+        sequence = len(rows)
+        address = 0
+        file = 1
+        name = filename(file)
+        line = 1
+        discriminator = 0
+        while offset < end:
+            opcode = data[offset]
+            offset += 1
+            if opcode >= opcode_base:
+                address_advance, line_advance = special[opcode]
+                address += address_advance
+                line += line_advance
+                append((address, name, line, discriminator))
+                discriminator = 0
+                continue
+
+            reader.offset = offset
+            if opcode == 0:
+                length = reader.uleb()
+                next_offset = reader.offset + length
+                if length:
+                    extended = reader.u8()
+                    if extended == 1:  # DW_LNE_end_sequence
+                        # rows at the end address cover no code
+                        while (len(rows) > sequence and
+                               rows[-1][0] == address):
+                            rows.pop()
+                        append((address, None, 0, 0))
+                        sequence = len(rows)
+                        address = 0
+                        file = 1
+                        name = filename(file)
+                        line = 1
+                        discriminator = 0
+                    elif extended == 2:  # DW_LNE_set_address
+                        address = reader.uint(length - 1)
+                    elif extended == 3:  # DW_LNE_define_file
+                        path = reader.cstring()
+                        directory = reader.uleb()
+                        filenames.extend(
+                            self._filenames(
+                                version, comp_dir, directories,
+                                [(path, directory)]
+                            )
+                        )
+                        name = filename(file)
+                    elif extended == 4:  # DW_LNE_set_discriminator
+                        discriminator = reader.uleb()
+                reader.offset = next_offset
+            elif opcode == 1:  # DW_LNS_copy
+                append((address, name, line, discriminator))
+                discriminator = 0
+            elif opcode == 2:  # DW_LNS_advance_pc
+                address += reader.uleb() * min_inst_length
+            elif opcode == 3:  # DW_LNS_advance_line
+                line += reader.sleb()
+            elif opcode == 4:  # DW_LNS_set_file
+                file = reader.uleb()
+                name = filename(file)
+            elif opcode == 8:  # DW_LNS_const_add_pc
+                address += const_add_pc
+            elif opcode == 9:  # DW_LNS_fixed_advance_pc
+                address += reader.u16()
+            else:
+                for _ in range(opcode_lengths[opcode]):
+                    reader.uleb()
+            offset = reader.offset
+        return end
+
+
+class ElfSymbolizer(Symbolizer):
+    """In-process replacement for Addr2line.
+
+    Symbol tables are read once per object and DWARF units as addresses
+    fall in them; functions come from the DWARF DIEs and the symbol table,
+    and locations from the DWARF line programs, with the same precedence
+    rules as addr2line.
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def load(self, filename):
+        return self._load_tables(filename, self._read_tables)
+
+    def _read_tables(self, filename):
+        elf = ElfFile(filename)
+        return SymbolTable(elf.symbols()), DwarfInfo(elf)
+
+    def find_symbol_and_line(self, filename, addresses):
+        symbols, info = self.load(filename)
+        results = []
+        for address in sorted(addresses):
+            index = symbols.lookup(address)
+            function, found = info.lookup(address)
+            if function is not None and (function[1] or index < 0):
+                symbol = function[0]
+            elif index >= 0:
+                symbol = symbols.names[index]
+            else:
+                symbol = '??'
+            if found is not None:
+                path, line, discriminator = found
+                location = '{}:{}'.format(path, line or '?')
+                if discriminator:
+                    location += ' (discriminator {})'.format(discriminator)
+            elif index < 0:
+                location = '??:0'
+            else:
+                file = symbols.files[index]
+                location = '{}:?'.format('??' if file is None else file)
+            results.append((address, symbol, location))
+        return results
+
+
+class FunctionSymbolizer(Symbolizer):
+    """Resolve addresses to their containing function only.
+
+    Only the ELF symbol table is read.  Locations are what addr2line
+    reports for an object without line information.
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def load(self, filename):
+        return self._load_tables(
+            filename,
+            lambda filename: SymbolTable(ElfFile(filename).symbols()),
+        )
+
+    def find_symbol_and_line(self, filename, addresses):
+        symbols = self.load(filename)
+        results = []
+        for address in sorted(addresses):
+            index = symbols.lookup(address)
+            if index < 0:
+                results.append((address, '??', '??:0'))
+                continue
+            file = symbols.files[index]
+            results.append((
+                address,
+                symbols.names[index],
+                '{}:?'.format('??' if file is None else file),
+            ))
+        return results
+
+
+def object_id(filename):
+    """Identify an object by its GNU build-id, or by a hash of its content."""
+    try:
+        build_id = ElfFile(filename).build_id()
+    except ValueError:
+        build_id = None
+    if build_id is not None:
+        return 'build-id:' + build_id
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(functools.partial(file.read, 1 << 20), b''):
+            digest.update(block)
+    return 'sha1:' + digest.hexdigest()
+
+
+class SymbolCache:
+    """Persistent cache of symbolization results.
+
+    Results are keyed by object identity (see object_id) and file offset
+    and stored in an SQLite database, which serializes concurrent
+    afgprof invocations.  The least recently used entries are evicted
+    when the cache holds more than max_entries results.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS symbols (
+            object TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            location TEXT NOT NULL,
+            used REAL NOT NULL,
+            UNIQUE (object, offset)
+        );
+        CREATE INDEX IF NOT EXISTS symbols_used ON symbols (used);
+        CREATE TABLE IF NOT EXISTS demangled (
+            mangled TEXT PRIMARY KEY,
+            demangled TEXT NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS demangled_used ON demangled (used);
+    '''
+
+    # bound on the number of host parameters in one statement
+    batch = 500
+
+    def __init__(self, directory, max_entries):
+        directory = pathlib.Path(directory).expanduser()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(
+            str(directory / 'symbols.sqlite3'), timeout=60
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.executescript(self.schema)
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, object_, offsets):
+        """Return ``{offset: (symbol, location)}`` for the cached offsets."""
+        offsets = list(offsets)
+        found = {}
+        now = time.time()
+        with self.connection:
+            for i in range(0, len(offsets), self.batch):
+                chunk = offsets[i:i + self.batch]
+                marks = ','.join('?' * len(chunk))
+                rows = self.connection.execute(
+                    'SELECT offset, symbol, location FROM symbols '
+                    'WHERE object = ? AND offset IN ({})'.format(marks),
+                    [object_] + chunk,
+                ).fetchall()
+                for offset, symbol, location in rows:
+                    found[offset] = (symbol, location)
+                self.connection.execute(
+                    'UPDATE symbols SET used = ? '
+                    'WHERE object = ? AND offset IN ({})'.format(marks),
+                    [now, object_] + chunk,
+                )
+        self.hits += len(found)
+        self.misses += len(offsets) - len(found)
+        return found
+
+    def store(self, object_, results):
+        """Store ``(offset, symbol, location)`` results and evict."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO symbols '
+                '(object, offset, symbol, location, used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (
+                    (object_, offset, symbol, location, now)
+                    for offset, symbol, location in results
+                ),
+            )
+            self._evict('symbols')
+
+    def lookup_demangled(self, names):
+        """Return ``{mangled: demangled}`` for the cached names."""
+        names = list(names)
+        found = {}
+        now = time.time()
+        with self.connection:
+            for i in range(0, len(names), self.batch):
+                chunk = names[i:i + self.batch]
+                marks = ','.join('?' * len(chunk))
+                found.update(self.connection.execute(
+                    'SELECT mangled, demangled FROM demangled '
+                    'WHERE mangled IN ({})'.format(marks),
+                    chunk,
+                ))
+                self.connection.execute(
+                    'UPDATE demangled SET used = ? '
+                    'WHERE mangled IN ({})'.format(marks),
+                    [now] + chunk,
+                )
+        return found
+
+    def store_demangled(self, names):
+        """Store ``{mangled: demangled}`` and evict."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO demangled (mangled, demangled, used) '
+                'VALUES (?, ?, ?)',
+                (
+                    (mangled, demangled, now)
+                    for mangled, demangled in names.items()
+                ),
+            )
+            self._evict('demangled')
+
+    def _evict(self, table):
+        count, = self.connection.execute(
+            'SELECT COUNT(*) FROM {}'.format(table)
+        ).fetchone()
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM {0} WHERE rowid IN ('
+                'SELECT rowid FROM {0} ORDER BY used LIMIT ?)'.format(table),
+                (count - self.max_entries, ),
+            )
+
+
+class Demangler:
+    """Demangle C++ symbol names with c++filt.
+
+    Each batch of names goes through a single c++filt process, and every
+    distinct name is demangled only once: results are memoized, and also
+    kept in the SymbolCache if one is given.  Only names with the Itanium
+    C++ ABI prefix _Z are sent.
+    """
+
+    def __init__(self, command, cache=None):
+        if shutil.which(command) is None:
+            raise Exception(
+                '{} not found in PATH'.format(shlex.quote(command))
+            )
+        self.command = command
+        self.cache = cache
+        self.names = {}
+
+    def demangle(self, names):
+        """Return ``{name: demangled name}`` for the names."""
+        names = set(names)
+        wanted = [
+            name for name in names
+            if name.startswith('_Z') and name not in self.names
+        ]
+        if wanted and self.cache is not None:
+            self.names.update(self.cache.lookup_demangled(wanted))
+            wanted = [name for name in wanted if name not in self.names]
+        if wanted:
+            output = subprocess.run(
+                [self.command],
+                input='\n'.join(wanted) + '\n',
+                stdout=subprocess.PIPE,
+                check=True,
+                universal_newlines=True,
+            ).stdout.split('\n')
+            if len(output) != len(wanted) + 1:
+                raise Exception(
+                    '{} returned {} names for {}'.format(
+                        self.command, len(output) - 1, len(wanted)
+                    )
+                )
+            demangled = dict(zip(wanted, output))
+            self.names.update(demangled)
+            if self.cache is not None:
+                self.cache.store_demangled(demangled)
+        return {name: self.names.get(name, name) for name in names}
+
+
+def demangle_index(index, demangler):
+    """Demangle the symbols of a symbolized index in place."""
+    names = demangler.demangle(
+        info['symbol'] for info in index.values() if 'symbol' in info
+    )
+    for info in index.values():
+        if 'symbol' in info:
+            info['symbol'] = names[info['symbol']]
+
+
 class Region(
         collections.namedtuple(
             'Region',
@@ -214,6 +1831,27 @@ class Region(
 
     @classmethod
     def fromline(cls, line):
+        # fast path for well-formed lines; produces the same fields as the
+        # pattern, which is still used to reject everything else
+        try:
+            addresses, perms, offset, dev, inode, pathname = \
+                line.split(' ', 5)
+            addr0, addr1 = addresses.split('-')
+            if len(dev) == 5 and dev[2] == ':' and inode.isdigit():
+                return cls(
+                    address=(hexint(addr0), hexint(addr1)),
+                    perms=perms,
+                    offset=hexint(offset),
+                    dev=dev[1],
+                    inode=(hexint(dev[4]), hexint(inode)),
+                    pathname=pathname.lstrip(' ').split('\n', 1)[0],
+                )
+        except ValueError:
+            pass
+        return cls._fromline(line)
+
+    @classmethod
+    def _fromline(cls, line):
         match = cls.pattern.match(line)
         if match is None:
             raise ValueError('bad value for region pattern: {!r}'.format(line))
@@ -232,6 +1870,7 @@ class Region(
 class Map:
     def __init__(self, region_iter):
         self.regions = sorted(region_iter)
+        self.starts = [region.address[0] for region in self.regions]
 
     @classmethod
     def fromfile(cls, file, executable_only=False):
@@ -241,7 +1880,7 @@ class Map:
         return cls(regions)
 
     def resolve(self, address):
-        index = bisect.bisect_right(self.regions, ((address, ), )) - 1
+        index = bisect.bisect_right(self.starts, address) - 1
         if index < 0:
             return None
         region = self.regions[index]
@@ -257,18 +1896,924 @@ class Map:
             resolved.pathname, address - resolved.address[0] + resolved.offset
         )
 
+    def translate_many(self, addresses, use_numpy=False):
+        """Translate sorted addresses in one pass.
 
-def get_parser():
-    parser = argparse.ArgumentParser(
-        allow_abbrev=False,
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
-    parser.add_argument('directory', help='directory to find calls and maps')
-    parser.add_argument(
-        '--addr2line',
-        metavar='COMMAND',
-        help='addr2line command',
-        default='arm-linux-androideabi-addr2line'
+        Return a list of (pathname, offset) pairs in the same order, like
+        translate.
+        """
+        if use_numpy:
+            return self._translate_many_numpy(addresses)
+        results = []
+        regions = self.regions
+        starts = self.starts
+        index = -1
+        region = None
+        for address in addresses:
+            while index + 1 < len(starts) and starts[index + 1] <= address:
+                index += 1
+                region = regions[index]
+            if region is None or region.address[1] <= address:
+                results.append((None, address))
+            else:
+                results.append((
+                    region.pathname,
+                    address - region.address[0] + region.offset
+                ))
+        return results
+
+    def _translate_many_numpy(self, addresses):
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        if not self.regions:
+            return [(None, int(address)) for address in addresses]
+        starts = numpy.array(self.starts, dtype=numpy.uint64)
+        ends = numpy.array(
+            [region.address[1] for region in self.regions], dtype=numpy.uint64
+        )
+        bases = numpy.array(
+            [region.offset for region in self.regions], dtype=numpy.uint64
+        )
+        indices = numpy.searchsorted(starts, addresses, side='right') - 1
+        clipped = numpy.maximum(indices, 0)
+        found = (indices >= 0) & (addresses < ends[clipped])
+        offsets = numpy.where(
+            found, addresses - starts[clipped] + bases[clipped], addresses
+        )
+        pathnames = [region.pathname for region in self.regions]
+        return [
+            (pathnames[index] if ok else None, offset)
+            for index, ok, offset in zip(
+                clipped.tolist(), found.tolist(), offsets.tolist()
+            )
+        ]
+
+
+CALL_RECORD = struct.Struct('<IIQ')
+
+if numpy is not None:
+    CALL_DTYPE = numpy.dtype([('lr', '<u4'), ('pc', '<u4'), ('count', '<u8')])
+
+
+def read_calls(calls_file):
+    """Read and aggregate the calls file.
+
+    Returns the arcs as ``((lr, pc), count)`` pairs, most called first, and
+    the addresses in the order they first appear in the file.
+    """
+    index = {}
+    call_count = collections.Counter()
+
+    with calls_file.open(mode='rb') as file:
+        data = file.read()
+    length = len(data) // CALL_RECORD.size
+    for lr, pc, count in ProgressBar(
+            CALL_RECORD.iter_unpack(data),
+            length,
+            prefix='READ {}: '.format(calls_file)
+    ):
+        call_count[lr, pc] += count
+        index[lr] = None
+        index[pc] = None
+
+    return call_count.most_common(), list(index)
+
+
+def aggregate_records(records):
+    """Sum duplicate arcs of a structured record array.
+
+    Returns the unique ``lr << 32 | pc`` keys in ascending order, their
+    summed counts and the position of the first record of each arc.
+    """
+    keys = records['lr'].astype(numpy.uint64) << numpy.uint64(32)
+    keys |= records['pc']
+    order = numpy.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = numpy.flatnonzero(
+        numpy.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+    )
+    counts = numpy.add.reduceat(records['count'][order], starts)
+    return sorted_keys[starts], counts, order[starts]
+
+
+def read_calls_numpy(calls_file):
+    """Vectorized version of read_calls.
+
+    Duplicate arcs are summed with a stable sort and ``reduceat``, so the
+    arcs and addresses come out in exactly the same order as from
+    read_calls.
+    """
+    with calls_file.open(mode='rb') as file:
+        data = file.read()
+    length = len(data) // CALL_RECORD.size
+    records = numpy.frombuffer(data, dtype=CALL_DTYPE, count=length)
+    print(
+        'READ {}: {} records'.format(calls_file, length),
+        file=sys.stderr,
+    )
+    if not length:
+        return [], []
+
+    unique_keys, counts, first = aggregate_records(records)
+
+    # most called first, ties broken by first appearance like Counter
+    rank = numpy.lexsort((first, ~counts))
+    unique_keys = unique_keys[rank]
+    arcs = list(
+        zip(
+            zip(
+                (unique_keys >> numpy.uint64(32)).tolist(),
+                (unique_keys & numpy.uint64(0xffffffff)).tolist(),
+            ),
+            counts[rank].tolist(),
+        )
+    )
+
+    interleaved = numpy.column_stack((records['lr'], records['pc'])).ravel()
+    addresses, first = numpy.unique(interleaved, return_index=True)
+    addresses = addresses[numpy.argsort(first)].tolist()
+
+    return arcs, addresses
+
+
+class ExternalSorter:
+    """Sort tuples of unsigned 64-bit integers with bounded memory.
+
+    Added tuples are kept in memory up to max_entries, then sorted and
+    written to disk as a run; iterating the sorter merges the runs back.
+    """
+
+    # rough size of one in-memory entry: list slot, tuple and three ints
+    entry_size = 120
+    run_record = struct.Struct('<QQQ')
+    run_block = 4096
+    max_runs = 64
+
+    def __init__(self, memory_budget, run_record=None):
+        if run_record is not None:
+            self.run_record = run_record
+        self.max_entries = max(1, memory_budget // self.entry_size)
+        self.entries = []
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.entries = []
+
+    def add(self, *entry):
+        self.entries.append(entry)
+        if len(self.entries) >= self.max_entries:
+            self.entries.sort()
+            self._add_run(self.entries)
+            self.entries = []
+
+    def _add_run(self, entries):
+        self.runs.append(self._write_run(entries))
+        if len(self.runs) >= self.max_runs:
+            # keep the number of open files bounded
+            runs = self.runs
+            self.runs = [self._write_run(self._merge(runs))]
+            for run in runs:
+                run.close()
+
+    def _write_run(self, entries):
+        run = tempfile.TemporaryFile(prefix='afgprof-run-')
+        pack = self.run_record.pack
+        run.writelines(pack(*entry) for entry in entries)
+        run.seek(0)
+        return run
+
+    def _read_run(self, run):
+        size = self.run_record.size * self.run_block
+        while True:
+            data = run.read(size)
+            if not data:
+                return
+            yield from self.run_record.iter_unpack(data)
+
+    def _merge(self, runs):
+        return heapq.merge(*map(self._read_run, runs))
+
+    def __iter__(self):
+        """Yield the entries in ascending order."""
+        self.entries.sort()
+        if not self.runs:
+            yield from self.entries
+            return
+
+        if self.entries:
+            self._add_run(self.entries)
+            self.entries = []
+        yield from self._merge(self.runs)
+
+
+class ArcTable(ExternalSorter):
+    """Out-of-core aggregation of arcs.
+
+    Arcs are keyed by ``lr << 32 | pc`` and map to their count and the
+    position of their first record.  When the in-memory table grows past
+    the memory budget it is written to disk as a sorted run; iterating
+    the table merges the runs back.
+    """
+
+    # rough size of one in-memory entry: dict slot, list and three ints
+    entry_size = 200
+
+    def __init__(self, memory_budget):
+        ExternalSorter.__init__(self, memory_budget)
+        self.table = {}
+
+    def __exit__(self, *exc_info):
+        ExternalSorter.__exit__(self, *exc_info)
+        self.table = {}
+
+    def add(self, key, count, position):
+        entry = self.table.get(key)
+        if entry is None:
+            self.table[key] = [count, position]
+            if len(self.table) >= self.max_entries:
+                self.spill()
+        else:
+            entry[0] += count
+
+    def spill(self):
+        self._add_run(
+            (key, count, position)
+            for key, (count, position) in sorted(self.table.items())
+        )
+        self.table = {}
+
+    def _merge(self, runs):
+        merged = ExternalSorter._merge(self, runs)
+        current = next(merged, None)
+        if current is None:
+            return
+        key, count, position = current
+        for next_key, next_count, next_position in merged:
+            if next_key == key:
+                count += next_count
+                position = min(position, next_position)
+            else:
+                yield key, count, position
+                key, count, position = next_key, next_count, next_position
+        yield key, count, position
+
+    def __iter__(self):
+        """Yield ``(key, count, first)`` in ascending key order."""
+        if not self.runs:
+            for key, (count, position) in sorted(self.table.items()):
+                yield key, count, position
+            return
+
+        if self.table:
+            self.spill()
+        yield from self._merge(self.runs)
+
+
+# largest value of a run record field, to sort counts in decreasing order
+RUN_MAX = (1 << 64) - 1
+
+
+def read_calls_streaming(calls_file, memory_budget, chunk_size, use_numpy):
+    """Memory-mapped, chunked version of read_calls.
+
+    The file is aggregated ``chunk_size`` records at a time into an
+    ArcTable.  If the table had to be spilled to disk, the arcs are then
+    ranked and the addresses ordered with ExternalSorters, each within
+    memory_budget.  Chunks are aggregated with NumPy first if use_numpy is
+    true.  The result is the same as from read_calls, and like it is
+    returned in memory: memory_budget bounds the work on the records, not
+    the unique arcs and addresses returned.
+    """
+    with calls_file.open(mode='rb') as file, \
+            ArcTable(memory_budget) as table:
+        length = os.fstat(file.fileno()).st_size // CALL_RECORD.size
+        if length:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                    memoryview(mm) as view:
+                chunk_bytes = chunk_size * CALL_RECORD.size
+                for start in ProgressBar(
+                        range(0, length * CALL_RECORD.size, chunk_bytes),
+                        prefix='READ {}: '.format(calls_file)
+                ):
+                    stop = min(start + chunk_bytes, length * CALL_RECORD.size)
+                    with view[start:stop] as chunk:
+                        _aggregate_chunk(
+                            table, chunk, start // CALL_RECORD.size, use_numpy
+                        )
+
+        if table.runs:
+            return _rank_external(table, memory_budget)
+        return _rank_in_memory(table)
+
+
+def _rank_in_memory(table):
+    arcs = []
+    first_seen = {}
+    for key, count, position in table:
+        lr = key >> 32
+        pc = key & 0xffffffff
+        arcs.append((-count, position, lr, pc))
+        # lr and pc of record i are at 2i and 2i + 1 in read order
+        seen = 2 * position
+        first_seen[lr] = min(first_seen.get(lr, seen), seen)
+        first_seen[pc] = min(first_seen.get(pc, seen + 1), seen + 1)
+
+    arcs.sort()
+    return (
+        [((lr, pc), -count) for count, _, lr, pc in arcs],
+        sorted(first_seen, key=first_seen.__getitem__),
+    )
+
+
+def _rank_external(table, memory_budget):
+    with ExternalSorter(memory_budget // 2) as ranked, \
+            ExternalSorter(memory_budget // 2, PAIR_RECORD) as seen:
+        for key, count, position in table:
+            # most called first, ties broken by first appearance
+            ranked.add(RUN_MAX - count, position, key)
+            # lr and pc of record i are at 2i and 2i + 1 in read order
+            seen.add(key >> 32, 2 * position)
+            seen.add(key & 0xffffffff, 2 * position + 1)
+
+        arcs = [
+            ((key >> 32, key & 0xffffffff), RUN_MAX - count)
+            for count, _, key in ranked
+        ]
+        with ExternalSorter(memory_budget, PAIR_RECORD) as first_seen:
+            previous = None
+            for address, position in seen:
+                # the first entry of each address is its first appearance
+                if address != previous:
+                    first_seen.add(position, address)
+                    previous = address
+            addresses = [address for _, address in first_seen]
+    return arcs, addresses
+
+
+def _aggregate_chunk(table, chunk, base, use_numpy):
+    if use_numpy:
+        records = numpy.frombuffer(chunk, dtype=CALL_DTYPE)
+        keys, counts, first = aggregate_records(records)
+        for key, count, position in zip(
+                keys.tolist(), counts.tolist(), first.tolist()
+        ):
+            table.add(key, count, base + position)
+    else:
+        for position, (lr, pc, count) in enumerate(
+                CALL_RECORD.iter_unpack(chunk), base
+        ):
+            table.add(lr << 32 | pc, count, position)
+
+
+PAIR_RECORD = struct.Struct('<QQ')
+
+BINARY_MAGIC = b'AFGPROF\0'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sI')
+BINARY_COUNT = struct.Struct('<Q')
+
+
+def _write_column(file, typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    file.write(column)
+
+
+def _read_column(file, typecode, count):
+    column = array.array(typecode)
+    size = column.itemsize * count
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError('truncated binary profile')
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def find_captures(directories):
+    """Return the capture directories, those with a calls file.
+
+    A directory without one is taken as a parent of captures, such as
+    /data/gmon, and searched one level down.  Captures with an empty calls
+    file are skipped.
+    """
+    captures = []
+    for directory in map(pathlib.Path, directories):
+        if (directory / 'calls').exists():
+            found = [directory]
+        else:
+            found = sorted(
+                child for child in directory.iterdir()
+                if (child / 'calls').exists()
+            )
+            if not found:
+                raise Exception('no calls file found in {}'.format(directory))
+        for capture in found:
+            if (capture / 'calls').stat().st_size:
+                captures.append(capture)
+            else:
+                print(
+                    'SKIP {}: empty calls file'.format(capture),
+                    file=sys.stderr,
+                )
+    if not captures:
+        raise Exception('no calls recorded in {}'.format(
+            ', '.join(map(str, directories))
+        ))
+    return captures
+
+
+def read_capture(
+        directory,
+        stream=False,
+        use_numpy=False,
+        memory_budget=1 << 30,
+        chunk_size=1 << 20,
+        stats=None
+):
+    """Read a capture directory and translate its addresses.
+
+    Return the index, ``{address: {'pathname': ..., 'offset': ...}}`` in
+    order of first appearance, and the arcs as ``((lr, pc), count)`` pairs,
+    most called first.  The read and translate stages are measured in
+    stats if given.
+    """
+    if stats is None:
+        stats = Stats()
+
+    calls_file = directory / 'calls'
+    with stats.stage('read'):
+        if stream:
+            arcs, addresses = read_calls_streaming(
+                calls_file, memory_budget, chunk_size, use_numpy
+            )
+        elif use_numpy:
+            arcs, addresses = read_calls_numpy(calls_file)
+        else:
+            arcs, addresses = read_calls(calls_file)
+
+    with stats.stage('translate'):
+        with (directory / 'maps').open() as file:
+            map_ = Map.fromfile(file)
+        index = {address: {} for address in addresses}
+
+        addresses = sorted(index)
+        for address, (pathname, offset) in zip(
+                addresses, map_.translate_many(addresses, use_numpy)
+        ):
+            index[address]['pathname'] = pathname
+            index[address]['offset'] = offset
+    return index, arcs
+
+
+def _init_worker(ignore_interrupts=False):
+    ProgressBar.enabled = False
+    if ignore_interrupts:
+        # leave interrupts to the main process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _read_normalized(directory, **kwargs):
+    index, arcs = read_capture(directory, **kwargs)
+    keys = {
+        address: (info['pathname'], info['offset'])
+        for address, info in index.items()
+    }
+    return [((keys[lr], keys[pc]), count) for (lr, pc), count in arcs]
+
+
+def read_captures(directories, workers=None, **kwargs):
+    """Read captures of several processes in parallel and merge them.
+
+    Addresses are normalized to (pathname, offset) with each process's own
+    maps, so code loaded at different addresses merges correctly.  Return
+    the index and arcs like read_capture, but keyed by ids numbered in
+    order of first appearance instead of addresses.  Workers draw no
+    progress bars; each capture is reported once read instead.
+    """
+    counts = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker
+    ) as executor:
+        for directory, arcs in zip(directories, executor.map(
+                functools.partial(_read_normalized, **kwargs), directories
+        )):
+            print(
+                'READ {}: {} arcs'.format(directory, len(arcs)),
+                file=sys.stderr,
+            )
+            for arc, count in arcs:
+                counts[arc] = counts.get(arc, 0) + count
+
+    ids = {}
+    index = {}
+    for arc in counts:
+        for key in arc:
+            if key not in ids:
+                ids[key] = len(ids)
+                pathname, offset = key
+                index[ids[key]] = {'pathname': pathname, 'offset': offset}
+
+    # stable, so ties stay in order of first appearance like most_common
+    arcs = sorted(
+        (((ids[lr], ids[pc]), count) for (lr, pc), count in counts.items()),
+        key=lambda arc: -arc[1]
+    )
+    return index, arcs
+
+
+def load_captures(directories, workers=None, stats=None, **kwargs):
+    """Find, read and translate captures like the afgprof command does.
+
+    directories are searched with find_captures.  A single capture is read
+    with read_capture, several with read_captures, whose memory budget is
+    shared among the workers.  Return the index and arcs; they can be
+    symbolized with symbolize_hot and passed on to afgprof2dot.CaptureParser
+    without writing them out.  Capture, record, arc and address counts are
+    added to stats if given.
+    """
+    if stats is None:
+        stats = Stats()
+
+    captures = find_captures(directories)
+    if len(captures) == 1:
+        index, arcs = read_capture(captures[0], stats=stats, **kwargs)
+    else:
+        if kwargs.get('stream'):
+            # share the budget among the processes of the pool
+            kwargs['memory_budget'] = kwargs.get(
+                'memory_budget', 1 << 30
+            ) // (workers or os.cpu_count())
+        # translation happens in the pool too
+        with stats.stage('read'):
+            index, arcs = read_captures(captures, workers, **kwargs)
+    stats.counters['captures'] = len(captures)
+    stats.counters['records'] = sum(
+        (capture / 'calls').stat().st_size // CALL_RECORD.size
+        for capture in captures
+    )
+    stats.counters['arcs'] = len(arcs)
+    stats.counters['addresses'] = len(index)
+    return index, arcs
+
+
+def write_binary(file, index, arcs):
+    """Write the profile in the binary format.
+
+    The file holds, after the header, three tables whose row counts
+    precede them:
+
+    * strings: lengths (u32) followed by the UTF-8 bytes of all strings
+    * index: address (u64), offset (u64), and string ids (i32, -1 when
+      absent) of pathname, symbol and location, one column after another
+    * arcs: row numbers in the index of lr and pc (u32), and count (u64)
+
+    All numbers are little-endian.
+    """
+    strings = {}
+
+    def intern(string):
+        if string is None:
+            return -1
+        try:
+            return strings[string]
+        except KeyError:
+            strings[string] = len(strings)
+            return strings[string]
+
+    rows = {address: row for row, address in enumerate(index)}
+    pathnames = [intern(info['pathname']) for info in index.values()]
+    symbols = [intern(info.get('symbol')) for info in index.values()]
+    locations = [intern(info.get('location')) for info in index.values()]
+    encoded = [string.encode() for string in strings]
+
+    file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION))
+    file.write(BINARY_COUNT.pack(len(encoded)))
+    _write_column(file, 'I', map(len, encoded))
+    file.write(b''.join(encoded))
+    file.write(BINARY_COUNT.pack(len(index)))
+    _write_column(file, 'Q', index)
+    _write_column(file, 'Q', (info['offset'] for info in index.values()))
+    _write_column(file, 'i', pathnames)
+    _write_column(file, 'i', symbols)
+    _write_column(file, 'i', locations)
+    file.write(BINARY_COUNT.pack(len(arcs)))
+    _write_column(file, 'I', (rows[lr] for (lr, pc), count in arcs))
+    _write_column(file, 'I', (rows[pc] for (lr, pc), count in arcs))
+    _write_column(file, 'Q', (count for arc, count in arcs))
+
+
+def read_binary(file):
+    """Read a profile written by write_binary.
+
+    Return a dict of the string list and the index and arc columns.
+    """
+    magic, version = BINARY_HEADER.unpack(file.read(BINARY_HEADER.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError('not a binary afgprof profile')
+    if version != BINARY_VERSION:
+        raise ValueError(
+            'unsupported binary profile version {}'.format(version)
+        )
+
+    def count():
+        return BINARY_COUNT.unpack(file.read(BINARY_COUNT.size))[0]
+
+    n = count()
+    lengths = _read_column(file, 'I', n)
+    blob = file.read(sum(lengths))
+    strings = []
+    position = 0
+    for length in lengths:
+        strings.append(blob[position:position + length].decode())
+        position += length
+
+    n = count()
+    profile = {
+        'strings': strings,
+        'address': _read_column(file, 'Q', n),
+        'offset': _read_column(file, 'Q', n),
+        'pathname': _read_column(file, 'i', n),
+        'symbol': _read_column(file, 'i', n),
+        'location': _read_column(file, 'i', n),
+    }
+    n = count()
+    profile['lr'] = _read_column(file, 'I', n)
+    profile['pc'] = _read_column(file, 'I', n)
+    profile['count'] = _read_column(file, 'Q', n)
+    return profile
+
+
+# index fields stored in the string table of write_json(string_table=True)
+STRING_FIELDS = ('pathname', 'symbol', 'location')
+
+
+def read_profile(file):
+    """Read a profile written by afgprof in either output format.
+
+    file is a binary file.  Return the index and arcs as read_capture
+    does, with the symbols and locations the profile holds.
+    """
+    data = file.read()
+    if data.startswith(BINARY_MAGIC):
+        profile = read_binary(io.BytesIO(data))
+        strings = profile['strings']
+        index = {}
+        for address, offset, pathname, symbol, location in zip(
+                profile['address'], profile['offset'], profile['pathname'],
+                profile['symbol'], profile['location']
+        ):
+            info = index[address] = {
+                'pathname': strings[pathname] if pathname >= 0 else None,
+                'offset': offset,
+            }
+            if symbol >= 0:
+                info['symbol'] = strings[symbol]
+            if location >= 0:
+                info['location'] = strings[location]
+        addresses = profile['address']
+        arcs = [
+            ((addresses[lr], addresses[pc]), count) for lr, pc, count in
+            zip(profile['lr'], profile['pc'], profile['count'])
+        ]
+        return index, arcs
+
+    profile = json.loads(data.decode())
+    strings = profile.get('strings')
+    index = {}
+    for address, info in profile['index'].items():
+        if strings is not None:
+            info = {
+                key: strings[value]
+                if key in STRING_FIELDS and value is not None else value
+                for key, value in info.items()
+            }
+        index[int(address)] = info
+    arcs = [
+        ((call['lr'], call['pc']), call['count']) for call in profile['calls']
+    ]
+    return index, arcs
+
+
+def write_json(file, index, arcs, compact=False, string_table=False):
+    """Write the profile as JSON one entry at a time.
+
+    The output is the same as json.dump with indent=2, or with the most
+    compact separators if compact is set, but the document is never built
+    in memory as a whole.
+
+    With string_table, each distinct pathname, symbol and location is
+    written once to a "strings" list, and index entries hold its position
+    in the list instead.
+    """
+    encode = json.JSONEncoder().encode
+    colon = ':' if compact else ': '
+
+    def newline(level):
+        return '' if compact else '\n' + '  ' * level
+
+    def obj(items, level):
+        if not items:
+            return '{}'
+        return '{' + ','.join(
+            newline(level + 1) + encode(key) + colon + encode(value)
+            for key, value in items
+        ) + newline(level) + '}'
+
+    def container(key, opening, closing, entries):
+        file.write(newline(1) + encode(key) + colon + opening)
+        buffer = []
+        empty = True
+        for entry in entries:
+            buffer.append(newline(2) + entry)
+            if len(buffer) >= 4096:
+                file.write(('' if empty else ',') + ','.join(buffer))
+                buffer.clear()
+                empty = False
+        if buffer:
+            file.write(('' if empty else ',') + ','.join(buffer))
+            empty = False
+        file.write(closing if empty else newline(1) + closing)
+
+    ids = {}
+
+    def items(info):
+        if not string_table:
+            return info.items()
+        return [
+            (key, ids[value])
+            if key in STRING_FIELDS and value is not None
+            else (key, value)
+            for key, value in info.items()
+        ]
+
+    file.write('{')
+    if string_table:
+        for info in index.values():
+            for field in STRING_FIELDS:
+                value = info.get(field)
+                if value is not None and value not in ids:
+                    ids[value] = len(ids)
+        container('strings', '[', ']', map(encode, ids))
+        file.write(',')
+
+    container(
+        'index', '{', '}', (
+            encode(str(address)) + colon + obj(items(info), 2)
+            for address, info in index.items()
+        )
+    )
+    file.write(',')
+    container(
+        'calls', '[', ']', (
+            obj((('lr', lr), ('pc', pc), ('count', count)), 2)
+            for (lr, pc), count in arcs
+        )
+    )
+    file.write(newline(0) + '}')
+
+
+def watch(
+        directory,
+        output_dir,
+        suffix,
+        settle,
+        symbolize,
+        write,
+        workers=None,
+        attempts=3,
+        **reader_options
+):
+    """Process captures as they appear in directory until interrupted.
+
+    A capture is processed once its calls file has not changed for settle
+    seconds.  Captures are read in a pool of workers kept for the whole
+    session, then symbolized with symbolize(index, arcs) and written with
+    write(file, index, arcs) to output_dir/<pid><suffix>.  Captures whose
+    output already exists are skipped.  A capture that fails is retried
+    once it has settled again, up to attempts times in all.
+    """
+    directory = pathlib.Path(directory)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    states = {}
+    started = set()
+    pending = {}
+    failures = collections.Counter()
+
+    print('WATCH {}'.format(directory), file=sys.stderr)
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(True,)
+    ) as executor:
+        try:
+            while True:
+                for capture in sorted(directory.iterdir()):
+                    if capture in started:
+                        continue
+                    output = output_dir / (capture.name + suffix)
+                    if output.exists():
+                        started.add(capture)
+                        continue
+                    try:
+                        stat = (capture / 'calls').stat()
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+                    state = stat.st_size, stat.st_mtime
+                    # an empty calls file has not been written yet
+                    if not stat.st_size or states.get(capture) != state or \
+                            time.time() - stat.st_mtime < settle:
+                        states[capture] = state
+                        continue
+                    started.add(capture)
+                    future = executor.submit(
+                        read_capture, capture, **reader_options
+                    )
+                    pending[future] = capture, output
+
+                for future in [future for future in pending if future.done()]:
+                    capture, output = pending.pop(future)
+                    start = time.time()
+                    try:
+                        index, arcs = future.result()
+                        symbolize(index, arcs)
+                        temporary = output.with_name(output.name + '.tmp')
+                        with temporary.open('wb') as file:
+                            write(file, index, arcs)
+                        temporary.rename(output)
+                    except Exception as e:
+                        failures[capture] += 1
+                        if failures[capture] < attempts:
+                            # wait for it to settle again, then retry
+                            started.discard(capture)
+                            states.pop(capture, None)
+                            retry = 'retrying'
+                        else:
+                            retry = 'skipping it after {} attempts'.format(
+                                attempts
+                            )
+                        print(
+                            'FAIL {}: {}, {}'.format(capture, e, retry),
+                            file=sys.stderr,
+                        )
+                        continue
+                    print(
+                        'DONE {} -> {} ({:.1f}s)'.format(
+                            capture, output, time.time() - start
+                        ),
+                        file=sys.stderr,
+                    )
+
+                time.sleep(min(settle, 0.5))
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+
+
+# defaults of the command line, shared with afgprof2dot
+ADDR2LINE = 'arm-linux-androideabi-addr2line'
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'afgprof'
+)
+CACHE_SIZE = 1 << 22
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        allow_abbrev=False,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        'directory',
+        nargs='*',
+        help='directory to find calls and maps. With several directories, '
+        'or a directory of them, the profiles of all processes are merged'
+    )
+    parser.add_argument(
+        '--symbolizer',
+        choices=('addr2line', 'elf'),
+        help='resolve symbols and lines with addr2line processes, or by '
+        'reading the ELF symbol table and DWARF line programs in-process',
+        default='addr2line'
+    )
+    parser.add_argument(
+        '--no-lines',
+        dest='lines',
+        action='store_false',
+        help='resolve addresses to functions from the ELF symbol table only, '
+        'without line information. Overrides --symbolizer'
+    )
+    parser.add_argument(
+        '--addr2line',
+        metavar='COMMAND',
+        help='addr2line command',
+        default=ADDR2LINE
     )
     parser.add_argument(
         '-j',
@@ -284,72 +2829,464 @@ def get_parser():
         help='directory to find unstripped objects',
         default='.'
     )
+    parser.add_argument(
+        '--numpy',
+        action='store_true',
+        help='read and aggregate the calls file with NumPy'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='read the calls file in memory-mapped chunks and spill the '
+        'aggregated arcs to disk past the memory budget'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        metavar='RECORDS',
+        help='number of records aggregated at a time with --stream',
+        type=int,
+        default=1 << 20
+    )
+    parser.add_argument(
+        '--memory-budget',
+        metavar='MIB',
+        help='memory for aggregating the records and ordering the arcs '
+        'and addresses with --stream. The unique arcs and addresses '
+        'are still kept in memory afterwards',
+        type=int,
+        default=1024
+    )
+    parser.add_argument(
+        '--format',
+        choices=('json', 'binary'),
+        help='output format. The binary format is smaller and faster to '
+        'write and read; afgprof2dot.py detects it automatically',
+        default='json'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='write JSON without indentation or spaces'
+    )
+    parser.add_argument(
+        '--watch',
+        metavar='DIRECTORY',
+        help='keep watching DIRECTORY for new captures and process each one '
+        'once its calls file stops changing'
+    )
+    parser.add_argument(
+        '--output-dir',
+        metavar='DIRECTORY',
+        help='with --watch, write the profile of capture <pid> to '
+        '<pid>.json (or <pid>.afgprof) here. Defaults to the watched directory'
+    )
+    parser.add_argument(
+        '--settle',
+        metavar='SECONDS',
+        help='with --watch, how long a calls file must stay unchanged before '
+        'the capture is considered complete',
+        type=float,
+        default=2.0
+    )
+    parser.add_argument(
+        '--coverage',
+        metavar='FRACTION',
+        help='symbolize only the addresses of the most called arcs that '
+        'make up FRACTION of all calls, e.g. 0.999. Other addresses are '
+        'named <object>+<offset> and can be symbolized later with --fill',
+        type=float
+    )
+    parser.add_argument(
+        '--top-arcs',
+        metavar='N',
+        help='symbolize only the addresses of the N most called arcs, '
+        'like --coverage',
+        type=int
+    )
+    parser.add_argument(
+        '--fill',
+        metavar='PROFILE',
+        help='read a profile written by afgprof instead of captures, and '
+        'symbolize the addresses it left unresolved'
+    )
+    parser.add_argument(
+        '--string-table',
+        action='store_true',
+        help='in JSON output, write each distinct pathname, symbol and '
+        'location once to a "strings" list and refer to them by position'
+    )
+    parser.add_argument(
+        '--stats',
+        metavar='FILE',
+        help='write timing, memory and symbolization statistics of each '
+        'stage to FILE as JSON. Memory tracing slows afgprof down'
+    )
+    parser.add_argument(
+        '--profile-stage',
+        metavar='STAGE',
+        action='append',
+        choices=('read', 'translate', 'symbolize', 'demangle', 'write'),
+        default=[],
+        help='run STAGE under cProfile and save the profile next to the '
+        '--stats file. May be repeated'
+    )
+    parser.add_argument(
+        '--demangle',
+        action='store_true',
+        help='demangle C++ symbol names'
+    )
+    parser.add_argument(
+        '--c++filt',
+        dest='cxxfilt',
+        metavar='COMMAND',
+        help='c++filt command used by --demangle',
+        default='arm-linux-androideabi-c++filt'
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='reuse symbolization results across runs, keyed by the build-id '
+        'of each object'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIRECTORY',
+        help='directory of the --cache database',
+        default=CACHE_DIR
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='ENTRIES',
+        help='evict the least recently used results past this many',
+        type=int,
+        default=CACHE_SIZE
+    )
     return parser
 
 
-def main():
-    options = get_parser().parse_args()
+def get_symbolizer(
+        name='addr2line', addr2line=ADDR2LINE, jobs=1
+):
+    """Return the symbolizer called name: addr2line, elf or symtab.
 
-    addr2line = Addr2line(options.addr2line, options.j)
+    addr2line and jobs only apply to the addr2line symbolizer.
+    """
+    if name == 'symtab':
+        return FunctionSymbolizer()
+    if name == 'elf':
+        return ElfSymbolizer()
+    if name == 'addr2line':
+        return Addr2line(addr2line, jobs)
+    raise ValueError('unknown symbolizer {!r}'.format(name))
 
-    objdir = pathlib.Path(options.objdir)
-    directory = pathlib.Path(options.directory)
 
-    with (directory / 'maps').open() as file:
-        map_ = Map.fromfile(file)
+def symbolize_index(index, symbolizer, name, objdir, cache=None, stats=None):
+    """Add the symbol and location of each entry of a translated index.
 
-    index = {}
-    call_count = collections.Counter()
+    name identifies the symbolizer in progress output and cache keys.
+    Objects are looked up by basename in objdir, so pathnames sharing a
+    basename are symbolized together from the same object.  Per-object
+    counts and throughput are added to stats if given.
+    """
+    objdir = pathlib.Path(objdir)
+    # {objpath: {offset: [info, ...]}}, as several entries may share both
+    grouped = collections.defaultdict(lambda: collections.defaultdict(list))
+    for info in index.values():
+        if info['pathname'] is not None:
+            objpath = str(objdir / os.path.basename(info['pathname']))
+            grouped[objpath][info['offset']].append(info)
 
-    calls_file = directory / 'calls'
-    with calls_file.open(mode='rb') as file:
-        data = file.read()
-    length = len(data) // 16
-    for lr, pc, count in ProgressBar(
-            struct.iter_unpack('<IIQ', data),
-            length,
-            prefix='READ {}: '.format(calls_file)
-    ):
-        call_count[lr, pc] += count
-        index[lr] = {}
-        index[pc] = {}
+    jobs = {}
+    object_ids = {}
+    counts = {}
+    # share one string object among the entries with equal names
+    strings = {}
 
-    grouped = collections.defaultdict(dict)
-    for pc, info in index.items():
-        info['pathname'], info['offset'] = map_.translate(pc)
-        if info['pathname'] is not None:
-            grouped[info['pathname']][info['offset']] = info
+    def intern(string):
+        return strings.setdefault(string, string)
+
+    def assign(infos, symbol, location):
+        symbol = intern(symbol)
+        location = intern(location)
+        for info in infos:
+            info['symbol'] = symbol
+            info['location'] = location
 
-    for pathname, grouped_index in grouped.items():
-        objpath = objdir / os.path.basename(pathname)
-        if not objpath.exists():
+    for objpath, grouped_index in grouped.items():
+        if not os.path.exists(objpath):
             print('SKIP {}: does not exist'.format(objpath), file=sys.stderr)
             continue
-        for address, symbol, location in ProgressBar(
-                addr2line.find_symbol_and_line(str(objpath), grouped_index),
-                len(grouped_index),
-                prefix='ADDR2LINE {}: '.format(objpath)
-        ):
-            grouped_index[address]['symbol'] = symbol
-            grouped_index[address]['location'] = location
-
-    json.dump(
-        {
-            'index': index,
-            'calls': [
-                {
-                    'lr': lr,
-                    'pc': pc,
-                    'count': count,
-                }
-                for (lr, pc), count
-                in call_count.most_common()
+
+        missing = grouped_index
+        if cache is not None:
+            object_ = object_ids[objpath] = '{}:{}'.format(
+                name, object_id(objpath)
+            )
+            cached = cache.lookup(object_, grouped_index)
+            for address, (symbol, location) in cached.items():
+                assign(grouped_index[address], symbol, location)
+            missing = [
+                address for address in grouped_index if address not in cached
             ]
-        },
-        sys.stdout,
-        indent=2
+            print(
+                'CACHE {}: {} hits, {} misses'.format(
+                    objpath, len(cached), len(missing)
+                ),
+                file=sys.stderr,
+            )
+        counts[objpath] = len(grouped_index), len(missing)
+        if missing:
+            jobs[objpath] = (missing, grouped_index)
+
+    results = collections.defaultdict(list)
+    total = sum(len(missing) for missing, _ in jobs.values())
+    if total:
+        for filename, address, symbol, location in ProgressBar(
+                symbolizer.symbolize({
+                    filename: missing
+                    for filename, (missing, _) in jobs.items()
+                }),
+                total,
+                prefix='{}: '.format(name.upper())
+        ):
+            assign(jobs[filename][1][address], symbol, location)
+            results[filename].append((address, symbol, location))
+    if cache is not None:
+        for filename, object_results in results.items():
+            cache.store(object_ids[filename], object_results)
+
+    if stats is not None:
+        objects = stats.counters.setdefault(
+            'objects', collections.OrderedDict()
+        )
+        for filename, (addresses, missing) in counts.items():
+            objects[filename] = collections.OrderedDict([
+                ('addresses', addresses),
+                ('cached', addresses - missing),
+            ])
+            if filename in jobs:
+                objects[filename].update(symbolizer.object_stats[filename])
+        if jobs:
+            stats.counters['workers'] = symbolizer.workers
+            stats.counters['worker_utilization'] = symbolizer.utilization
+
+
+def hot_addresses(arcs, coverage=None, top_arcs=None):
+    """Return the addresses of the most called arcs.
+
+    arcs must be sorted by decreasing count.  Arcs are taken until they
+    make up coverage (a fraction) of all calls, and at most top_arcs of
+    them; without either limit, all addresses are returned.
+    """
+    if coverage is not None:
+        target = coverage * sum(count for arc, count in arcs)
+    covered = 0
+    hot = set()
+    for i, ((lr, pc), count) in enumerate(arcs):
+        if top_arcs is not None and i >= top_arcs:
+            break
+        if coverage is not None and covered >= target:
+            break
+        hot.add(lr)
+        hot.add(pc)
+        covered += count
+    return hot
+
+
+def unresolved(index):
+    """Return the mapped entries of index without a location."""
+    return {
+        address: info
+        for address, info in index.items()
+        if info['pathname'] is not None and 'location' not in info
+    }
+
+
+def label_unresolved(index):
+    """Name the unresolved entries of index after their object and offset.
+
+    Their location is left out, so that they can be told apart from
+    resolved entries and symbolized later.
+    """
+    for info in unresolved(index).values():
+        info['symbol'] = '{}+0x{:x}'.format(
+            os.path.basename(info['pathname']), info['offset']
+        )
+
+
+def symbolize_hot(index, arcs, coverage=None, top_arcs=None, **kwargs):
+    """symbolize_index restricted to the addresses of the hottest arcs.
+
+    index may hold a subset of the addresses of arcs, in which case only
+    that subset is considered.  See hot_addresses for coverage and
+    top_arcs.  With either limit, the
+    other entries are labelled with label_unresolved.
+    """
+    if coverage is None and top_arcs is None:
+        symbolize_index(index, **kwargs)
+        return
+    hot = {
+        address: index[address]
+        for address in hot_addresses(arcs, coverage, top_arcs)
+        if address in index
+    }
+    symbolize_index(hot, **kwargs)
+    stats = kwargs.get('stats')
+    if stats is not None:
+        stats.counters['hot_addresses'] = len(hot)
+    label_unresolved(index)
+
+
+def symbolize_and_demangle(index, arcs, demangler=None, **kwargs):
+    """symbolize_hot, followed by demangle_index if demangler is given."""
+    symbolize_hot(index, arcs, **kwargs)
+    if demangler is not None:
+        demangle_index(index, demangler)
+
+
+def write_profile(
+        file, index, arcs, format_='json', compact=False, string_table=False
+):
+    """Write the profile to a binary file in the given output format."""
+    if format_ == 'binary':
+        write_binary(file, index, arcs)
+    else:
+        text = io.TextIOWrapper(file, encoding='ascii')
+        write_json(text, index, arcs, compact, string_table)
+        text.write('\n')
+        text.detach()
+    file.flush()
+
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+    if options.numpy and numpy is None:
+        parser.error('--numpy requires NumPy to be installed')
+    if sum(map(bool, (options.directory, options.watch, options.fill))) != 1:
+        parser.error('specify either capture directories, --watch or --fill')
+    if options.coverage is not None and not 0 < options.coverage <= 1:
+        parser.error('--coverage must be in (0, 1]')
+    if options.top_arcs is not None and options.top_arcs < 1:
+        parser.error('--top-arcs must be at least 1')
+    if options.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+    if options.stats and options.watch:
+        parser.error('--stats cannot be used with --watch')
+    if options.profile_stage and not options.stats:
+        parser.error('--profile-stage requires --stats')
+    stats = Stats(
+        trace_memory=options.stats is not None,
+        profile_stages=options.profile_stage,
+        prefix=options.stats,
+    )
+
+    if not options.lines:
+        options.symbolizer = 'symtab'
+    symbolizer = get_symbolizer(
+        options.symbolizer, options.addr2line, options.j
+    )
+    if options.cache:
+        cache = SymbolCache(options.cache_dir, options.cache_size)
+    else:
+        cache = None
+    if options.demangle:
+        demangler = Demangler(options.cxxfilt, cache)
+    else:
+        demangler = None
+
+    objdir = pathlib.Path(options.objdir)
+    reader_options = dict(
+        stream=options.stream,
+        use_numpy=options.numpy,
+        memory_budget=options.memory_budget << 20,
+        chunk_size=options.chunk_size,
     )
-    print()
+    workers = options.j if options.j > 0 else None
+
+    if options.watch:
+        if options.stream:
+            # share the budget among the processes of the pool
+            reader_options['memory_budget'] //= workers or os.cpu_count()
+        watch(
+            options.watch,
+            options.output_dir or options.watch,
+            '.afgprof' if options.format == 'binary' else '.json',
+            options.settle,
+            functools.partial(
+                symbolize_and_demangle,
+                symbolizer=symbolizer,
+                name=options.symbolizer,
+                objdir=objdir,
+                cache=cache,
+                demangler=demangler,
+                coverage=options.coverage,
+                top_arcs=options.top_arcs,
+            ),
+            functools.partial(
+                write_profile,
+                format_=options.format,
+                compact=options.compact,
+                string_table=options.string_table,
+            ),
+            workers,
+            **reader_options
+        )
+        if cache is not None:
+            cache.close()
+        return
+
+    if options.fill:
+        with stats.stage('read'):
+            with open(options.fill, 'rb') as file:
+                index, arcs = read_profile(file)
+        pending = unresolved(index)
+        stats.counters['arcs'] = len(arcs)
+        stats.counters['addresses'] = len(index)
+        stats.counters['unresolved'] = len(pending)
+    else:
+        index, arcs = load_captures(
+            options.directory, workers, stats, **reader_options
+        )
+        pending = index
+
+    with stats.stage('symbolize'):
+        symbolize_hot(
+            pending,
+            arcs,
+            options.coverage,
+            options.top_arcs,
+            symbolizer=symbolizer,
+            name=options.symbolizer,
+            objdir=objdir,
+            cache=cache,
+            stats=stats,
+        )
+    if demangler is not None:
+        with stats.stage('demangle'):
+            demangle_index(pending, demangler)
+        stats.counters['demangled'] = len(demangler.names)
+
+    if cache is not None:
+        print(
+            'CACHE: {} hits, {} misses'.format(cache.hits, cache.misses),
+            file=sys.stderr,
+        )
+        cache.close()
+
+    with stats.stage('write'):
+        write_profile(
+            sys.stdout.buffer,
+            index,
+            arcs,
+            options.format,
+            options.compact,
+            options.string_table,
+        )
+
+    if options.stats:
+        with open(options.stats, 'w') as file:
+            stats.write(file)
 
 
 if __name__ == '__main__':
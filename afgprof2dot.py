@@ -27,8 +27,15 @@ import textwrap
 import optparse
 import xml.parsers.expat
 import collections
+import contextlib
+import copy
 import locale
 import json
+import heapq
+import itertools
+import bisect
+import gzip
+import io
 
 # Python 2.x/3.x compatibility
 if sys.version_info[0] >= 3:
@@ -65,6 +72,14 @@ try:
 except ImportError:
     pass
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# binary profiles, captures and --stats; found next to this script
+import afgprof
+
 ########################################################################
 # Model
 
@@ -79,6 +94,20 @@ def percentage(p):
     return "%.02f%%" % (p * 100.0, )
 
 
+def signed_times(x):
+    return "%+d%s" % (x, MULTIPLICATION_SIGN)
+
+
+def signed_percentage(p):
+    return "%+.02f%%" % (p * 100.0, )
+
+
+def change(x):
+    if x == float('inf'):
+        return "new"
+    return "%s%.02f" % (MULTIPLICATION_SIGN, x)
+
+
 def add(a, b):
     return a + b
 
@@ -132,11 +161,8 @@ class Event(object):
         self._aggregator = aggregator
         self._formatter = formatter
 
-    def __eq__(self, other):
-        return self is other
-
-    def __hash__(self):
-        return id(self)
+    # Events compare and hash by identity, like any object; not overriding
+    # __eq__ and __hash__ keeps event dict lookups in C
 
     def null(self):
         return self._null
@@ -172,12 +198,25 @@ TIME_RATIO = Event("Time ratio", 0.0, add, lambda x: '(' + percentage(x) + ')')
 TOTAL_TIME = Event("Total time", 0.0, fail)
 TOTAL_TIME_RATIO = Event("Total time ratio", 0.0, fail, percentage)
 
+# Differences between two profiles, see diff_profiles()
+DELTA_CALLS = Event("Calls delta", 0, add, signed_times)
+DELTA_SAMPLES = Event("Samples delta", 0, add, signed_times)
+DELTA_TOTAL_TIME_RATIO = Event(
+    "Total time ratio delta", 0.0, add, signed_percentage
+)
+CALLS_CHANGE = Event("Calls change", 1.0, fail, change)
+SAMPLES_CHANGE = Event("Samples change", 1.0, fail, change)
+TOTAL_TIME_RATIO_CHANGE = Event("Total time ratio change", 1.0, fail, change)
+
 totalMethod = 'callratios'
 
 
 class Object(object):
     """Base class for all objects in profile which can store events."""
 
+    # Profiles can hold millions of calls; slots keep each object small
+    __slots__ = ('events', )
+
     def __init__(self, events=None):
         if events is None:
             self.events = {}
@@ -216,6 +255,8 @@ class Call(Object):
     There should be at most one call object for every pair of functions.
     """
 
+    __slots__ = ('callee_id', 'ratio', 'weight')
+
     def __init__(self, callee_id):
         Object.__init__(self)
         self.callee_id = callee_id
@@ -226,6 +267,11 @@ class Call(Object):
 class Function(Object):
     """A function."""
 
+    __slots__ = (
+        'id', 'name', 'module', 'process', 'calls', 'called', 'weight',
+        'cycle', 'filename'
+    )
+
     def __init__(self, id, name):
         Object.__init__(self)
         self.id = id
@@ -290,23 +336,104 @@ class Function(Object):
 class Cycle(Object):
     """A cycle made from recursive function calls."""
 
+    __slots__ = ('functions', )
+
     def __init__(self):
         Object.__init__(self)
         self.functions = set()
 
     def add_function(self, function):
         assert function not in self.functions
+        merged = function.cycle
         self.functions.add(function)
-        if function.cycle is not None:
-            for other in function.cycle.functions:
-                if function not in self.functions:
-                    self.add_function(other)
         function.cycle = self
+        # all members of a cycle point to it, so one pass merges it whole
+        if merged is not None and merged is not self:
+            for other in merged.functions:
+                if other not in self.functions:
+                    self.functions.add(other)
+                    other.cycle = self
+
+
+class CallGraphIndex(object):
+    """Functions of a profile indexed by name, with callers of each one.
+
+    Built once in linear time, it answers any number of queries, each in
+    time linear in the size of the call graph at most.
+    """
+
+    def __init__(self, profile):
+        self.functions = profile.functions
+        self.ids = collections.defaultdict(list)
+        self.callers = collections.defaultdict(list)
+        for function in compat_itervalues(profile.functions):
+            self.ids[function.name].append(function.id)
+            for callee_id in function.calls:
+                self.callers[callee_id].append(function.id)
+        self.names = sorted(self.ids)
+
+    def find(self, pattern):
+        """Return the ids of the functions matching pattern.
+
+        pattern is a function name, a name prefix followed by '*', or a
+        regular expression to search names for following 're:'.
+        """
+
+        if pattern.startswith('re:'):
+            search = re.compile(pattern[3:]).search
+            names = [name for name in self.names if search(name)]
+        elif pattern.endswith('*'):
+            prefix = pattern[:-1]
+            names = []
+            for name in self.names[bisect.bisect_left(self.names, prefix):]:
+                if not name.startswith(prefix):
+                    break
+                names.append(name)
+        else:
+            names = [pattern] if pattern in self.ids else []
+        return [id for name in names for id in self.ids[name]]
+
+    def find_all(self, patterns, kind='function'):
+        """Return the ids of the functions matching any of patterns.
+
+        Raise ValueError if a pattern matches no function.
+        """
+        ids = []
+        for pattern in patterns:
+            found = self.find(pattern)
+            if not found:
+                raise ValueError(kind + ' node ' + pattern + ' not found')
+            ids.extend(found)
+        return ids
+
+    def descendants(self, ids):
+        """Return ids and the ids of the functions they call, directly or
+        not."""
+        functions = self.functions
+        return self._closure(ids, lambda id: functions[id].calls)
+
+    def ancestors(self, ids):
+        """Return ids and the ids of the functions calling them, directly or
+        not."""
+        callers = self.callers
+        return self._closure(ids, lambda id: callers.get(id, ()))
+
+    def _closure(self, ids, neighbours):
+        visited = set(ids)
+        queue = collections.deque(visited)
+        while queue:
+            for neighbour in neighbours(queue.popleft()):
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    queue.append(neighbour)
+        return visited
 
 
 class Profile(Object):
     """The whole profile."""
 
+    __slots__ = ('functions', 'cycles')
+
     def __init__(self):
         Object.__init__(self)
         self.functions = {}
@@ -346,9 +473,12 @@ class Profile(Object):
         for function in compat_itervalues(self.functions):
             order = self._tarjan(function, order, stack, data)
         cycles = []
+        seen = set()
         for function in compat_itervalues(self.functions):
-            if function.cycle is not None and function.cycle not in cycles:
-                cycles.append(function.cycle)
+            cycle = function.cycle
+            if cycle is not None and cycle not in seen:
+                seen.add(cycle)
+                cycles.append(cycle)
         self.cycles = cycles
         if 0:
             for cycle in cycles:
@@ -356,51 +486,59 @@ class Profile(Object):
                 for member in cycle.functions:
                     sys.stderr.write("\tFunction %s\n" % member.name)
 
-    def prune_root(self, root):
-        visited = set()
-        frontier = set([root])
-        while len(frontier) > 0:
-            node = frontier.pop()
-            visited.add(node)
-            f = self.functions[node]
-            newNodes = f.calls.keys()
-            frontier = frontier.union(set(newNodes) - visited)
-        subtreeFunctions = {}
-        for n in visited:
-            subtreeFunctions[n] = self.functions[n]
-        self.functions = subtreeFunctions
-
-    def prune_leaf(self, leaf):
-        edgesUp = collections.defaultdict(set)
-        for f in self.functions.keys():
-            for n in self.functions[f].calls.keys():
-                edgesUp[n].add(f)
-        # build the tree up
-        visited = set()
-        frontier = set([leaf])
-        while len(frontier) > 0:
-            node = frontier.pop()
-            visited.add(node)
-            frontier = frontier.union(edgesUp[node] - visited)
-        downTree = set(self.functions.keys())
-        upTree = visited
-        path = downTree.intersection(upTree)
-        pathFunctions = {}
-        for n in path:
-            f = self.functions[n]
-            newCalls = {}
-            for c in f.calls.keys():
-                if c in path:
-                    newCalls[c] = f.calls[c]
-            f.calls = newCalls
-            pathFunctions[n] = f
-        self.functions = pathFunctions
-
-    def getFunctionId(self, funcName):
-        for f in self.functions:
-            if self.functions[f].name == funcName:
-                return f
-        return False
+    def prune_root(self, roots, index=None):
+        """Keep only the functions called from roots, directly or not."""
+        self.prune_paths(roots, None, index)
+
+    def prune_leaf(self, leaves, index=None):
+        """Keep only the functions calling leaves, directly or not."""
+        self.prune_paths(None, leaves, index)
+
+    def prune_names(self, roots=(), leaves=()):
+        """prune_paths with roots and leaves matched by CallGraphIndex.find
+        patterns.  No patterns stand for any function.
+
+        Raise ValueError if a pattern matches no function.
+        """
+
+        if not roots and not leaves:
+            return
+        index = CallGraphIndex(self)
+        self.prune_paths(
+            index.find_all(roots, 'root') if roots else None,
+            index.find_all(leaves, 'leaf') if leaves else None,
+            index
+        )
+
+    def prune_paths(self, roots, leaves, index=None):
+        """Keep only the functions on call paths from roots to leaves.
+
+        roots and leaves are lists of function ids; None stands for any
+        function.  index is a CallGraphIndex of the profile, built if not
+        given.
+        """
+
+        if index is None:
+            index = CallGraphIndex(self)
+        keep = None
+        if roots is not None:
+            keep = index.descendants(roots)
+        if leaves is not None:
+            ancestors = index.ancestors(leaves)
+            keep = ancestors if keep is None else keep & ancestors
+        if keep is None:
+            return
+
+        functions = {}
+        for function_id, function in compat_iteritems(self.functions):
+            if function_id in keep:
+                calls = {}
+                for callee_id, call in compat_iteritems(function.calls):
+                    if callee_id in keep:
+                        calls[callee_id] = call
+                function.calls = calls
+                functions[function_id] = function
+        self.functions = functions
 
     class _TarjanData:
         def __init__(self, order):
@@ -411,54 +549,74 @@ class Profile(Object):
     def _tarjan(self, function, order, stack, data):
         """Tarjan's strongly connected components algorithm.
 
+        The depth-first search keeps its own stack of frames rather than
+        recursing, so that deep call chains do not hit the recursion limit.
+
         See also:
         - http://en.wikipedia.org/wiki/Tarjan's_strongly_connected_components_algorithm
         """
 
-        try:
-            func_data = data[function.id]
+        if function.id in data:
             return order
-        except KeyError:
+        frames = []
+
+        def push(function, order):
             func_data = self._TarjanData(order)
             data[function.id] = func_data
+            func_data.onstack = True
+            frames.append((
+                function, func_data, len(stack),
+                iter(compat_itervalues(function.calls))
+            ))
+            stack.append(function)
+            return func_data
+
+        push(function, order)
         order += 1
-        pos = len(stack)
-        stack.append(function)
-        func_data.onstack = True
-        for call in compat_itervalues(function.calls):
-            try:
-                callee_data = data[call.callee_id]
+        while frames:
+            function, func_data, pos, calls = frames[-1]
+            for call in calls:
+                callee_data = data.get(call.callee_id)
+                if callee_data is None:
+                    # descend, and resume with the next call afterwards
+                    push(self.functions[call.callee_id], order)
+                    order += 1
+                    break
                 if callee_data.onstack:
                     func_data.lowlink = min(
                         func_data.lowlink, callee_data.order
                     )
-            except KeyError:
-                callee = self.functions[call.callee_id]
-                order = self._tarjan(callee, order, stack, data)
-                callee_data = data[call.callee_id]
-                func_data.lowlink = min(func_data.lowlink, callee_data.lowlink)
-        if func_data.lowlink == func_data.order:
-            # Strongly connected component found
-            members = stack[pos:]
-            del stack[pos:]
-            if len(members) > 1:
-                cycle = Cycle()
-                for member in members:
-                    cycle.add_function(member)
-                    data[member.id].onstack = False
             else:
-                for member in members:
-                    data[member.id].onstack = False
+                frames.pop()
+                if func_data.lowlink == func_data.order:
+                    # Strongly connected component found
+                    members = stack[pos:]
+                    del stack[pos:]
+                    if len(members) > 1:
+                        cycle = Cycle()
+                        for member in members:
+                            cycle.add_function(member)
+                    for member in members:
+                        data[member.id].onstack = False
+                if frames:
+                    caller_data = frames[-1][1]
+                    caller_data.lowlink = min(
+                        caller_data.lowlink, func_data.lowlink
+                    )
         return order
 
-    def call_ratios(self, event):
+    def call_ratios(self, event, use_numpy=False):
+        if use_numpy:
+            return self._call_ratios_numpy(event)
+
         # Aggregate for incoming calls
         cycle_totals = {}
         for cycle in self.cycles:
             cycle_totals[cycle] = 0.0
+        # keyed by id, which hashes faster than the function itself
         function_totals = {}
-        for function in compat_itervalues(self.functions):
-            function_totals[function] = 0.0
+        for function_id in self.functions:
+            function_totals[function_id] = 0.0
 
         # Pass 1:  function_total gets the sum of call[event] for all
         #          incoming arrows.  Same for cycle_total for all arrows
@@ -468,7 +626,7 @@ class Profile(Object):
                 if call.callee_id != function.id:
                     callee = self.functions[call.callee_id]
                     if event in call.events:
-                        function_totals[callee] += call[event]
+                        function_totals[call.callee_id] += call[event]
                         if callee.cycle is not None and callee.cycle is not function.cycle:
                             cycle_totals[callee.cycle] += call[event]
                     else:
@@ -489,12 +647,70 @@ class Profile(Object):
                         if callee.cycle is not None and callee.cycle is not function.cycle:
                             total = cycle_totals[callee.cycle]
                         else:
-                            total = function_totals[callee]
+                            total = function_totals[call.callee_id]
                         call.ratio = ratio(call[event], total)
                     else:
                         # Warnings here would only repeat those issued above.
                         call.ratio = 0.0
 
+    def _call_ratios_numpy(self, event):
+        """call_ratios() with the totals summed by numpy.bincount."""
+
+        functions = {}
+        for function in compat_itervalues(self.functions):
+            functions[function.id] = len(functions)
+        cycles = {}
+        for cycle in self.cycles:
+            cycles[cycle] = len(cycles)
+
+        calls = []
+        values = []
+        callees = []
+        # calls that are not into a cycle go to the extra last bucket
+        callee_cycles = []
+        for function in compat_itervalues(self.functions):
+            for call in compat_itervalues(function.calls):
+                assert call.ratio is None
+                if call.callee_id != function.id:
+                    callee = self.functions[call.callee_id]
+                    if event in call.events:
+                        calls.append(call)
+                        values.append(call.events[event])
+                        callees.append(functions[call.callee_id])
+                        if callee.cycle is not None and callee.cycle is not function.cycle:
+                            callee_cycles.append(cycles[callee.cycle])
+                        else:
+                            callee_cycles.append(len(cycles))
+                    else:
+                        sys.stderr.write(
+                            "call_ratios: No data for " + function.name +
+                            " call to " + callee.name + "\n"
+                        )
+                        call.ratio = 0.0
+        if not calls:
+            return
+
+        values = numpy.array(values, dtype=numpy.float64)
+        callees = numpy.array(callees, dtype=numpy.intp)
+        callee_cycles = numpy.array(callee_cycles, dtype=numpy.intp)
+        function_totals = numpy.bincount(callees, values, len(functions))
+        cycle_totals = numpy.bincount(callee_cycles, values, len(cycles) + 1)
+        totals = numpy.where(
+            callee_cycles < len(cycles),
+            cycle_totals[callee_cycles],
+            function_totals[callees],
+        )
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratios = values / totals
+        # 0/0 is undefined, but 1.0 yields more useful results
+        ratios[totals == 0.0] = 1.0
+        # let ratio() warn about and clamp the out of range ones
+        for i in numpy.flatnonzero((ratios < 0.0) | (ratios > 1.0)):
+            ratios[i] = ratio(values[i], totals[i])
+        for call, call_ratio in zip(calls, ratios.tolist()):
+            call.ratio = call_ratio
+
     def integrate(self, outevent, inevent):
         """Propagate function time ratio along the function calls.
 
@@ -514,23 +730,85 @@ class Profile(Object):
                 if call.callee_id != function.id:
                     assert call.ratio is not None
 
-        # Aggregate the input for each cycle
-        for cycle in self.cycles:
-            total = inevent.null()
-            for function in compat_itervalues(self.functions):
-                total = inevent.aggregate(total, function[inevent])
-            self[inevent] = total
+        # Index the calls entering each cycle once, rather than scanning the
+        # whole profile for every cycle
+        entries = {}
+        for function in compat_itervalues(self.functions):
+            for call in compat_itervalues(function.calls):
+                callee = self.functions[call.callee_id]
+                if callee.cycle is not None and callee.cycle is not function.cycle:
+                    callees = entries.setdefault(callee.cycle, {})
+                    callees[callee] = callees.get(callee, 0.0) + call.ratio
+
+        # Integrate along the edges, callees first so that every call only
+        # looks up the already integrated time of its callee
+        for node in self._callees_first():
+            if isinstance(node, Cycle):
+                self._integrate_cycle(
+                    node, entries.get(node, {}), outevent, inevent
+                )
+            else:
+                self._integrate_function(node, outevent, inevent)
 
-        # Integrate along the edges
         total = inevent.null()
         for function in compat_itervalues(self.functions):
             total = inevent.aggregate(total, function[inevent])
-            self._integrate_function(function, outevent, inevent)
+        if self.cycles:
+            self[inevent] = total
         self[outevent] = total
 
+    def _callees_first(self):
+        """Return the functions outside cycles and the cycles, each one
+        after all those it calls.
+
+        This is a post-order of an iterative depth-first search on the call
+        graph with cycles collapsed, which has no cycles left.
+        """
+
+        functions = self.functions
+
+        def node(function):
+            if function.cycle is None:
+                return function
+            return function.cycle
+
+        def callees(node):
+            if isinstance(node, Cycle):
+                members = node.functions
+            else:
+                members = (node, )
+            for member in members:
+                for callee_id in member.calls:
+                    callee = functions[callee_id]
+                    if callee.cycle is None:
+                        yield callee
+                    else:
+                        yield callee.cycle
+
+        order = []
+        visited = set()
+        for function in compat_itervalues(functions):
+            root = node(function)
+            if root in visited:
+                continue
+            visited.add(root)
+            stack = [(root, callees(root))]
+            while stack:
+                current, successors = stack[-1]
+                for successor in successors:
+                    if successor not in visited:
+                        visited.add(successor)
+                        stack.append((successor, callees(successor)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(current)
+        return order
+
     def _integrate_function(self, function, outevent, inevent):
         if function.cycle is not None:
-            return self._integrate_cycle(function.cycle, outevent, inevent)
+            # integrate() does cycles before their callers
+            return function.cycle[outevent]
         else:
             if outevent not in function:
                 total = function[inevent]
@@ -550,7 +828,13 @@ class Profile(Object):
         call[outevent] = subtotal
         return subtotal
 
-    def _integrate_cycle(self, cycle, outevent, inevent):
+    def _integrate_cycle(self, cycle, callees, outevent, inevent):
+        """Integrate a cycle, then share its total among its members.
+
+        callees maps the members called from outside the cycle to the sum
+        of the ratios of those calls.
+        """
+
         if outevent not in cycle:
 
             # Compute the outevent for the whole cycle
@@ -566,18 +850,6 @@ class Profile(Object):
                 total += subtotal
             cycle[outevent] = total
 
-            # Compute the time propagated to callers of this cycle
-            callees = {}
-            for function in compat_itervalues(self.functions):
-                if function.cycle is not cycle:
-                    for call in compat_itervalues(function.calls):
-                        callee = self.functions[call.callee_id]
-                        if callee.cycle is cycle:
-                            try:
-                                callees[callee] += call.ratio
-                            except KeyError:
-                                callees[callee] = call.ratio
-
             for member in cycle.functions:
                 member[outevent] = outevent.null()
 
@@ -601,110 +873,118 @@ class Profile(Object):
         return cycle[outevent]
 
     def _rank_cycle_function(self, cycle, function, ranks):
-        """Dijkstra's shortest paths algorithm.
+        """Rank the members of a cycle, by id, by their distance in calls
+        from function.
 
-        See also:
-        - http://en.wikipedia.org/wiki/Dijkstra's_algorithm
+        Every call counts as one, so a breadth-first search finds the same
+        shortest paths as Dijkstra's algorithm would.
         """
 
-        import heapq
-        Q = []
-        Qd = {}
-        p = {}
-        visited = set([function])
-
-        ranks[function] = 0
-        for call in compat_itervalues(function.calls):
-            if call.callee_id != function.id:
-                callee = self.functions[call.callee_id]
-                if callee.cycle is cycle:
-                    ranks[callee] = 1
-                    item = [ranks[callee], function, callee]
-                    heapq.heappush(Q, item)
-                    Qd[callee] = item
-
-        while Q:
-            cost, parent, member = heapq.heappop(Q)
-            if member not in visited:
-                p[member] = parent
-                visited.add(member)
-                for call in compat_itervalues(member.calls):
-                    if call.callee_id != member.id:
-                        callee = self.functions[call.callee_id]
-                        if callee.cycle is cycle:
-                            member_rank = ranks[member]
-                            rank = ranks.get(callee)
-                            if rank is not None:
-                                if rank > 1 + member_rank:
-                                    rank = 1 + member_rank
-                                    ranks[callee] = rank
-                                    Qd_callee = Qd[callee]
-                                    Qd_callee[0] = rank
-                                    Qd_callee[1] = member
-                                    heapq._siftdown(Q, 0, Q.index(Qd_callee))
-                            else:
-                                rank = 1 + member_rank
-                                ranks[callee] = rank
-                                item = [rank, member, callee]
-                                heapq.heappush(Q, item)
-                                Qd[callee] = item
+        ranks[function.id] = 0
+        queue = collections.deque([function])
+        while queue:
+            member = queue.popleft()
+            rank = ranks[member.id] + 1
+            for call in compat_itervalues(member.calls):
+                if call.callee_id != member.id and call.callee_id not in ranks:
+                    callee = self.functions[call.callee_id]
+                    if callee.cycle is cycle:
+                        ranks[call.callee_id] = rank
+                        queue.append(callee)
 
     def _call_ratios_cycle(self, cycle, function, ranks, call_ratios, visited):
-        if function not in visited:
-            visited.add(function)
-            for call in compat_itervalues(function.calls):
+        if function.id in visited:
+            return
+        visited.add(function.id)
+        # depth-first along calls of increasing rank, without recursing
+        stack = [(function, iter(compat_itervalues(function.calls)))]
+        while stack:
+            function, calls = stack[-1]
+            for call in calls:
                 if call.callee_id != function.id:
                     callee = self.functions[call.callee_id]
                     if callee.cycle is cycle:
-                        if ranks[callee] > ranks[function]:
-                            call_ratios[callee] = call_ratios.get(
-                                callee, 0.0
+                        if ranks[callee.id] > ranks[function.id]:
+                            call_ratios[callee.id] = call_ratios.get(
+                                callee.id, 0.0
                             ) + call.ratio
-                            self._call_ratios_cycle(
-                                cycle, callee, ranks, call_ratios, visited
-                            )
+                            if callee.id not in visited:
+                                visited.add(callee.id)
+                                stack.append((
+                                    callee,
+                                    iter(compat_itervalues(callee.calls))
+                                ))
+                                break
+            else:
+                stack.pop()
 
     def _integrate_cycle_function(
             self, cycle, function, partial_ratio, partials, ranks, call_ratios,
             outevent, inevent
     ):
-        if function not in partials:
-            partial = partial_ratio * function[inevent]
-            for call in compat_itervalues(function.calls):
+        if function.id in partials:
+            return partials[function.id]
+        start = function.id
+
+        def call_partial(call):
+            call_ratio = ratio(call.ratio, call_ratios[call.callee_id])
+            call_partial = call_ratio * partials[call.callee_id]
+            call.events[outevent] = call.events.get(
+                outevent, 0.0
+            ) + call_partial
+            return call_partial
+
+        # Each frame holds a member, its remaining calls, its partial so
+        # far, and the call whose callee is being integrated, if any
+        frames = []
+
+        def enter(function):
+            frames.append([
+                function,
+                iter(compat_itervalues(function.calls)),
+                partial_ratio * function[inevent],
+                None,
+            ])
+
+        enter(function)
+        while frames:
+            frame = frames[-1]
+            function, calls, partial, waiting = frame
+            if waiting is not None:
+                partial += call_partial(waiting)
+                frame[3] = None
+            for call in calls:
                 if call.callee_id != function.id:
                     callee = self.functions[call.callee_id]
                     if callee.cycle is not cycle:
                         assert outevent in call
                         partial += partial_ratio * call[outevent]
                     else:
-                        if ranks[callee] > ranks[function]:
-                            callee_partial = self._integrate_cycle_function(
-                                cycle, callee, partial_ratio, partials, ranks,
-                                call_ratios, outevent, inevent
-                            )
-                            call_ratio = ratio(call.ratio, call_ratios[callee])
-                            call_partial = call_ratio * callee_partial
-                            try:
-                                call[outevent] += call_partial
-                            except UndefinedEvent:
-                                call[outevent] = call_partial
-                            partial += call_partial
-            partials[function] = partial
-            try:
-                function[outevent] += partial
-            except UndefinedEvent:
-                function[outevent] = partial
-        return partials[function]
+                        if ranks[callee.id] > ranks[function.id]:
+                            if callee.id not in partials:
+                                # come back to this call once the callee
+                                # is done
+                                frame[2] = partial
+                                frame[3] = call
+                                enter(callee)
+                                break
+                            partial += call_partial(call)
+            else:
+                frames.pop()
+                partials[function.id] = partial
+                function.events[outevent] = function.events.get(
+                    outevent, 0.0
+                ) + partial
+        return partials[start]
 
     def aggregate(self, event):
         """Aggregate an event for the whole profile."""
 
         total = event.null()
         for function in compat_itervalues(self.functions):
-            try:
-                total = event.aggregate(total, function[event])
-            except UndefinedEvent:
+            if event not in function.events:
                 return
+            total = event.aggregate(total, function.events[event])
         self[event] = total
 
     def ratio(self, outevent, inevent):
@@ -723,28 +1003,32 @@ class Profile(Object):
     def prune(self, node_thres, edge_thres):
         """Prune the profile"""
 
+        self.weigh()
+        self.prune_weights(node_thres, edge_thres)
+
+    def weigh(self):
+        """Weigh functions and calls by their total time ratio."""
+
         # compute the prune ratios
         for function in compat_itervalues(self.functions):
-            try:
-                function.weight = function[TOTAL_TIME_RATIO]
-            except UndefinedEvent:
-                pass
+            function_ratio = function.events.get(TOTAL_TIME_RATIO)
+            if function_ratio is not None:
+                function.weight = function_ratio
 
             for call in compat_itervalues(function.calls):
-                callee = self.functions[call.callee_id]
-
-                if TOTAL_TIME_RATIO in call:
+                call_ratio = call.events.get(TOTAL_TIME_RATIO)
+                if call_ratio is not None:
                     # handle exact cases first
-                    call.weight = call[TOTAL_TIME_RATIO]
-                else:
-                    try:
-                        # make a safe estimate
-                        call.weight = min(
-                            function[TOTAL_TIME_RATIO],
-                            callee[TOTAL_TIME_RATIO]
-                        )
-                    except UndefinedEvent:
-                        pass
+                    call.weight = call_ratio
+                elif function_ratio is not None:
+                    # make a safe estimate
+                    callee = self.functions[call.callee_id]
+                    callee_ratio = callee.events.get(TOTAL_TIME_RATIO)
+                    if callee_ratio is not None:
+                        call.weight = min(function_ratio, callee_ratio)
+
+    def prune_weights(self, node_thres, edge_thres):
+        """Remove the functions and calls weighing less than thresholds."""
 
         # prune the nodes
         for function_id in compat_keys(self.functions):
@@ -780,6 +1064,161 @@ class Profile(Object):
                 '    %s: %s\n' % (event.name, event.format(value))
             )
 
+
+def diff_profiles(baseline, candidate):
+    """Return the changes from the baseline to the candidate profile.
+
+    Functions and calls are matched by function name.  The result holds
+    the candidate's CALLS, SAMPLES and TOTAL_TIME_RATIO along with their
+    deltas and change ratios; functions only in the baseline are kept
+    with null values.  Weights are the larger total time ratio of either
+    profile, so that prune() keeps what was significant in any of them.
+    """
+
+    olds = {}
+    for function in compat_itervalues(baseline.functions):
+        olds[function.name] = function
+    news = {}
+    for function in compat_itervalues(candidate.functions):
+        news[function.name] = function
+
+    profile = Profile()
+    ids = {}
+    for name in itertools.chain(news, olds):
+        if name not in ids:
+            ids[name] = len(ids)
+            profile.add_function(Function(ids[name], name))
+
+    # calls, and function calls counted on the incoming calls
+    called = {}
+    for source, side in ((baseline, 0), (candidate, 1)):
+        for caller in compat_itervalues(source.functions):
+            function = profile.functions[ids[caller.name]]
+            for call in compat_itervalues(caller.calls):
+                callee = source.functions[call.callee_id]
+                callee_id = ids[callee.name]
+                pair = function.calls.get(callee_id)
+                if pair is None:
+                    pair = function.calls[callee_id] = [None, None]
+                pair[side] = call
+                if CALLS in call:
+                    counts = called.setdefault(callee_id, [0, 0])
+                    counts[side] += call[CALLS]
+
+    for function in compat_itervalues(profile.functions):
+        old = olds.get(function.name)
+        new = news.get(function.name)
+        _diff_events(function, old, new, SAMPLES, DELTA_SAMPLES, SAMPLES_CHANGE)
+        _diff_events(
+            function, old, new,
+            TOTAL_TIME_RATIO, DELTA_TOTAL_TIME_RATIO, TOTAL_TIME_RATIO_CHANGE
+        )
+        counts = called.get(function.id, (0, 0))
+        function[CALLS] = counts[1]
+        function[DELTA_CALLS] = counts[1] - counts[0]
+        function[CALLS_CHANGE] = _change(counts[0], counts[1])
+        function.weight = _diff_weight(old, new)
+
+        for callee_id, (old, new) in list(compat_iteritems(function.calls)):
+            call = Call(callee_id)
+            _diff_events(call, old, new, CALLS, DELTA_CALLS, CALLS_CHANGE)
+            _diff_events(call, old, new, SAMPLES2, DELTA_SAMPLES, SAMPLES_CHANGE)
+            _diff_events(
+                call, old, new,
+                TOTAL_TIME_RATIO, DELTA_TOTAL_TIME_RATIO, TOTAL_TIME_RATIO_CHANGE
+            )
+            call.weight = _diff_weight(old, new)
+            function.calls[callee_id] = call
+
+    return profile
+
+
+def _change(old, new):
+    if old:
+        return float(new) / float(old)
+    if new:
+        return float('inf')
+    return 1.0
+
+
+def _diff_events(obj, old, new, event, delta, change_event):
+    null = event.null()
+    old_value = null if old is None else old.events.get(event, null)
+    new_value = null if new is None else new.events.get(event, null)
+    obj.events[event] = new_value
+    obj.events[delta] = new_value - old_value
+    obj.events[change_event] = _change(old_value, new_value)
+
+
+def _diff_weight(old, new):
+    weights = [
+        obj.events[TOTAL_TIME_RATIO] for obj in (old, new)
+        if obj is not None and TOTAL_TIME_RATIO in obj.events
+    ]
+    if weights:
+        return max(weights)
+    return None
+
+
+def diff_weigh(profile):
+    """Set the weights of a diff profile for a DiffTheme.
+
+    0.5 means no change in total time ratio, 0.0 and 1.0 the largest
+    decrease and increase in the profile.
+    """
+
+    objects = []
+    for function in compat_itervalues(profile.functions):
+        objects.append(function)
+        objects.extend(compat_itervalues(function.calls))
+    scale = max(
+        [abs(obj[DELTA_TOTAL_TIME_RATIO]) for obj in objects] + [tol]
+    )
+    for obj in objects:
+        obj.weight = 0.5 + 0.5 * obj[DELTA_TOTAL_TIME_RATIO] / scale
+
+
+def report_regressions(profile, count, file):
+    """Write the functions and calls that grew the most to file."""
+
+    functions = heapq.nlargest(
+        count,
+        compat_itervalues(profile.functions),
+        key=lambda function: function[DELTA_TOTAL_TIME_RATIO]
+    )
+    calls = heapq.nlargest(
+        count,
+        (
+            (function, call)
+            for function in compat_itervalues(profile.functions)
+            for call in compat_itervalues(function.calls)
+        ),
+        key=lambda item: item[1][DELTA_CALLS]
+    )
+
+    file.write('Top regressions by total time ratio:\n')
+    for function in functions:
+        if function[DELTA_TOTAL_TIME_RATIO] <= 0:
+            break
+        file.write('  %s %s (%s) %s\n' % (
+            signed_percentage(function[DELTA_TOTAL_TIME_RATIO]),
+            change(function[TOTAL_TIME_RATIO_CHANGE]),
+            percentage(function[TOTAL_TIME_RATIO]),
+            function.name,
+        ))
+    file.write('Top regressions by calls:\n')
+    for function, call in calls:
+        if call[DELTA_CALLS] <= 0:
+            break
+        file.write('  %s %s (%s) %s -> %s\n' % (
+            signed_times(call[DELTA_CALLS]),
+            change(call[CALLS_CHANGE]),
+            times(call[CALLS]),
+            function.name,
+            profile.functions[call.callee_id].name,
+        ))
+
+
 ########################################################################
 # Parsers
 
@@ -834,69 +1273,202 @@ class Parser:
         raise NotImplementedError
 
 
+class NullStats:
+    """Stand-in for afgprof.Stats when no statistics are collected."""
+
+    def __init__(self):
+        self.counters = {}
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+
 class AfgprofParser(Parser):
-    def __init__(self, stream):
+    # stats stage of read_calls
+    read_stage = 'read'
+
+    def __init__(self, stream, stats=None, use_numpy=False):
         Parser.__init__(self)
         self.stream = stream
+        self.stats = NullStats() if stats is None else stats
+        self.use_numpy = use_numpy
+
+    def read_calls(self):
+        """Return (caller symbol, callee symbol, count) for each call."""
+        data = self.stream.read()
+        if isinstance(data, bytes) and data.startswith(afgprof.BINARY_MAGIC):
+            obj = afgprof.read_binary(io.BytesIO(data))
+            strings = obj['strings']
+            symbols = [
+                strings[symbol] if symbol >= 0 else '?'
+                for symbol in obj['symbol']
+            ]
+            return [
+                (symbols[lr], symbols[pc], count)
+                for lr, pc, count in zip(obj['lr'], obj['pc'], obj['count'])
+            ]
+
+        obj = json.loads(data)
+        if 'strings' in obj:
+            # string table output, symbols are positions in it
+            strings = obj['strings']
+            symbols = {
+                address: strings[info['symbol']] if 'symbol' in info else '?'
+                for address, info in obj['index'].items()
+            }
+        else:
+            symbols = {
+                address: info.get('symbol', '?')
+                for address, info in obj['index'].items()
+            }
+        return [
+            (symbols[str(call['lr'])], symbols[str(call['pc'])], call['count'])
+            for call in obj['calls']
+        ]
 
     def parse(self):
 
-        obj = json.load(self.stream)
+        stats = self.stats
+        with stats.stage(self.read_stage):
+            calls = self.read_calls()
+        stats.counters['arcs'] = len(calls)
+
+        with stats.stage('build'):
+            profile = self.build(calls)
+
+        if False:
+            profile.dump()
+
+        # compute derived data
+        with stats.stage('cycles'):
+            profile.validate()
+            profile.find_cycles()
+        with stats.stage('ratios'):
+            profile.ratio(TIME_RATIO, SAMPLES)
+            profile.call_ratios(SAMPLES2, self.use_numpy)
+            profile.aggregate(CALLS)
+        with stats.stage('integrate'):
+            profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        stats.counters['functions'] = len(profile.functions)
+        stats.counters['calls'] = sum(
+            len(function.calls)
+            for function in compat_itervalues(profile.functions)
+        )
+        stats.counters['cycles'] = len(profile.cycles)
+        return profile
+
+    def build(self, calls):
+        """Build the profile from read_calls() output."""
 
         profile = Profile()
-        profile[SAMPLES] = 0
 
         functions = dict()
         fi = 0
 
-        def find_function(pc):
-            try:
-                return functions[transform(pc)]
-            except KeyError:
+        def find_function(symbol):
+            function = functions.get(symbol)
+            if function is None:
                 nonlocal fi
-                function = Function(
-                    fi, obj['index'][str(pc)].get('symbol', '?')
-                )
+                function = Function(fi, symbol)
                 function[SAMPLES] = 0
                 fi += 1
-                functions[transform(pc)] = function
+                functions[symbol] = function
                 profile.add_function(function)
-                return function
+            return function
 
-        def transform(pc):
-            return obj['index'][str(pc)].get('symbol', '?')
+        total = 0
+        for caller, callee, count in calls:
+            caller = find_function(caller)
+            callee = find_function(callee)
 
-        for call in obj['calls']:
-            caller = find_function(call['lr'])
-            callee = find_function(call['pc'])
-            count = call['count']
+            callee.events[SAMPLES] += count
+            total += count
 
-            callee[SAMPLES] += count
-            profile[SAMPLES] += count
-
-            try:
-                call = caller.calls[callee.id]
-            except KeyError:
+            call = caller.calls.get(callee.id)
+            if call is None:
                 call = Call(callee.id)
                 call[SAMPLES2] = count
                 call[CALLS] = count
                 caller.add_call(call)
             else:
-                call[CALLS] += count
-                call[SAMPLES2] += count
+                events = call.events
+                events[CALLS] += count
+                events[SAMPLES2] += count
 
-        if False:
-            profile.dump()
+        profile[SAMPLES] = total
+        return profile
 
-        # compute derived data
-        profile.validate()
-        profile.find_cycles()
-        profile.ratio(TIME_RATIO, SAMPLES)
-        profile.call_ratios(SAMPLES2)
-        profile.aggregate(CALLS)
-        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
 
-        return profile
+class CaptureParser(AfgprofParser):
+    """Parser of a profile already in memory, as returned by
+    afgprof.load_captures and symbolized, without a JSON round trip."""
+
+    read_stage = 'calls'
+
+    def __init__(self, index, arcs, stats=None, use_numpy=False):
+        AfgprofParser.__init__(self, None, stats, use_numpy)
+        self.index = index
+        self.arcs = arcs
+
+    def read_calls(self):
+        symbols = {
+            address: info.get('symbol', '?')
+            for address, info in compat_iteritems(self.index)
+        }
+        return [
+            (symbols[lr], symbols[pc], count)
+            for (lr, pc), count in self.arcs
+        ]
+
+
+def load_profile(
+        directories,
+        objdir='.',
+        symbolizer='addr2line',
+        name=None,
+        coverage=None,
+        top_arcs=None,
+        cache=None,
+        demangler=None,
+        stats=None,
+        use_numpy=False,
+        **kwargs
+):
+    """Read, symbolize and analyze afgprof captures in this process.
+
+    directories and kwargs, reader options such as stream, are passed to
+    afgprof.load_captures.  symbolizer is the name of an afgprof symbolizer
+    or a symbolizer object, which name then identifies in progress output
+    and cache keys.  Objects are looked up in objdir; see
+    afgprof.symbolize_hot for coverage and top_arcs.  Return the Profile,
+    ready to be pruned and written.
+    """
+
+    if stats is None:
+        stats = NullStats()
+    if isinstance(symbolizer, str):
+        name = symbolizer
+        symbolizer = afgprof.get_symbolizer(name)
+    index, arcs = afgprof.load_captures(
+        directories, stats=stats, use_numpy=use_numpy, **kwargs
+    )
+    with stats.stage('symbolize'):
+        afgprof.symbolize_hot(
+            index,
+            arcs,
+            coverage,
+            top_arcs,
+            symbolizer=symbolizer,
+            name=name or 'symbolize',
+            objdir=objdir,
+            cache=cache,
+            stats=stats,
+        )
+    if demangler is not None:
+        with stats.stage('demangle'):
+            afgprof.demangle_index(index, demangler)
+    return CaptureParser(index, arcs, stats, use_numpy).parse()
 
 
 class Theme:
@@ -1032,6 +1604,49 @@ class Theme:
             return m1
 
 
+class DiffTheme(Theme):
+    """Diverging theme for diff profiles, see diff_weigh().
+
+    Weights below 0.5 shade from neutralcolor to mincolor, weights above it
+    to maxcolor; font sizes and pen widths grow with the size of the change
+    either way.
+    """
+
+    def __init__(self, neutralcolor=(0.0, 0.0, 0.6), **kwargs):
+        Theme.__init__(self, **kwargs)
+        self.neutralcolor = neutralcolor
+
+    def magnitude(self, weight):
+        return min(abs(weight - 0.5) * 2.0, 1.0)
+
+    def edge_penwidth(self, weight):
+        return Theme.edge_penwidth(self, self.magnitude(weight))
+
+    def fontsize(self, weight):
+        return Theme.fontsize(self, self.magnitude(weight))
+
+    def color(self, weight):
+        if self.skew < 0:
+            raise ValueError("Skew must be greater than 0")
+        magnitude = self.magnitude(weight)
+        if self.skew != 1.0:
+            base = self.skew
+            magnitude = (-1.0 + (base**magnitude)) / (base - 1.0)
+
+        h0, s0, l0 = self.neutralcolor
+        if weight < 0.5:
+            h1, s1, l1 = self.mincolor
+        else:
+            h1, s1, l1 = self.maxcolor
+
+        # the neutral color is gray, so keep the hue of the end color
+        h = h1
+        s = s0 + magnitude * (s1 - s0)
+        l = l0 + magnitude * (l1 - l0)
+
+        return self.hsl_to_rgb(h, s, l)
+
+
 TEMPERATURE_COLORMAP = Theme(
     mincolor = (2.0/3.0, 0.80, 0.25), # dark blue
     maxcolor = (0.0, 1.0, 0.5), # satured red
@@ -1068,6 +1683,14 @@ PRINT_COLORMAP = Theme(
     maxpenwidth = 8.0,
 )
 
+DIFF_COLORMAP = DiffTheme(
+    mincolor = (2.0/3.0, 0.80, 0.35), # blue
+    maxcolor = (0.0, 1.0, 0.5), # satured red
+    minfontsize = 10.0,
+    maxfontsize = 16.0,
+    gamma = 1.0
+)
+
 themes = {
     "color": TEMPERATURE_COLORMAP,
     "pink": PINK_COLORMAP,
@@ -1099,6 +1722,7 @@ class DotWriter:
 
     def __init__(self, fp):
         self.fp = fp
+        self.buffer = []
 
     def wrap_function_name(self, name):
         """Split the function name on multiple lines."""
@@ -1120,6 +1744,14 @@ class DotWriter:
     show_function_events = [TOTAL_TIME_RATIO, TIME_RATIO]
     show_edge_events = [TOTAL_TIME_RATIO, CALLS]
 
+    # weights are rounded to this many steps between 0 and 1, and the
+    # styles of each step computed once.  With the built-in themes, styles
+    # then stay within a unit of color and 0.01 in size of the exact ones
+    weight_levels = 4096
+
+    # strings written at a time
+    buffer_size = 4096
+
     def graph(self, profile, theme):
         self.begin_graph()
 
@@ -1139,6 +1771,47 @@ class DotWriter:
         )
         self.attr('edge', fontname=fontname)
 
+        node_styles = {}
+        edge_styles = {}
+        levels = float(self.weight_levels)
+
+        # The attributes of a node or edge other than its label and tooltip
+        # only depend on its weight.  They are written in attr_list() order,
+        # sorted by name, before the label (and after it for edges).
+
+        def node_style(weight):
+            level = int(weight * levels + 0.5)
+            style = node_styles.get(level)
+            if style is None:
+                weight = level / levels
+                style = node_styles[level] = ' [%s, %s, %s, label=' % (
+                    self.attr_pair('color', self.color(theme.node_bgcolor(weight))),
+                    self.attr_pair('fontcolor', self.color(theme.node_fgcolor(weight))),
+                    self.attr_pair('fontsize', "%.2f" % theme.node_fontsize(weight)),
+                )
+            return style
+
+        def edge_style(weight):
+            level = int(weight * levels + 0.5)
+            style = edge_styles.get(level)
+            if style is None:
+                weight = level / levels
+                color = self.color(theme.edge_color(weight))
+                penwidth = "%.2f" % theme.edge_penwidth(weight)
+                style = edge_styles[level] = (
+                    ' [%s, %s, %s, %s, label=' % (
+                        self.attr_pair('arrowsize', "%.2f" % theme.edge_arrowsize(weight)),
+                        self.attr_pair('color', color),
+                        self.attr_pair('fontcolor', color),
+                        self.attr_pair('fontsize', "%.2f" % theme.edge_fontsize(weight)),
+                    ),
+                    ', %s, %s];\n' % (
+                        self.attr_pair('labeldistance', penwidth),
+                        self.attr_pair('penwidth', penwidth),
+                    ),
+                )
+            return style
+
         for _, function in sorted_iteritems(profile.functions):
             labels = []
             if function.process is not None:
@@ -1167,13 +1840,13 @@ class DotWriter:
                 weight = 0.0
 
             label = '\n'.join(labels)
-            self.node(
-                function.id,
-                label=label,
-                color=self.color(theme.node_bgcolor(weight)),
-                fontcolor=self.color(theme.node_fgcolor(weight)),
-                fontsize="%.2f" % theme.node_fontsize(weight),
-                tooltip=function.filename,
+            if function.filename is None:
+                tooltip = ''
+            else:
+                tooltip = ', ' + self.attr_pair('tooltip', function.filename)
+            self.write(
+                '\t' + str(function.id) + node_style(weight) +
+                self.format_id(label) + tooltip + '];\n'
             )
 
             for _, call in sorted_iteritems(function.calls):
@@ -1194,16 +1867,10 @@ class DotWriter:
 
                 label = '\n'.join(labels)
 
-                self.edge(
-                    function.id,
-                    call.callee_id,
-                    label=label,
-                    color=self.color(theme.edge_color(weight)),
-                    fontcolor=self.color(theme.edge_color(weight)),
-                    fontsize="%.2f" % theme.edge_fontsize(weight),
-                    penwidth="%.2f" % theme.edge_penwidth(weight),
-                    labeldistance="%.2f" % theme.edge_penwidth(weight),
-                    arrowsize="%.2f" % theme.edge_arrowsize(weight),
+                before, after = edge_style(weight)
+                self.write(
+                    '\t' + str(function.id) + ' -> ' + str(call.callee_id) +
+                    before + self.format_id(label) + after
                 )
 
         self.end_graph()
@@ -1213,6 +1880,7 @@ class DotWriter:
 
     def end_graph(self):
         self.write('}\n')
+        self.flush()
 
     def attr(self, what, **attrs):
         self.write("\t")
@@ -1251,17 +1919,23 @@ class DotWriter:
             self.id(value)
         self.write(']')
 
+    def attr_pair(self, name, value):
+        """Return name=value as attr_list() would write it."""
+        return self.format_id(name) + '=' + self.format_id(value)
+
     def id(self, id):
+        self.write(self.format_id(id))
+
+    def format_id(self, id):
         if isinstance(id, (int, float)):
-            s = str(id)
+            return str(id)
         elif isinstance(id, basestring):
             if id.isalnum() and not id.startswith('0x'):
-                s = id
+                return id
             else:
-                s = self.escape(id)
+                return self.escape(id)
         else:
             raise TypeError
-        self.write(s)
 
     def color(self, rgb):
         r, g, b = rgb
@@ -1275,9 +1949,14 @@ class DotWriter:
 
         return "#" + "".join(["%02x" % float2int(c) for c in (r, g, b)])
 
+    # characters escape() replaces, for a quick check
+    _escaped_re = re.compile(r'[\\\n\t"]')
+
     def escape(self, s):
         if not PYTHON_3:
             s = s.encode('utf-8')
+        if self._escaped_re.search(s) is None:
+            return '"' + s + '"'
         s = s.replace('\\', r'\\')
         s = s.replace('\n', r'\n')
         s = s.replace('\t', r'\t')
@@ -1285,12 +1964,225 @@ class DotWriter:
         return '"' + s + '"'
 
     def write(self, s):
-        self.fp.write(s)
+        self.buffer.append(s)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffered output."""
+        self.fp.write(''.join(self.buffer))
+        del self.buffer[:]
+
+
+def _varint(value):
+    """Encode a non-negative integer as a protocol buffers varint."""
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _message(*fields):
+    """Encode (number, value) fields as a protocol buffers message.
+
+    int values are varints, bytes values length-delimited (strings and
+    embedded messages), and lists of ints packed varints.
+    """
+
+    data = []
+    for number, value in fields:
+        if isinstance(value, list):
+            value = b''.join([_varint(item) for item in value])
+        if isinstance(value, bytes):
+            data.append(_varint(number << 3 | 2))
+            data.append(_varint(len(value)))
+            data.append(value)
+        else:
+            data.append(_varint(number << 3))
+            data.append(_varint(value))
+    return b''.join(data)
+
+
+class PprofWriter:
+    """Writer for gzipped pprof profile.proto files.
+
+    Every call becomes a sample of two locations, the callee and the
+    caller, valued with the calls and samples of the call and labelled with
+    its total time ratio in parts per million.  Each function has a single
+    location.
+
+    See also:
+    - https://github.com/google/pprof/blob/main/proto/profile.proto
+    """
+
+    strip = False
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def graph(self, profile, theme=None):
+        out = gzip.GzipFile(fileobj=self.fp, mode='wb')
+        strings = {}
+
+        # string_table entries can come anywhere in the message, so each
+        # string is written as soon as it is first used
+        def string(s):
+            index = strings.get(s)
+            if index is None:
+                index = strings[s] = len(strings)
+                out.write(_message((6, s.encode('utf-8'))))
+            return index
+
+        string('')
+        for type_, unit in (('calls', 'count'), ('samples', 'count')):
+            out.write(_message(
+                (1, _message((1, string(type_)), (2, string(unit))))
+            ))
+        total_time = string('total_time')
+        ppm = string('ppm')
+
+        for _, function in sorted_iteritems(profile.functions):
+            location_id = function.id + 1
+            if self.strip:
+                name = function.stripped_name()
+            else:
+                name = function.name
+            out.write(_message((5, _message(
+                (1, location_id),
+                (2, string(name)),
+                (3, string(function.name)),
+                (4, string(function.filename or '')),
+            ))))
+            out.write(_message((4, _message(
+                (1, location_id),
+                (4, _message((1, location_id))),
+            ))))
+
+            for _, call in sorted_iteritems(function.calls):
+                fields = [
+                    (1, [call.callee_id + 1, location_id]),
+                    (2, [
+                        int(call.events.get(CALLS, 0)),
+                        int(call.events.get(SAMPLES2, 0)),
+                    ]),
+                ]
+                if TOTAL_TIME_RATIO in call.events:
+                    fields.append((3, _message(
+                        (1, total_time),
+                        (3, int(round(call[TOTAL_TIME_RATIO] * 1e6))),
+                        (4, ppm),
+                    )))
+                out.write(_message((2, _message(*fields))))
+
+        out.close()
+
+
+class CallgrindWriter:
+    """Writer for the callgrind format read by KCachegrind.
+
+    The self cost of a function is its samples, and the inclusive cost of
+    a call its total time ratio applied to the samples of the profile.
+
+    See also:
+    - https://valgrind.org/docs/manual/cl-format.html
+    """
+
+    strip = False
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def graph(self, profile, theme=None):
+        total = profile.events.get(SAMPLES, 0)
+        self.fp.write(
+            '# callgrind format\n'
+            'version: 1\n'
+            'creator: afgprof2dot\n'
+            'positions: line\n'
+            'events: Samples\n'
+            'summary: %d\n'
+            '\n' % total
+        )
+
+        named = set()
+
+        def name(function):
+            # names are given once and referred to by number afterwards
+            if function.id in named:
+                return '(%d)' % function.id
+            named.add(function.id)
+            if self.strip:
+                return '(%d) %s' % (function.id, function.stripped_name())
+            return '(%d) %s' % (function.id, function.name)
+
+        lines = []
+        for _, function in sorted_iteritems(profile.functions):
+            lines.append('fn=' + name(function))
+            lines.append('0 %d' % function.events.get(SAMPLES, 0))
+            for _, call in sorted_iteritems(function.calls):
+                callee = profile.functions[call.callee_id]
+                inclusive = call.events.get(TOTAL_TIME_RATIO, 0.0) * total
+                lines.append('cfn=' + name(callee))
+                lines.append('calls=%d 0' % call.events.get(CALLS, 0))
+                lines.append('0 %d' % int(round(inclusive)))
+            lines.append('')
+            if len(lines) >= 4096:
+                self.fp.write('\n'.join(lines))
+                del lines[:]
+        self.fp.write('\n'.join(lines))
 
 ########################################################################
 # Main program
 
 
+def write_graph(
+        profile,
+        fp,
+        output_format='dot',
+        theme=None,
+        strip=False,
+        wrap=False,
+        show_samples=False,
+        diff=False
+):
+    """Write profile to fp as dot, pprof or callgrind.
+
+    fp is a binary file for pprof and a text file otherwise.  With diff,
+    profile comes from diff_profiles and its changes are shown, which only
+    dot supports.
+    """
+
+    if output_format == 'pprof':
+        writer = PprofWriter(fp)
+    elif output_format == 'callgrind':
+        writer = CallgrindWriter(fp)
+    elif output_format == 'dot':
+        writer = DotWriter(fp)
+        writer.wrap = wrap
+        if diff:
+            writer.show_function_events = [
+                TOTAL_TIME_RATIO, DELTA_TOTAL_TIME_RATIO,
+                TOTAL_TIME_RATIO_CHANGE
+            ]
+            writer.show_edge_events = [CALLS, DELTA_CALLS, CALLS_CHANGE]
+            if show_samples:
+                writer.show_function_events.append(DELTA_SAMPLES)
+        elif show_samples:
+            writer.show_function_events = \
+                writer.show_function_events + [SAMPLES]
+    else:
+        raise ValueError('unknown output format %r' % output_format)
+    if diff and output_format != 'dot':
+        raise ValueError('a diff can only be written as dot')
+    if theme is None:
+        theme = DIFF_COLORMAP if diff else TEMPERATURE_COLORMAP
+
+    writer.strip = strip
+    writer.graph(profile, theme)
+
+
 def naturalJoin(values):
     if len(values) >= 2:
         return ', '.join(values[:-1]) + ' or ' + values[-1]
@@ -1304,7 +2196,7 @@ def main():
 
     global totalMethod
 
-    optparser = optparse.OptionParser(usage="\n\t%prog [options] [file] ...")
+    optparser = optparse.OptionParser(usage="\n\t%prog [options] [file | capture directory ...]")
     optparser.add_option(
         '-o',
         '--output',
@@ -1345,8 +2237,8 @@ def main():
         type="choice",
         choices=('color', 'pink', 'gray', 'bw', 'print'),
         dest="theme",
-        default="color",
-        help="color map: color, pink, gray, bw, or print [default: %default]"
+        help="color map: color, pink, gray, bw, or print [default: color]; "
+        "--diff has a color map of its own"
     )
     optparser.add_option(
         '-s',
@@ -1376,17 +2268,23 @@ def main():
         '-z',
         '--root',
         type="string",
+        action="append",
         dest="root",
-        default="",
-        help="prune call graph to show only descendants of specified root function"
+        default=[],
+        help="prune call graph to show only descendants of specified root function; "
+        "NAME matches a name, PREFIX* a name prefix and re:REGEX searches names; "
+        "may be repeated"
     )
     optparser.add_option(
         '-l',
         '--leaf',
         type="string",
+        action="append",
         dest="leaf",
-        default="",
-        help="prune call graph to show only ancestors of specified leaf function"
+        default=[],
+        help="prune call graph to show only ancestors of specified leaf function, "
+        "matched like --root; may be repeated. "
+        "With --root, show the call paths from the roots to the leaves"
     )
     # add a new option to control skew of the colorization curve
     optparser.add_option(
@@ -1396,47 +2294,192 @@ def main():
         default=1.0,
         help="skew the colorization curve.  Values < 1.0 give more variety to lower percentages.  Values > 1.0 give less variety to lower percentages"
     )
+    optparser.add_option(
+        '--diff',
+        metavar='BASELINE',
+        type="string",
+        dest="diff",
+        help="compare the input with the BASELINE profile: show the changes in calls, samples and total time, colored by the change"
+    )
+    optparser.add_option(
+        '--regressions',
+        metavar='N',
+        type="int",
+        dest="regressions",
+        default=10,
+        help="with --diff, list the top N regressions on stderr [default: %default]"
+    )
+    optparser.add_option(
+        '--stats',
+        metavar='FILE',
+        type="string",
+        dest="stats",
+        help="write timing and memory statistics of each stage to FILE as JSON"
+    )
+    optparser.add_option(
+        '--profile-stage',
+        metavar='STAGE',
+        type="choice",
+        choices=('read', 'translate', 'symbolize', 'demangle', 'calls', 'build', 'cycles', 'ratios', 'integrate', 'baseline', 'diff', 'prune', 'graph'),
+        action="append",
+        dest="profile_stages",
+        default=[],
+        help="run STAGE under cProfile and save the profile next to the --stats file; may be repeated"
+    )
+    optparser.add_option(
+        '--output-format',
+        type="choice",
+        choices=('dot', 'pprof', 'callgrind'),
+        dest="output_format",
+        default="dot",
+        help="output format: dot, gzipped pprof profile.proto, or callgrind for KCachegrind; "
+        "pprof and callgrind suit graphs too large for Graphviz [default: %default]"
+    )
+    optparser.add_option(
+        '--objdir',
+        metavar='DIRECTORY',
+        type="string",
+        dest="objdir",
+        default='.',
+        help="when the inputs are afgprof capture directories, read and symbolize them in-process, "
+        "finding unstripped objects in DIRECTORY [default: %default]"
+    )
+    optparser.add_option(
+        '--symbolizer',
+        type="choice",
+        choices=('addr2line', 'elf'),
+        dest="symbolizer",
+        default='addr2line',
+        help="with capture directories, resolve symbols with addr2line processes, or by reading "
+        "the ELF symbol table and DWARF line programs in-process, like afgprof.py [default: %default]"
+    )
+    optparser.add_option(
+        '--addr2line',
+        metavar='COMMAND',
+        type="string",
+        dest="addr2line",
+        default=afgprof.ADDR2LINE,
+        help="addr2line command [default: %default]"
+    )
+    optparser.add_option(
+        '-j',
+        metavar='N',
+        type="int",
+        dest="jobs",
+        default=1,
+        help="with capture directories, spawn N addr2line processes and read captures in N workers; "
+        "less than 1 means the number of CPUs [default: %default]"
+    )
+    optparser.add_option(
+        '--cache',
+        action="store_true",
+        dest="cache",
+        default=False,
+        help="reuse symbolization results across runs, keyed by the build-id of each object, "
+        "in the database afgprof.py --cache uses"
+    )
+    optparser.add_option(
+        '--cache-dir',
+        metavar='DIRECTORY',
+        type="string",
+        dest="cache_dir",
+        default=afgprof.CACHE_DIR,
+        help="directory of the --cache database [default: %default]"
+    )
+    optparser.add_option(
+        '--cache-size',
+        metavar='ENTRIES',
+        type="int",
+        dest="cache_size",
+        default=afgprof.CACHE_SIZE,
+        help="evict the least recently used results past this many [default: %default]"
+    )
+    optparser.add_option(
+        '--numpy',
+        action="store_true",
+        dest="numpy",
+        default=False,
+        help="compute call ratios with NumPy, faster on large profiles; total times are integrated in Python either way"
+    )
     (options, args) = optparser.parse_args(sys.argv[1:])
 
-    try:
-        theme = themes[options.theme]
-    except KeyError:
-        optparser.error('invalid colormap \'%s\'' % options.theme)
+    if options.numpy and numpy is None:
+        optparser.error('--numpy requires NumPy to be installed')
+    if options.diff and options.output_format != 'dot':
+        optparser.error('--diff can only be written as dot')
+    if options.diff and options.theme is not None:
+        optparser.error('--colormap cannot be used with --diff')
+
+    if options.diff:
+        theme = DIFF_COLORMAP
+    else:
+        try:
+            theme = themes[options.theme or 'color']
+        except KeyError:
+            optparser.error('invalid colormap \'%s\'' % options.theme)
 
-    # set skew on the theme now that it has been picked.
+    # set skew on a copy of the theme, leaving the shared one untouched
+    theme = copy.copy(theme)
     if options.theme_skew:
         theme.skew = options.theme_skew
 
     totalMethod = options.totalMethod
 
-    Format = AfgprofParser
-
-    if Format.stdinInput:
-        if not args:
-            fp = sys.stdin
-        elif PYTHON_3:
-            fp = open(args[0], 'rt', encoding='UTF-8')
-        else:
-            fp = open(args[0], 'rt')
-        parser = Format(fp)
-    elif Format.multipleInput:
-        if not args:
-            optparser.error(
-                'at least a file must be specified for %s input' %
-                options.format
-            )
-        parser = Format(*args)
+    if options.stats:
+        stats = afgprof.Stats(
+            trace_memory=True,
+            profile_stages=options.profile_stages,
+            prefix=options.stats,
+        )
+    elif options.profile_stages:
+        optparser.error('--profile-stage requires --stats')
     else:
-        if len(args) != 1:
-            optparser.error(
-                'exactly one file must be specified for %s input' %
-                options.format
-            )
-        parser = Format(args[0])
-
-    profile = parser.parse()
-
-    if options.output is None:
+        stats = NullStats()
+
+    directories = [path for path in args if os.path.isdir(path)]
+    if directories and len(directories) != len(args):
+        optparser.error('give either capture directories or a profile, not both')
+    if not directories and len(args) > 1:
+        optparser.error('only one profile can be read at a time')
+
+    def parse(paths, stats=None):
+        if paths and all(os.path.isdir(path) for path in paths):
+            # capture directories, symbolized in-process
+            workers = options.jobs if options.jobs > 0 else None
+            if options.cache:
+                cache = afgprof.SymbolCache(options.cache_dir, options.cache_size)
+            else:
+                cache = None
+            try:
+                return load_profile(
+                    paths,
+                    options.objdir,
+                    afgprof.get_symbolizer(
+                        options.symbolizer, options.addr2line, options.jobs
+                    ),
+                    options.symbolizer,
+                    cache=cache,
+                    stats=stats,
+                    use_numpy=options.numpy,
+                    workers=workers,
+                )
+            finally:
+                if cache is not None:
+                    cache.close()
+        if not paths:
+            # binary, so that AfgprofParser can tell the input format
+            return AfgprofParser(sys.stdin.buffer, stats, options.numpy).parse()
+        with open(paths[0], 'rb') as fp:
+            return AfgprofParser(fp, stats, options.numpy).parse()
+
+    profile = parse(args, stats)
+
+    if options.output_format == 'pprof':
+        if options.output is None:
+            output = sys.stdout.buffer
+        else:
+            output = open(options.output, 'wb')
+    elif options.output is None:
         output = sys.stdout
     else:
         if PYTHON_3:
@@ -1444,43 +2487,56 @@ def main():
         else:
             output = open(options.output, 'wt')
 
-    dot = DotWriter(output)
-    dot.strip = options.strip
-    dot.wrap = options.wrap
-    if options.show_samples:
-        dot.show_function_events.append(SAMPLES)
-
-    profile = profile
-    profile.prune(options.node_thres / 100.0, options.edge_thres / 100.0)
-
-    if options.root:
-        rootId = profile.getFunctionId(options.root)
-        if not rootId:
-            sys.stderr.write(
-                'root node ' + options.root +
-                ' not found (might already be pruned : try -e0 -n0 flags)\n'
+    if options.diff:
+        with stats.stage('baseline'):
+            baseline = parse([options.diff])
+        with stats.stage('diff'):
+            profile = diff_profiles(baseline, profile)
+            report_regressions(profile, options.regressions, sys.stderr)
+
+    with stats.stage('prune'):
+        if options.diff:
+            # diff_profiles() has weighed the profile already
+            profile.prune_weights(
+                options.node_thres / 100.0, options.edge_thres / 100.0
             )
-            sys.exit(1)
-        profile.prune_root(rootId)
-    if options.leaf:
-        leafId = profile.getFunctionId(options.leaf)
-        if not leafId:
+            diff_weigh(profile)
+        else:
+            profile.prune(
+                options.node_thres / 100.0, options.edge_thres / 100.0
+            )
+
+        try:
+            profile.prune_names(options.root, options.leaf)
+        except ValueError as error:
             sys.stderr.write(
-                'leaf node ' + options.leaf +
-                ' not found (maybe already pruned : try -e0 -n0 flags)\n'
+                str(error) +
+                ' (might already be pruned : try -e0 -n0 flags)\n'
             )
             sys.exit(1)
-        profile.prune_leaf(leafId)
 
-    dot.graph(profile, theme)
+    with stats.stage('graph'):
+        write_graph(
+            profile,
+            output,
+            options.output_format,
+            theme,
+            options.strip,
+            options.wrap,
+            options.show_samples,
+            bool(options.diff),
+        )
+    output.flush()
+
+    stats.counters['graph_functions'] = len(profile.functions)
+    stats.counters['graph_calls'] = sum(
+        len(function.calls)
+        for function in compat_itervalues(profile.functions)
+    )
+    if options.stats:
+        with open(options.stats, 'w') as fp:
+            stats.write(fp)
 
 
 if __name__ == '__main__':
     main()
-else:
-    # Importing this module is unsupported.  It more robust and equally easy to
-    # do
-    #
-    #   subprocess.call([sys.executable, 'gprof2dot.py', ...])
-    #
-    raise Exception('using gprof2dot.py as a module is unsupported')
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Benchmark the afgprof post-processing pipeline on synthetic captures.
+
+A capture directory with a maps file and a calls file is generated from
+the given shape, then each stage of afgprof is timed separately with
+afgprof.Stats, as afgprof --stats does:
+
+* read: reading and aggregating the calls file
+* translate: parsing maps and translating addresses to objects
+* symbolize: resolving symbols with fake_addr2line.py
+* write: writing the JSON output
+
+One JSON object per run is appended to the results file.  The peak_rss_kib
+of each stage is the peak RSS of the process so far; that is a high-water
+mark of the whole run, so it only shows the stage that raised it.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+import afgprof  # noqa: E402
+
+# modules are mapped this far apart, from this base address
+MODULE_STRIDE = 0x01000000
+MODULE_BASE = 0x40000000
+
+
+def generate(directory, records, arcs, modules, spread, seed):
+    """Write a synthetic capture to directory.
+
+    Empty files stand in for the mapped objects in directory/obj, which is
+    returned.  Arc endpoints are drawn from the first spread bytes of each
+    module's executable mapping.  Every one of the arcs is recorded at least
+    once, at a random position; the other records are drawn from the arcs
+    with a skewed distribution, so that hot arcs repeat as in real captures.
+    """
+    if records < arcs:
+        raise ValueError(
+            '{} records cannot hold {} arcs'.format(records, arcs)
+        )
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    objdir = directory / 'obj'
+    objdir.mkdir(exist_ok=True)
+
+    with (directory / 'maps').open('w') as file:
+        for module in range(modules):
+            start = MODULE_BASE + module * MODULE_STRIDE
+            name = 'lib{}.so'.format(module)
+            file.write(
+                '{:08x}-{:08x} r-xp 00001000 fd:01 {} /system/lib/{}\n'.format(
+                    start, start + spread, 1000 + module, name
+                )
+            )
+            (objdir / name).touch()
+        file.write('bee00000-bee21000 rw-p 00000000 00:00 0 [stack]\n')
+
+    def address():
+        module = rng.randrange(modules)
+        return MODULE_BASE + module * MODULE_STRIDE + rng.randrange(spread)
+
+    pool = set()
+    while len(pool) < arcs:
+        pool.add((address(), address()))
+    pool = list(pool)
+    rng.shuffle(pool)
+
+    record = afgprof.CALL_RECORD
+    unseen = 0
+    with (directory / 'calls').open('wb') as file:
+        buffer = bytearray()
+        for i in range(records):
+            # the first appearance of the arcs, spread over the whole file;
+            # certain once only as many records as unseen arcs remain
+            if not unseen or (
+                    unseen < arcs
+                    and rng.random() * (records - i) < arcs - unseen
+            ):
+                lr, pc = pool[unseen]
+                unseen += 1
+            else:
+                lr, pc = pool[(int(rng.paretovariate(1.2)) - 1) % unseen]
+            buffer += record.pack(lr, pc, rng.randrange(1, 8))
+            if len(buffer) >= 1 << 20:
+                file.write(buffer)
+                buffer.clear()
+        file.write(buffer)
+    assert unseen == arcs
+    return objdir
+
+
+def run(options, directory):
+    objdir = generate(
+        directory,
+        options.records,
+        options.arcs,
+        options.modules,
+        options.spread,
+        options.seed,
+    )
+    stats = afgprof.Stats()
+
+    index, arcs = afgprof.read_capture(
+        directory,
+        stream=options.stream,
+        use_numpy=options.numpy,
+        memory_budget=options.memory_budget << 20,
+        chunk_size=options.chunk_size,
+        stats=stats,
+    )
+    if len(arcs) != options.arcs:
+        raise Exception(
+            'read {} unique arcs, generated {}'.format(len(arcs), options.arcs)
+        )
+
+    os.environ['FAKE_ADDR2LINE_LATENCY'] = str(options.latency)
+    symbolizer = afgprof.Addr2line(str(HERE / 'fake_addr2line.py'), options.j)
+    with stats.stage('symbolize'):
+        afgprof.symbolize_index(
+            index, symbolizer, 'addr2line', objdir, stats=stats
+        )
+
+    with stats.stage('write'):
+        with open(os.devnull, 'w') as file:
+            afgprof.write_json(file, index, arcs)
+
+    for name, stage in stats.stages.items():
+        print(
+            '{}: {:.3f}s'.format(name, stage['wall_seconds']),
+            file=sys.stderr,
+        )
+    return {
+        'records': options.records,
+        'unique_arcs': len(arcs),
+        'unique_addresses': len(index),
+        'stages': stats.stages,
+        'workers': stats.counters.get('workers'),
+        'worker_utilization': stats.counters.get('worker_utilization'),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(HERE),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        allow_abbrev=False,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--records', type=int, default=1000000, help='records in calls'
+    )
+    parser.add_argument(
+        '--arcs', type=int, default=50000, help='distinct (lr, pc) arcs'
+    )
+    parser.add_argument(
+        '--modules', type=int, default=8, help='number of mapped objects'
+    )
+    parser.add_argument(
+        '--spread',
+        type=int,
+        default=1 << 20,
+        help='bytes of each object addresses are drawn from'
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--numpy',
+        action='store_true',
+        help='read and translate with NumPy, like afgprof --numpy'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='read the calls file in chunks, like afgprof --stream'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        metavar='RECORDS',
+        type=int,
+        default=1 << 20,
+        help='records aggregated at a time with --stream'
+    )
+    parser.add_argument(
+        '--memory-budget',
+        metavar='MIB',
+        type=int,
+        default=1024,
+        help='memory budget of --stream'
+    )
+    parser.add_argument(
+        '--latency',
+        metavar='SECONDS',
+        type=float,
+        default=0.0,
+        help='time the fake addr2line takes per address'
+    )
+    parser.add_argument(
+        '-j',
+        metavar='N',
+        type=int,
+        default=1,
+        help='number of fake addr2line processes'
+    )
+    parser.add_argument(
+        '--workdir',
+        metavar='DIRECTORY',
+        help='where to generate the capture, a temporary directory by default'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='FILE',
+        default='bench_results.jsonl',
+        help='append the results to FILE as one line of JSON'
+    )
+    return parser
+
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+    if options.numpy and afgprof.numpy is None:
+        sys.exit('NumPy is not installed')
+    if options.records < options.arcs:
+        parser.error('--records must be at least --arcs')
+
+    if options.workdir is None:
+        with tempfile.TemporaryDirectory(prefix='afgprof-bench-') as workdir:
+            results = run(options, pathlib.Path(workdir))
+    else:
+        results = run(options, pathlib.Path(options.workdir))
+
+    results.update(
+        timestamp=time.time(),
+        revision=git_revision(),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        options=vars(options),
+    )
+    with open(options.output, 'a') as file:
+        file.write(json.dumps(results, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
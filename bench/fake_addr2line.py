@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""Stand-in for ``addr2line -f -e FILE`` reading addresses from stdin.
+
+Every address resolves to a made-up function and line.  Set
+FAKE_ADDR2LINE_LATENCY to the number of seconds each lookup should take.
+"""
+
+import os
+import sys
+import time
+
+
+def main():
+    latency = float(os.environ.get('FAKE_ADDR2LINE_LATENCY', 0))
+    filename = os.path.basename(sys.argv[-1])
+    for line in sys.stdin:
+        address = int(line, 16)
+        if latency:
+            time.sleep(latency)
+        sys.stdout.write(
+            'fn_{:x}\n{}.c:{}\n'.format(
+                address >> 6, filename, address % 1000 + 1
+            )
+        )
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
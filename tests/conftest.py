@@ -0,0 +1,37 @@
+import pathlib
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import afgprof  # noqa: E402
+
+CC = shutil.which('gcc') or shutil.which('cc')
+
+
+def make_capture(directory, maps, records):
+    """Write a capture with the given maps lines and calls records."""
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / 'maps').write_text(''.join(line + '\n' for line in maps))
+    with (directory / 'calls').open('wb') as file:
+        for record in records:
+            file.write(afgprof.CALL_RECORD.pack(*record))
+    return directory
+
+
+def compile_object(output, source, *flags, suffix='.c'):
+    """Build a shared object from C (or, with suffix='.cpp', C++) source,
+    skipping the test without a compiler."""
+    if CC is None:
+        pytest.skip('no C compiler')
+    source_file = output.with_suffix(suffix)
+    source_file.write_text(source)
+    subprocess.run(
+        [CC, '-shared', '-fPIC', '-o', str(output), str(source_file)] +
+        list(flags),
+        check=True,
+    )
+    return output
@@ -0,0 +1,170 @@
+import io
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import afgprof
+import afgprof2dot
+from conftest import compile_object, make_capture
+
+INDEX = {
+    0x1000: {'pathname': '/lib/a.so', 'offset': 0x10, 'symbol': 'main',
+             'location': 'a.c:1'},
+    0x2000: {'pathname': '/lib/a.so', 'offset': 0x20, 'symbol': 'parse',
+             'location': 'a.c:2'},
+    0x3000: {'pathname': '/lib/b.so', 'offset': 0x30, 'symbol': 'malloc',
+             'location': 'b.c:3'},
+    0x4000: {'pathname': None, 'offset': 0x4000},
+}
+ARCS = [
+    ((0x1000, 0x2000), 10),
+    ((0x2000, 0x3000), 6),
+    ((0x1000, 0x3000), 2),
+    ((0x4000, 0x1000), 1),
+]
+CALLS = [
+    ('main', 'parse', 10),
+    ('parse', 'malloc', 6),
+    ('main', 'malloc', 2),
+    ('?', 'main', 1),
+]
+
+
+def profile_bytes(format_, **kwargs):
+    file = io.BytesIO()
+    afgprof.write_profile(file, INDEX, ARCS, format_, **kwargs)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize('format_, kwargs', [
+    ('json', {}),
+    ('json', {'string_table': True}),
+    ('binary', {}),
+])
+def test_read_calls(format_, kwargs):
+    parser = afgprof2dot.AfgprofParser(
+        io.BytesIO(profile_bytes(format_, **kwargs))
+    )
+    assert parser.read_calls() == CALLS
+
+
+SOURCE = '''\
+int leaf(int x) { return x + 1; }
+int middle(int x) { return leaf(x) * 2; }
+int top(int x) { return middle(x) + leaf(x); }
+'''
+
+
+def summary(profile):
+    """{name: total time ratio} and {(caller, callee): calls}."""
+    functions = profile.functions
+    totals = {
+        function.name: function[afgprof2dot.TOTAL_TIME_RATIO]
+        for function in functions.values()
+    }
+    calls = {
+        (function.name, functions[callee_id].name): call[afgprof2dot.CALLS]
+        for function in functions.values()
+        for callee_id, call in function.calls.items()
+    }
+    return totals, calls
+
+
+def test_load_profile_matches_json(tmp_path):
+    objdir = tmp_path / 'obj'
+    objdir.mkdir()
+    obj = compile_object(objdir / 'liba.so', SOURCE, '-g')
+    table = afgprof.ElfSymbolizer().load(str(obj))[0]
+    address = {
+        name: 0x40000000 + start
+        for name, start in zip(table.names, table.starts)
+    }
+    maps = ['40000000-40100000 r-xp 00000000 fd:01 1000 /data/app/liba.so']
+    for pid, records in (
+            ('100', [(address['top'] + 4, address['middle'], 3),
+                     (address['middle'] + 4, address['leaf'], 3)]),
+            ('200', [(address['top'] + 8, address['leaf'], 2),
+                     (0x1000, address['top'], 1)]),
+    ):
+        make_capture(tmp_path / 'gmon' / pid, maps, records)
+
+    output = subprocess.run(
+        [sys.executable, afgprof.__file__, '--symbolizer', 'elf',
+         '--objdir', str(objdir), str(tmp_path / 'gmon')],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+    ).stdout
+    expected = afgprof2dot.AfgprofParser(io.BytesIO(output)).parse()
+    profile = afgprof2dot.load_profile(
+        [str(tmp_path / 'gmon')], str(objdir), symbolizer='elf'
+    )
+
+    totals, calls = summary(profile)
+    expected_totals, expected_calls = summary(expected)
+    assert calls == expected_calls == {
+        ('top', 'middle'): 3, ('middle', 'leaf'): 3, ('top', 'leaf'): 2,
+        ('?', 'top'): 1,
+    }
+    assert totals == pytest.approx(expected_totals)
+
+    # afgprof2dot given the captures draws the same graph as from the JSON
+    def afgprof2dot_output(*args, **kwargs):
+        return subprocess.run(
+            [sys.executable, afgprof2dot.__file__] + list(args),
+            stdout=subprocess.PIPE, check=True, **kwargs
+        ).stdout
+    dot = afgprof2dot_output(input=output)
+    assert b'label="middle' in dot
+    assert afgprof2dot_output(
+        '--symbolizer', 'elf', '--objdir', str(objdir),
+        str(tmp_path / 'gmon'), stderr=subprocess.DEVNULL,
+    ) == dot
+    if shutil.which('addr2line') is not None:
+        for _ in range(2):
+            assert afgprof2dot_output(
+                '--addr2line', 'addr2line', '--cache', '--cache-dir',
+                str(tmp_path / 'cache'), '--objdir', str(objdir),
+                str(tmp_path / 'gmon'), stderr=subprocess.DEVNULL,
+            ) == dot
+        assert (tmp_path / 'cache' / 'symbols.sqlite3').exists()
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['afgprof2dot.py'] + list(args))
+    afgprof2dot.main()
+
+
+def test_diff_rejects_colormap(tmp_path, monkeypatch, capsys):
+    profile = tmp_path / 'profile.json'
+    profile.write_bytes(profile_bytes('json'))
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, '-c', 'gray', '--diff', str(profile),
+                 str(profile))
+    assert '--colormap cannot be used with --diff' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('args', [[], ['--diff', 'PROFILE'], ['-c', 'bw']])
+def test_skew_leaves_themes_untouched(tmp_path, monkeypatch, args):
+    profile = tmp_path / 'profile.json'
+    profile.write_bytes(profile_bytes('json'))
+    args = [str(profile) if arg == 'PROFILE' else arg for arg in args]
+    run_main(monkeypatch, '--skew', '2.5', '-o', str(tmp_path / 'out.dot'),
+             *(args + [str(profile)]))
+    assert (tmp_path / 'out.dot').read_text().startswith('digraph')
+    for theme in list(afgprof2dot.themes.values()) + \
+            [afgprof2dot.DIFF_COLORMAP]:
+        assert theme.skew == 1.0
+
+
+@pytest.mark.parametrize('inputs, message', [
+    (['one.json', 'two.json'], 'only one profile'),
+    (['one.json', 'gmon'], 'either capture directories or a profile'),
+])
+def test_inputs_are_checked(tmp_path, monkeypatch, capsys, inputs, message):
+    (tmp_path / 'gmon').mkdir()
+    for name in ('one.json', 'two.json'):
+        (tmp_path / name).write_bytes(profile_bytes('json'))
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, *[str(tmp_path / path) for path in inputs])
+    assert message in capsys.readouterr().err
@@ -0,0 +1,100 @@
+import itertools
+
+import pytest
+
+import afgprof
+from conftest import compile_object
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    # strictly increasing times, so that the least recently used is known
+    clock = itertools.count()
+    monkeypatch.setattr(afgprof.time, 'time', lambda: next(clock))
+    cache = afgprof.SymbolCache(str(tmp_path / 'cache'), 1000)
+    yield cache
+    cache.close()
+
+
+def results(offsets):
+    return [
+        (offset, 'f{}'.format(offset), 'f.c:{}'.format(offset))
+        for offset in offsets
+    ]
+
+
+def test_lookup_in_batches(cache):
+    offsets = range(cache.batch + 10)
+    cache.store('a', results(offsets))
+    found = cache.lookup('a', list(offsets) + [-1])
+    assert found == {
+        offset: (symbol, location)
+        for offset, symbol, location in results(offsets)
+    }
+    assert cache.lookup('b', offsets) == {}
+    assert (cache.hits, cache.misses) == (len(offsets), len(offsets) + 1)
+
+
+def test_least_recently_used_are_evicted(cache):
+    cache.store('a', results(range(400)))
+    cache.store('b', results(range(400)))
+    # using the first half of a makes it more recent than b
+    cache.lookup('a', range(200))
+    cache.store('c', results(range(600)))
+
+    assert len(cache.lookup('a', range(200))) == 200
+    assert cache.lookup('a', range(200, 400)) == {}
+    assert len(cache.lookup('b', range(400))) == 200
+    assert len(cache.lookup('c', range(600))) == 600
+
+
+def test_object_id(tmp_path):
+    with_id = compile_object(
+        tmp_path / 'libid.so', 'int f(void) { return 1; }',
+        '-Wl,--build-id=sha1'
+    )
+    assert afgprof.object_id(str(with_id)).startswith('build-id:')
+
+    other = tmp_path / 'other'
+    other.write_bytes(b'one')
+    first = afgprof.object_id(str(other))
+    assert first.startswith('sha1:')
+    other.write_bytes(b'two')
+    assert afgprof.object_id(str(other)) != first
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """Record the commands run by afgprof."""
+    commands = []
+    run = afgprof.subprocess.run
+
+    def record(args, **kwargs):
+        commands.append(args)
+        return run(args, **kwargs)
+    monkeypatch.setattr(afgprof.subprocess, 'run', record)
+    return commands
+
+
+NAMES = ['_ZN2ns4workERSt6vectorIiSaIiEE', '_Z5entryi', 'malloc', '_Z5entryi']
+DEMANGLED = {
+    '_ZN2ns4workERSt6vectorIiSaIiEE': 'ns::work(std::vector<int, '
+    'std::allocator<int> >&)',
+    '_Z5entryi': 'entry(int)',
+    'malloc': 'malloc',
+}
+
+
+def test_demangle_once(cache, runs):
+    if afgprof.shutil.which('c++filt') is None:
+        pytest.skip('no c++filt')
+    demangler = afgprof.Demangler('c++filt', cache)
+    assert demangler.demangle(NAMES) == DEMANGLED
+    assert demangler.demangle(NAMES) == DEMANGLED
+    assert afgprof.Demangler('c++filt', cache).demangle(NAMES) == DEMANGLED
+    assert runs == [['c++filt']]
+
+
+def test_demangle_without_command():
+    with pytest.raises(Exception, match='not found'):
+        afgprof.Demangler('no-such-c++filt')
@@ -0,0 +1,45 @@
+import pytest
+
+import afgprof
+from conftest import make_capture
+
+MAPS = [
+    '40000000-40100000 r-xp 00001000 fd:01 1000 /system/lib/liba.so',
+    '50000000-50100000 r-xp 00000000 fd:01 1001 /vendor/lib/liba.so',
+]
+
+
+def test_empty_captures_are_skipped(tmp_path, capsys):
+    full = make_capture(tmp_path / '1', MAPS, [(0x40000010, 0x50000020, 3)])
+    make_capture(tmp_path / '2', MAPS, [])
+
+    assert afgprof.find_captures([tmp_path]) == [full]
+    assert 'SKIP {}: empty calls file'.format(tmp_path / '2') in \
+        capsys.readouterr().err
+
+    with pytest.raises(Exception, match='no calls recorded'):
+        afgprof.find_captures([tmp_path / '2'])
+
+
+def test_read_calls_of_an_empty_file(tmp_path):
+    capture = make_capture(tmp_path / '1', MAPS, [])
+    assert afgprof.read_calls(capture / 'calls') == ([], [])
+
+
+def test_merged_captures_report_once_each(tmp_path, capfd):
+    first = make_capture(tmp_path / '1', MAPS, [(0x40000010, 0x50000020, 3)])
+    second = make_capture(tmp_path / '2', MAPS, [
+        (0x40000010, 0x50000020, 1),
+        (0x50000020, 0x40000030, 2),
+    ])
+    index, arcs = afgprof.load_captures([tmp_path], workers=2)
+
+    err = capfd.readouterr().err
+    # no progress bars from the workers
+    assert '%' not in err
+    assert 'READ {}: 1 arcs'.format(first) in err
+    assert 'READ {}: 2 arcs'.format(second) in err
+    assert sorted(
+        ((index[lr]['offset'], index[pc]['offset']), count)
+        for (lr, pc), count in arcs
+    ) == [((0x20, 0x1030), 2), ((0x1010, 0x20), 4)]
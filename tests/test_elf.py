@@ -0,0 +1,205 @@
+import shutil
+import subprocess
+
+import pytest
+
+import afgprof
+from conftest import compile_object
+
+ADDR2LINE = shutil.which('addr2line')
+
+HEADER = '''\
+static inline int twice(int x)
+{
+    return 2 * x;
+}
+'''
+
+C_SOURCE = '''\
+#include "twice.h"
+
+static int counter;
+
+static inline int square(int x)
+{
+    return x * x;
+}
+
+int accumulate(const int *values, int n)
+{
+    int sum = 0;
+    for (int i = 0; i < n; i++)
+        sum += square(values[i]) + twice(values[i]);
+    counter += sum;
+    return sum;
+}
+
+static int helper(int x)
+{
+    if (x > 10)
+        return accumulate(&x, 1);
+    return x - 1;
+}
+
+int entry(int x)
+{
+    return helper(x) + helper(x + 1);
+}
+'''
+
+CXX_SOURCE = '''\
+#include <algorithm>
+#include <map>
+#include <string>
+#include <vector>
+
+namespace ns {
+template <typename T> static inline T twice(T x) { return x + x; }
+
+struct Counter {
+    std::map<std::string, int> counts;
+    void add(const std::string &name) { counts[name] += twice(1); }
+};
+
+int work(std::vector<int> &values)
+{
+    std::sort(values.begin(), values.end());
+    int total = 0;
+    for (int v : values)
+        total += twice(v);
+    return total;
+}
+}
+
+int entry(int n)
+{
+    ns::Counter counter;
+    std::vector<int> values(n);
+    for (int i = 0; i < n; i++) {
+        values[i] = n - i;
+        counter.add(std::to_string(i % 3));
+    }
+    return ns::work(values) + counter.counts.size();
+}
+'''
+
+
+def build(tmp_path, *flags, strip=False):
+    (tmp_path / 'twice.h').write_text(HEADER)
+    output = compile_object(tmp_path / 'libtest.so', C_SOURCE, *flags)
+    if strip:
+        if shutil.which('strip') is None:
+            pytest.skip('no strip')
+        subprocess.run(['strip', '--strip-debug', str(output)], check=True)
+    return str(output)
+
+
+def text_addresses(filename):
+    text = afgprof.ElfFile(filename).section_by_name['.text']
+    return list(range(text.address, text.address + text.size))
+
+
+def compare(filename, symbolizer):
+    """Return the addresses of .text symbolized differently from addr2line,
+    leaving out the known differences."""
+    if ADDR2LINE is None:
+        pytest.skip('no addr2line')
+    addresses = text_addresses(filename)
+    expected = sorted(
+        afgprof.Addr2line(ADDR2LINE, 1).find_symbol_and_line(
+            filename, addresses
+        )
+    )
+    results = symbolizer.find_symbol_and_line(filename, addresses)
+    assert [address for address, _, _ in results] == addresses
+
+    if isinstance(symbolizer, afgprof.ElfSymbolizer):
+        symbols, info = symbolizer.load(filename)
+    mismatches = []
+    for (address, symbol, location), (_, want_symbol, want_location) in zip(
+        results, expected
+    ):
+        if (symbol, location) == (want_symbol, want_location):
+            continue
+        if isinstance(symbolizer, afgprof.ElfSymbolizer):
+            # binutils 2.35+ misnames DWARF 5 file 0
+            if (symbol == want_symbol and
+                    location.rsplit(':', 1)[1] ==
+                    want_location.rsplit(':', 1)[1]):
+                continue
+            # binutils 2.30+ names inlined C functions after their DWARF
+            # name, NDK's addr2line after the symbol table
+            index = symbols.lookup(address)
+            inlined, _ = info.lookup(address)
+            if (location == want_location and index >= 0 and
+                    symbol == symbols.names[index] and
+                    inlined and want_symbol == inlined[0]):
+                continue
+        mismatches.append(
+            (hex(address), symbol, location, want_symbol, want_location)
+        )
+    return mismatches
+
+
+@pytest.mark.parametrize('flags', [
+    ('-O0', '-g'),
+    ('-O0', '-g', '-gdwarf-4'),
+    ('-O2', '-g'),
+    ('-O2', '-g', '-gdwarf-4'),
+    ('-O2',),
+])
+def test_elf_symbolizer_matches_addr2line(tmp_path, flags):
+    filename = build(tmp_path, *flags)
+    assert compare(filename, afgprof.ElfSymbolizer()) == []
+
+
+def test_elf_symbolizer_debug_stripped(tmp_path):
+    filename = build(tmp_path, '-O2', '-g', strip=True)
+    assert compare(filename, afgprof.ElfSymbolizer()) == []
+
+
+def test_elf_symbolizer_without_aranges(tmp_path):
+    # units are then found by the ranges of their unit DIE
+    filename = build(tmp_path, '-O2', '-g')
+    if shutil.which('objcopy') is None:
+        pytest.skip('no objcopy')
+    subprocess.run(
+        ['objcopy', '--remove-section', '.debug_aranges', filename],
+        check=True,
+    )
+    assert compare(filename, afgprof.ElfSymbolizer()) == []
+
+
+def test_elf_symbolizer_reads_units_lazily(tmp_path):
+    other = tmp_path / 'other.c'
+    other.write_text('int other(int x)\n{\n    return x + 1;\n}\n')
+    filename = build(tmp_path, '-O2', '-g', str(other))
+    symbolizer = afgprof.ElfSymbolizer()
+    symbols, info = symbolizer.load(filename)
+    address = symbols.starts[symbols.names.index('other')]
+    [(_, symbol, location)] = symbolizer.find_symbol_and_line(
+        filename, [address]
+    )
+    assert symbol == 'other'
+    assert location.startswith(str(other) + ':')
+    scanned = [
+        unit for unit in info.units.values()
+        if unit is not None and unit.functions is not None
+    ]
+    assert len(scanned) == 1
+    assert list(info.line_tables) == [scanned[0].stmt_list]
+
+
+def test_elf_symbolizer_cxx(tmp_path):
+    # std::sort leaves a sequence ending on a row of its own, which must
+    # not spill into the gap after it
+    filename = str(compile_object(
+        tmp_path / 'libtest.so', CXX_SOURCE, '-O2', '-g', suffix='.cpp'
+    ))
+    assert compare(filename, afgprof.ElfSymbolizer()) == []
+
+
+@pytest.mark.parametrize('flags', [('-O2',), ('-O0', '-g')])
+def test_function_symbolizer_matches_addr2line(tmp_path, flags):
+    filename = build(tmp_path, *flags, strip=True)
+    assert compare(filename, afgprof.FunctionSymbolizer()) == []
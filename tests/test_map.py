@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+import afgprof
+
+MAPS = [
+    '7f0000000000-7f0000010000 r-xp 00002000 fd:01 1234 /system/lib/libc.so',
+    '7f0000010000-7f0000011000 rw-p 00012000 fd:01 1234 /system/lib/libc.so',
+    '7f0000020000-7f0000030000 r-xp 00000000 fd:01 99   /data/app/libapp.so',
+    '7f0000040000-7f0000041000 rw-p 00000000 00:00 0 ',
+    '7fff00000000-7fff00001000 rw-p 00000000 00:00 0    [stack]',
+]
+
+
+@pytest.fixture
+def regions():
+    return afgprof.Map(afgprof.Region.fromline(line + '\n') for line in MAPS)
+
+
+@pytest.fixture
+def addresses(regions):
+    rng = random.Random(3)
+    addresses = {0, (1 << 64) - 1}
+    for region in regions.regions:
+        start, end = region.address
+        addresses.update((start - 1, start, end - 1, end))
+        addresses.update(rng.randrange(start, end) for _ in range(20))
+    addresses.update(rng.randrange(1 << 48) for _ in range(200))
+    return sorted(addresses)
+
+
+def test_fast_path_matches_pattern():
+    for line in MAPS:
+        line += '\n'
+        assert afgprof.Region.fromline(line) == \
+            afgprof.Region._fromline(line)
+
+
+def test_translate_many_matches_translate(regions, addresses):
+    expected = [regions.translate(address) for address in addresses]
+    assert regions.translate_many(addresses) == expected
+
+
+def test_translate(regions):
+    assert regions.translate(0x7f0000000010) == \
+        ('/system/lib/libc.so', 0x2010)
+    assert regions.translate(0x7f0000020010) == ('/data/app/libapp.so', 0x10)
+    assert regions.translate(0x7f0000030000) == (None, 0x7f0000030000)
+
+
+@pytest.mark.skipif(afgprof.numpy is None, reason='NumPy is not installed')
+def test_translate_many_numpy(regions, addresses):
+    assert regions.translate_many(addresses, use_numpy=True) == \
+        regions.translate_many(addresses)
@@ -0,0 +1,451 @@
+import gzip
+import io
+import pathlib
+import random
+import re
+
+import pytest
+
+import afgprof2dot
+
+# two cycles, {a, b} and {parse, expr, term, factor}, and a recursive eval
+CALLS = [
+    ('?', 'main', 1), ('main', 'init', 2), ('main', 'loop', 1),
+    ('main', 'a', 3), ('a', 'b', 30), ('b', 'a', 20), ('b', 'malloc', 5),
+    ('loop', 'parse', 100), ('loop', 'eval', 100), ('parse', 'expr', 100),
+    ('expr', 'term', 300), ('term', 'factor', 500), ('factor', 'expr', 200),
+    ('factor', 'parse', 10), ('term', 'malloc', 50), ('eval', 'eval', 400),
+    ('eval', 'malloc', 60), ('init', 'malloc', 1),
+]
+
+
+def parse(calls, **kwargs):
+    """Parse (caller, callee, count) calls with CaptureParser."""
+    ids = {}
+    for caller, callee, count in calls:
+        ids.setdefault(caller, len(ids))
+        ids.setdefault(callee, len(ids))
+    index = {id_: {'symbol': name} for name, id_ in ids.items()}
+    arcs = [((ids[caller], ids[callee]), count)
+            for caller, callee, count in calls]
+    return afgprof2dot.CaptureParser(index, arcs, **kwargs).parse()
+
+
+def random_calls(seed, size, degree):
+    rng = random.Random(seed)
+    return [
+        ('f{}'.format(caller), 'f{}'.format(callee), rng.randrange(1, 1000))
+        for caller in range(size)
+        for callee in rng.sample(range(size), rng.randrange(degree + 1))
+    ]
+
+
+def cycles(profile):
+    return sorted(
+        sorted(function.name for function in cycle.functions)
+        for cycle in profile.cycles
+    )
+
+
+def strongly_connected(calls):
+    """Sets of more than one mutually reachable function, the slow way."""
+    callees = {}
+    for caller, callee, count in calls:
+        callees.setdefault(caller, set()).add(callee)
+        callees.setdefault(callee, set())
+    reachable = {}
+    for name in callees:
+        seen = set()
+        stack = [name]
+        while stack:
+            for callee in callees[stack.pop()]:
+                if callee not in seen:
+                    seen.add(callee)
+                    stack.append(callee)
+        reachable[name] = seen
+    components = {
+        frozenset(
+            [name] + [other for other in reachable[name]
+                      if name in reachable[other]]
+        )
+        for name in callees
+    }
+    return sorted(sorted(c) for c in components if len(c) > 1)
+
+
+def test_find_cycles():
+    assert cycles(parse(CALLS)) == \
+        [['a', 'b'], ['expr', 'factor', 'parse', 'term']]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_find_cycles_matches_strongly_connected(seed):
+    calls = random_calls(seed, 200, 2)
+    assert cycles(parse(calls)) == strongly_connected(calls)
+
+
+@pytest.mark.parametrize('closed', [False, True])
+def test_deep_call_chain(closed):
+    # deeper than the recursion limit
+    size = 20000
+    calls = [('main', 'f0', 1)] + [
+        ('f{}'.format(i), 'f{}'.format(i + 1), 1) for i in range(size - 1)
+    ]
+    if closed:
+        calls.append(('f{}'.format(size - 1), 'f0', 1))
+    profile = parse(calls)
+    assert len(profile.cycles) == closed
+    main = next(function for function in profile.functions.values()
+                if function.name == 'main')
+    assert main[afgprof2dot.TOTAL_TIME_RATIO] == pytest.approx(1.0)
+
+
+def events(profile, event):
+    """{(caller, callee): value} of the calls with event, and
+    {name: value} of the functions."""
+    functions = profile.functions
+    calls = {}
+    totals = {}
+    for function in functions.values():
+        if event in function.events:
+            totals[function.name] = function[event]
+        for callee_id, call in function.calls.items():
+            if event in call.events:
+                calls[function.name, functions[callee_id].name] = call[event]
+    return calls, totals
+
+
+@pytest.mark.skipif(afgprof2dot.numpy is None, reason='NumPy is not installed')
+@pytest.mark.parametrize('seed', [None, 0, 1])
+def test_numpy_call_ratios(seed):
+    calls = CALLS if seed is None else random_calls(seed, 200, 3)
+    for event in (afgprof2dot.SAMPLES2, afgprof2dot.TOTAL_TIME_RATIO):
+        expected_calls, expected_totals = events(parse(calls), event)
+        numpy_calls, numpy_totals = events(parse(calls, use_numpy=True), event)
+        assert numpy_calls == pytest.approx(expected_calls)
+        assert numpy_totals == pytest.approx(expected_totals)
+
+
+# as computed by the recursive integration of gprof2dot
+TOTAL_TIME_RATIOS = {
+    '?': 1.0,
+    'a': 0.030801911843,
+    'b': 0.018587360595,
+    'eval': 0.297397769517,
+    'expr': 0.6107275624,
+    'factor': 0.265533722783,
+    'init': 0.001593202337,
+    'loop': 0.967073818375,
+    'main': 1.0,
+    'malloc': 0.061603823686,
+    'parse': 0.669144981413,
+    'term': 0.451407328731,
+}
+CALL_TOTAL_TIME_RATIOS = {
+    ('?', 'main'): 1.0,
+    ('a', 'b'): 0.018587360595,
+    ('b', 'malloc'): 0.002655337228,
+    ('eval', 'malloc'): 0.031864046734,
+    ('expr', 'term'): 0.451407328731,
+    ('init', 'malloc'): 0.000531067446,
+    ('loop', 'parse'): 0.669144981413,
+    ('loop', 'eval'): 0.297397769517,
+    ('main', 'init'): 0.001593202337,
+    ('main', 'loop'): 0.967073818375,
+    ('main', 'a'): 0.030801911843,
+    ('parse', 'expr'): 0.6107275624,
+    ('term', 'malloc'): 0.026553372278,
+    ('term', 'factor'): 0.265533722783,
+}
+
+
+def test_integrate_cycles():
+    calls, totals = events(parse(CALLS), afgprof2dot.TOTAL_TIME_RATIO)
+    assert totals == pytest.approx(TOTAL_TIME_RATIOS)
+    assert calls == pytest.approx(CALL_TOTAL_TIME_RATIOS)
+
+
+def names(profile):
+    return sorted(function.name for function in profile.functions.values())
+
+
+def test_find():
+    profile = parse(CALLS)
+    index = afgprof2dot.CallGraphIndex(profile)
+
+    def find(pattern):
+        return sorted(profile.functions[id].name for id in index.find(pattern))
+    assert find('term') == ['term']
+    assert find('ter') == []
+    assert find('e*') == ['eval', 'expr']
+    assert find('re:^.a') == ['factor', 'main', 'malloc', 'parse']
+    with pytest.raises(ValueError, match='leaf node nothing not found'):
+        index.find_all(['main', 'nothing'], 'leaf')
+
+
+@pytest.mark.parametrize('roots, leaves, expected', [
+    (['loop'], [],
+     ['eval', 'expr', 'factor', 'loop', 'malloc', 'parse', 'term']),
+    ([], ['re:^(init|b)$'], ['?', 'a', 'b', 'init', 'main']),
+    (['pa*'], ['malloc'], ['expr', 'factor', 'malloc', 'parse', 'term']),
+    (['main', 'a'], ['b', 'init'], ['a', 'b', 'init', 'main']),
+    ([], [], sorted(TOTAL_TIME_RATIOS)),
+])
+def test_prune_names(roots, leaves, expected):
+    profile = parse(CALLS)
+    profile.prune_names(roots, leaves)
+    assert names(profile) == expected
+    kept = set(expected)
+    expected_calls = {(caller, callee) for caller, callee, count in CALLS
+                      if caller in kept and callee in kept}
+    assert set(events(profile, afgprof2dot.CALLS)[0]) == expected_calls
+
+
+DATA = pathlib.Path(__file__).parent / 'data'
+
+# colors and sizes, which DotWriter rounds to weight levels
+STYLE = re.compile(r'"#([0-9a-f]{6})"|"(\d+\.\d\d)"')
+
+
+def assert_same_graph(dot, expected):
+    """Assert that two dot graphs only differ by the rounding of weights:
+    a unit in a color channel, or 0.01 in a size."""
+    lines = dot.splitlines()
+    expected_lines = expected.splitlines()
+    assert len(lines) == len(expected_lines)
+    for line, expected_line in zip(lines, expected_lines):
+        parts = STYLE.split(line)
+        expected_parts = STYLE.split(expected_line)
+        assert len(parts) == len(expected_parts), line
+        for i in range(0, len(parts), 3):
+            assert parts[i] == expected_parts[i], line
+        for color, expected_color in zip(parts[1::3], expected_parts[1::3]):
+            if color is None or expected_color is None:
+                assert color == expected_color, line
+                continue
+            for channel in range(0, 6, 2):
+                assert abs(
+                    int(color[channel:channel + 2], 16) -
+                    int(expected_color[channel:channel + 2], 16)
+                ) <= 1, line
+        for size, expected_size in zip(parts[2::3], expected_parts[2::3]):
+            if size is None or expected_size is None:
+                assert size == expected_size, line
+                continue
+            assert float(size) == \
+                pytest.approx(float(expected_size), abs=0.011), line
+
+
+@pytest.mark.parametrize('theme', sorted(afgprof2dot.themes) + ['diff'])
+def test_weight_levels(monkeypatch, theme):
+    # total times, and so weights, evenly spread between 0 and 1
+    size = 5000
+    calls = [('f{}'.format(i), 'f{}'.format(i + 1), 1) for i in range(size)]
+    if theme == 'diff':
+        profile = afgprof2dot.diff_profiles(
+            parse(calls[:size // 2]), parse(calls)
+        )
+        afgprof2dot.diff_weigh(profile)
+    else:
+        profile = parse(calls)
+        profile.prune(0.0, 0.0)
+
+    def write_graph():
+        file = io.StringIO()
+        afgprof2dot.write_graph(
+            profile, file,
+            theme=afgprof2dot.themes.get(theme), diff=theme == 'diff'
+        )
+        return file.getvalue()
+    dot = write_graph()
+    # as good as exact
+    monkeypatch.setattr(afgprof2dot.DotWriter, 'weight_levels', 1 << 50)
+    assert_same_graph(dot, write_graph())
+
+
+def test_write_graph():
+    # cycles.dot was written by gprof2dot before DotWriter was optimized
+    profile = parse(CALLS)
+    profile.prune(0.005, 0.001)
+    file = io.StringIO()
+    afgprof2dot.write_graph(profile, file)
+    assert_same_graph(
+        file.getvalue(), (DATA / 'cycles.dot').read_text(encoding='utf-8')
+    )
+
+
+def decode(data):
+    """Decode a protocol buffers message into (number, value) fields, with
+    varints as ints and everything else as bytes."""
+
+    def varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+    fields = []
+    position = 0
+    while position < len(data):
+        key = varint()
+        if key & 7 == 0:
+            fields.append((key >> 3, varint()))
+        else:
+            assert key & 7 == 2
+            length = varint()
+            fields.append((key >> 3, data[position:position + length]))
+            position += length
+    return fields
+
+
+def varints(data):
+    """Decode packed varints."""
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def test_write_pprof():
+    file = io.BytesIO()
+    afgprof2dot.write_graph(parse(CALLS), file, 'pprof')
+    fields = decode(gzip.decompress(file.getvalue()))
+    strings = [value.decode() for number, value in fields if number == 6]
+    assert strings[0] == ''
+    functions = {}
+    for number, value in fields:
+        if number == 5:
+            function = dict(decode(value))
+            functions[function[1]] = strings[function[2]]
+    locations = {}
+    for number, value in fields:
+        if number == 4:
+            location = dict(decode(value))
+            locations[location[1]] = \
+                functions[dict(decode(location[4]))[1]]
+    calls = {}
+    ratios = {}
+    for number, value in fields:
+        if number == 2:
+            sample = decode(value)
+            callee, caller = [locations[id] for id in varints(sample[0][1])]
+            calls[caller, callee] = varints(sample[1][1])[0]
+            for label_number, label in sample[2:]:
+                label = dict(decode(label))
+                assert strings[label[1]] == 'total_time'
+                assert strings[label[4]] == 'ppm'
+                ratios[caller, callee] = label[3] / 1e6
+    assert calls == {(caller, callee): count
+                     for caller, callee, count in CALLS}
+    assert ratios == pytest.approx(CALL_TOTAL_TIME_RATIOS, abs=1e-6)
+
+
+def test_write_callgrind():
+    file = io.StringIO()
+    afgprof2dot.write_graph(parse(CALLS), file, 'callgrind')
+    lines = iter(file.getvalue().splitlines())
+    header = [next(lines) for _ in range(7)]
+    total = sum(count for caller, callee, count in CALLS)
+    assert header[0] == '# callgrind format'
+    assert header[5] == 'summary: {}'.format(total)
+
+    names = {}
+
+    def name(value):
+        # "(id) name" the first time, "(id)" afterwards
+        id_, _, given = value.partition(' ')
+        if given:
+            names[id_] = given
+        return names[id_]
+    costs = {}
+    calls = {}
+    inclusive = {}
+    for line in lines:
+        if line.startswith('fn='):
+            function = name(line[3:])
+            costs[function] = int(next(lines).split()[1])
+        elif line.startswith('cfn='):
+            callee = name(line[4:])
+            calls[function, callee] = int(next(lines).split()[0][6:])
+            inclusive[function, callee] = int(next(lines).split()[1])
+        else:
+            assert line == ''
+
+    samples = {}
+    for caller, callee, count in CALLS:
+        samples[callee] = samples.get(callee, 0) + count
+    assert costs == {function: samples.get(function, 0)
+                     for function in TOTAL_TIME_RATIOS}
+    assert calls == {(caller, callee): count
+                     for caller, callee, count in CALLS}
+    assert inclusive == {
+        call: round(CALL_TOTAL_TIME_RATIOS.get(call, 0.0) * total)
+        for call in calls
+    }
+
+
+def test_diff_profiles():
+    candidate_calls = [
+        (caller, callee, 600 if (caller, callee) == ('eval', 'malloc')
+         else count)
+        for caller, callee, count in CALLS
+        if (caller, callee) != ('main', 'init')
+    ] + [('main', 'new', 5)]
+    baseline = parse(CALLS)
+    candidate = parse(candidate_calls)
+    profile = afgprof2dot.diff_profiles(baseline, candidate)
+
+    assert names(profile) == sorted(list(TOTAL_TIME_RATIOS) + ['new'])
+    delta_calls, _ = events(profile, afgprof2dot.DELTA_CALLS)
+    changes, _ = events(profile, afgprof2dot.CALLS_CHANGE)
+    assert delta_calls[('eval', 'malloc')] == 540
+    assert changes[('eval', 'malloc')] == 10.0
+    assert delta_calls[('main', 'init')] == -2
+    assert changes[('main', 'init')] == 0.0
+    assert delta_calls[('main', 'new')] == 5
+    assert changes[('main', 'new')] == float('inf')
+    assert delta_calls[('term', 'factor')] == 0
+
+    _, old = events(baseline, afgprof2dot.TOTAL_TIME_RATIO)
+    _, new = events(candidate, afgprof2dot.TOTAL_TIME_RATIO)
+    _, delta = events(profile, afgprof2dot.DELTA_TOTAL_TIME_RATIO)
+    assert delta == pytest.approx({
+        name: new.get(name, 0.0) - old.get(name, 0.0) for name in delta
+    })
+
+    afgprof2dot.diff_weigh(profile)
+    weights = []
+    for function in profile.functions.values():
+        weights.append(function.weight)
+        weights.extend(call.weight for call in function.calls.values())
+    assert min(weights) >= 0.0
+    assert max(weights) == 1.0
+
+    report = io.StringIO()
+    afgprof2dot.report_regressions(profile, 3, report)
+    lines = report.getvalue().splitlines()
+    assert lines[0] == 'Top regressions by total time ratio:'
+    assert lines[1].endswith(' malloc')
+    calls = lines.index('Top regressions by calls:')
+    assert lines[calls + 1:] == [
+        '  +540× ×10.00 (600×) eval -> malloc',
+        '  +5× new (5×) main -> new',
+    ]
+
+
+def test_diff_of_a_profile_with_itself():
+    profile = afgprof2dot.diff_profiles(parse(CALLS), parse(CALLS))
+    for event in (afgprof2dot.DELTA_CALLS,
+                  afgprof2dot.DELTA_TOTAL_TIME_RATIO):
+        calls, totals = events(profile, event)
+        assert calls == pytest.approx(dict.fromkeys(calls, 0))
+        assert totals == pytest.approx(dict.fromkeys(totals, 0))
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+import afgprof
+
+
+def write_calls(path, records):
+    with path.open('wb') as file:
+        for record in records:
+            file.write(afgprof.CALL_RECORD.pack(*record))
+    return path
+
+
+@pytest.fixture
+def calls_file(tmp_path):
+    rng = random.Random(1)
+    addresses = [rng.randrange(1 << 32) for i in range(300)]
+    records = [
+        (rng.choice(addresses), rng.choice(addresses), rng.randrange(1, 4))
+        for i in range(5000)
+    ]
+    return write_calls(tmp_path / 'calls', records)
+
+
+@pytest.mark.parametrize('memory_budget', [1, 2000, 1 << 30])
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+def test_streaming_matches_read_calls(calls_file, memory_budget, chunk_size):
+    expected = afgprof.read_calls(calls_file)
+    assert afgprof.read_calls_streaming(
+        calls_file, memory_budget, chunk_size, False
+    ) == expected
+
+
+@pytest.mark.skipif(afgprof.numpy is None, reason='NumPy is not installed')
+def test_numpy_matches_read_calls(calls_file):
+    expected = afgprof.read_calls(calls_file)
+    assert afgprof.read_calls_numpy(calls_file) == expected
+    assert afgprof.read_calls_streaming(calls_file, 2000, 100, True) == \
+        expected
+
+
+def test_streaming_empty_file(tmp_path):
+    calls_file = write_calls(tmp_path / 'calls', [])
+    assert afgprof.read_calls_streaming(calls_file, 1000, 10, False) == \
+        ([], [])
+
+
+def test_external_sorter_spills(tmp_path):
+    rng = random.Random(2)
+    entries = [(rng.randrange(1 << 64), i, 0) for i in range(1000)]
+    sorter = afgprof.ExternalSorter(10 * afgprof.ExternalSorter.entry_size)
+    with sorter:
+        for entry in entries:
+            sorter.add(*entry)
+        assert sorter.runs
+        assert list(sorter) == sorted(entries)
+    assert not sorter.runs
+
+
+def test_chunk_size_must_be_positive(monkeypatch, capsys):
+    monkeypatch.setattr('sys.argv', ['afgprof.py', '--chunk-size', '0', '.'])
+    with pytest.raises(SystemExit):
+        afgprof.main()
+    assert '--chunk-size must be at least 1' in capsys.readouterr().err
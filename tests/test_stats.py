@@ -0,0 +1,78 @@
+import json
+import sys
+
+import afgprof
+from conftest import compile_object, make_capture
+
+SOURCE = '''\
+int callee(void) { return 1; }
+int caller(void) { return callee(); }
+'''
+MAPS = ['40000000-40100000 r-xp 00000000 fd:01 1000 /data/app/libs.so']
+
+
+def test_main_writes_stats(tmp_path, monkeypatch, capsysbinary):
+    objdir = tmp_path / 'obj'
+    objdir.mkdir()
+    obj = compile_object(objdir / 'libs.so', SOURCE)
+    table = afgprof.FunctionSymbolizer().load(str(obj))
+    address = {
+        name: 0x40000000 + start
+        for name, start in zip(table.names, table.starts)
+    }
+    capture = make_capture(tmp_path / 'gmon' / '100', MAPS, [
+        (address['caller'] + 4, address['callee'], 2),
+        (address['caller'] + 4, address['callee'], 3),
+        (0x1000, address['caller'], 1),
+    ])
+    stats_file = tmp_path / 'stats.json'
+    monkeypatch.setattr(sys, 'argv', [
+        'afgprof.py', '--symbolizer', 'elf', '--objdir', str(objdir),
+        '--stats', str(stats_file), '--profile-stage', 'symbolize',
+        str(capture),
+    ])
+    try:
+        afgprof.main()
+    finally:
+        afgprof.tracemalloc.stop()
+    assert json.loads(capsysbinary.readouterr().out)['calls']
+
+    report = json.loads(stats_file.read_text())
+    stages = report['stages']
+    assert list(stages) == ['read', 'translate', 'symbolize', 'write']
+    for name, stage in stages.items():
+        assert stage['wall_seconds'] >= 0
+        assert stage['cpu_seconds'] >= 0
+        assert stage['children_cpu_seconds'] >= 0
+        assert stage['peak_traced_bytes'] > 0
+        assert stage['peak_rss_kib'] > 0
+        assert ('profile' in stage) == (name == 'symbolize')
+    assert (tmp_path / 'stats.json.symbolize.prof').exists()
+
+    assert report['captures'] == 1
+    assert report['records'] == 3
+    assert report['arcs'] == 2
+    assert report['addresses'] == 4
+    objects = report['objects']
+    assert list(objects) == [str(obj)]
+    assert objects[str(obj)]['addresses'] == 3
+    assert objects[str(obj)]['cached'] == 0
+    assert report['workers'] == 1
+
+
+def test_memory_is_only_traced_on_request():
+    stats = afgprof.Stats()
+    with stats.stage('read'):
+        data = [0] * 1000
+    stats.counters['records'] = len(data)
+    assert list(stats.stages['read']) == [
+        'wall_seconds', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_kib'
+    ]
+
+    traced = afgprof.Stats(trace_memory=True)
+    try:
+        with traced.stage('read'):
+            data = [0] * 100000
+        assert traced.stages['read']['peak_traced_bytes'] >= 8 * len(data)
+    finally:
+        afgprof.tracemalloc.stop()
@@ -0,0 +1,128 @@
+import afgprof
+
+
+class FakeSymbolizer(afgprof.Symbolizer):
+    """Name each address after the object and offset, recording the jobs."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def symbolize(self, jobs):
+        self.jobs.append({
+            filename: sorted(addresses) for filename, addresses in jobs.items()
+        })
+        return afgprof.Symbolizer.symbolize(self, jobs)
+
+    def find_symbol_and_line(self, filename, addresses):
+        return [
+            (address, 'f{:x}'.format(address), 'f.c:{}'.format(address))
+            for address in sorted(addresses)
+        ]
+
+
+def test_pathnames_sharing_a_basename(tmp_path):
+    (tmp_path / 'libc.so').touch()
+    index = {
+        0x1000: {'pathname': '/system/lib/libc.so', 'offset': 0x10},
+        0x2000: {'pathname': '/vendor/lib/libc.so', 'offset': 0x20},
+        # same object and offset as the first entry, mapped twice
+        0x3000: {'pathname': '/system/lib/libc.so', 'offset': 0x10},
+        0x4000: {'pathname': None, 'offset': None},
+    }
+    symbolizer = FakeSymbolizer()
+    stats = afgprof.Stats()
+    afgprof.symbolize_index(index, symbolizer, 'fake', tmp_path, stats=stats)
+
+    assert symbolizer.jobs == [{str(tmp_path / 'libc.so'): [0x10, 0x20]}]
+    assert index[0x1000]['symbol'] == 'f10'
+    assert index[0x2000]['symbol'] == 'f20'
+    assert index[0x3000]['location'] == 'f.c:16'
+    assert 'symbol' not in index[0x4000]
+    assert stats.counters['objects'][str(tmp_path / 'libc.so')][
+        'addresses'] == 2
+
+
+def test_missing_objects_are_skipped(tmp_path, capsys):
+    index = {0x1000: {'pathname': '/system/lib/libm.so', 'offset': 0x10}}
+    symbolizer = FakeSymbolizer()
+    afgprof.symbolize_index(index, symbolizer, 'fake', tmp_path)
+
+    assert symbolizer.jobs == []
+    assert 'symbol' not in index[0x1000]
+    assert 'SKIP' in capsys.readouterr().err
+
+
+def test_cache_is_shared_by_pathnames_sharing_a_basename(tmp_path):
+    objdir = tmp_path / 'obj'
+    objdir.mkdir()
+    (objdir / 'libc.so').write_bytes(b'not an ELF file')
+
+    def make_index():
+        return {
+            0x1000: {'pathname': '/system/lib/libc.so', 'offset': 0x10},
+            0x2000: {'pathname': '/vendor/lib/libc.so', 'offset': 0x20},
+        }
+    cache = afgprof.SymbolCache(str(tmp_path / 'cache'), 100)
+    try:
+        afgprof.symbolize_index(
+            make_index(), FakeSymbolizer(), 'fake', objdir, cache
+        )
+        index = make_index()
+        symbolizer = FakeSymbolizer()
+        afgprof.symbolize_index(index, symbolizer, 'fake', objdir, cache)
+    finally:
+        cache.close()
+
+    assert symbolizer.jobs == []
+    assert index[0x1000]['symbol'] == 'f10'
+    assert index[0x2000]['symbol'] == 'f20'
+
+
+HOT_ARCS = [((0x1000, 0x2000), 100), ((0x2000, 0x3000), 10),
+            ((0x3000, 0x4000), 1), ((0x5000, 0x1000), 1)]
+
+
+def test_hot_addresses():
+    assert afgprof.hot_addresses(HOT_ARCS) == \
+        {0x1000, 0x2000, 0x3000, 0x4000, 0x5000}
+    assert afgprof.hot_addresses(HOT_ARCS, coverage=0.85) == {0x1000, 0x2000}
+    assert afgprof.hot_addresses(HOT_ARCS, coverage=0.99) == \
+        {0x1000, 0x2000, 0x3000, 0x4000}
+    assert afgprof.hot_addresses(HOT_ARCS, top_arcs=2) == \
+        {0x1000, 0x2000, 0x3000}
+    assert afgprof.hot_addresses(HOT_ARCS, 0.99, 1) == {0x1000, 0x2000}
+
+
+def test_symbolize_hot_then_fill(tmp_path):
+    (tmp_path / 'libc.so').touch()
+
+    def make_index():
+        index = {
+            address: {'pathname': '/system/lib/libc.so', 'offset': address}
+            for address in (0x1000, 0x2000, 0x3000, 0x4000)
+        }
+        index[0x5000] = {'pathname': None, 'offset': 0x5000}
+        return index
+    expected = make_index()
+    afgprof.symbolize_index(expected, FakeSymbolizer(), 'fake', tmp_path)
+
+    index = make_index()
+    symbolizer = FakeSymbolizer()
+    afgprof.symbolize_hot(
+        index, HOT_ARCS, coverage=0.85,
+        symbolizer=symbolizer, name='fake', objdir=tmp_path,
+    )
+    assert symbolizer.jobs == [{str(tmp_path / 'libc.so'): [0x1000, 0x2000]}]
+    assert index[0x3000] == {
+        'pathname': '/system/lib/libc.so', 'offset': 0x3000,
+        'symbol': 'libc.so+0x3000',
+    }
+    assert index[0x5000] == expected[0x5000]
+
+    pending = afgprof.unresolved(index)
+    assert sorted(pending) == [0x3000, 0x4000]
+    afgprof.symbolize_hot(
+        pending, HOT_ARCS, symbolizer=symbolizer, name='fake', objdir=tmp_path
+    )
+    assert symbolizer.jobs[1] == {str(tmp_path / 'libc.so'): [0x3000, 0x4000]}
+    assert index == expected
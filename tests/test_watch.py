@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+import afgprof
+from conftest import compile_object, make_capture
+
+MAPS = ['40000000-40100000 r-xp 00001000 fd:01 1000 /system/lib/liba.so']
+
+
+def find(symbolizer, obj, name):
+    """Symbolize the address of the function called name in obj."""
+    table = symbolizer.load(str(obj))
+    address = table.starts[table.names.index(name)]
+    [(_, symbol, _)] = symbolizer.find_symbol_and_line(str(obj), [address])
+    return symbol
+
+
+def test_symbol_tables_are_reloaded_when_the_object_changes(tmp_path):
+    obj = compile_object(
+        tmp_path / 'liba.so', 'int before(void) { return 1; }\n'
+    )
+    symbolizer = afgprof.FunctionSymbolizer()
+    assert find(symbolizer, obj, 'before') == 'before'
+
+    rebuilt = compile_object(
+        tmp_path / 'rebuilt.so', 'int after(void) { return 1; }\n'
+    )
+    os.replace(str(rebuilt), str(obj))
+    assert find(symbolizer, obj, 'after') == 'after'
+    assert 'before' not in symbolizer.load(str(obj)).names
+
+
+@pytest.fixture
+def watched(tmp_path):
+    make_capture(
+        tmp_path / 'gmon' / '1234', MAPS, [(0x40000010, 0x40000020, 1)]
+    )
+    return tmp_path / 'gmon'
+
+
+def write(file, index, arcs):
+    file.write(b'done')
+
+
+def stop_after(monkeypatch, scans):
+    sleep = time.sleep
+    count = [0]
+
+    def fake_sleep(seconds):
+        count[0] += 1
+        if count[0] >= scans:
+            raise KeyboardInterrupt
+        sleep(0.05)
+    monkeypatch.setattr(afgprof.time, 'sleep', fake_sleep)
+
+
+def test_failed_captures_are_retried(watched, monkeypatch, capsys):
+    calls = []
+
+    def symbolize(index, arcs):
+        calls.append(len(arcs))
+        if len(calls) == 1:
+            raise ValueError('object busy')
+    stop_after(monkeypatch, 50)
+    afgprof.watch(watched, watched, '.out', 0, symbolize, write, 1)
+
+    assert calls == [1, 1]
+    assert (watched / '1234.out').read_bytes() == b'done'
+    err = capsys.readouterr().err
+    assert 'FAIL {}: object busy, retrying'.format(watched / '1234') in err
+
+
+def test_failing_captures_are_skipped_after_attempts(
+        watched, monkeypatch, capsys
+):
+    calls = []
+
+    def symbolize(index, arcs):
+        calls.append(len(arcs))
+        raise ValueError('broken')
+    stop_after(monkeypatch, 50)
+    afgprof.watch(watched, watched, '.out', 0, symbolize, write, 1, attempts=2)
+
+    assert calls == [1, 1]
+    assert not (watched / '1234.out').exists()
+    assert 'skipping it after 2 attempts' in capsys.readouterr().err
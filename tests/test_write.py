@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+
+import afgprof
+
+
+def make_profile(size):
+    index = {}
+    for i in range(size):
+        index[0x1000 + i] = {
+            'pathname': '/lib/lib{}.so'.format(i % 3) if i % 5 else None,
+            'offset': i,
+        }
+        if i % 5:
+            index[0x1000 + i].update(
+                symbol='f{}'.format(i % 7), location='f.c:{}'.format(i)
+            )
+    arcs = [((0x1000 + i, 0x1000 + i // 2), size - i) for i in range(size)]
+    return index, arcs
+
+
+def document(index, arcs):
+    return {
+        'index': index,
+        'calls': [
+            {'lr': lr, 'pc': pc, 'count': count}
+            for (lr, pc), count in arcs
+        ],
+    }
+
+
+def write_json(index, arcs, **kwargs):
+    file = io.StringIO()
+    afgprof.write_json(file, index, arcs, **kwargs)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize('size', [0, 1, 10000])
+def test_write_json_matches_json_dump(size):
+    index, arcs = make_profile(size)
+    assert write_json(index, arcs) == \
+        json.dumps(document(index, arcs), indent=2)
+    assert write_json(index, arcs, compact=True) == \
+        json.dumps(document(index, arcs), separators=(',', ':'))
+
+
+def test_string_table_is_unique():
+    index, arcs = make_profile(100)
+    strings = json.loads(write_json(index, arcs, string_table=True))['strings']
+    assert len(strings) == len(set(strings))
+    assert set(strings) == {
+        info[field] for info in index.values()
+        for field in afgprof.STRING_FIELDS if info.get(field) is not None
+    }
+
+
+@pytest.mark.parametrize('format_, kwargs', [
+    ('json', {}),
+    ('json', {'string_table': True}),
+    ('binary', {}),
+])
+def test_read_profile(format_, kwargs):
+    index, arcs = make_profile(100)
+    file = io.BytesIO()
+    afgprof.write_profile(file, index, arcs, format_, **kwargs)
+    file.seek(0)
+    assert afgprof.read_profile(file) == (index, arcs)